@@ -3,9 +3,13 @@ import logging
 import sys
 import os
 import re
-from peakflow_soap import ConnectionOptions, PeakflowSOAP 
+import time
+from peakflow_soap import ConnectionOptions, get_pool, session
+from workers import run_parallel
 
-from lxml import objectify
+from array import array
+from cStringIO import StringIO
+from lxml import etree, objectify
 
 import urllib2
 
@@ -26,8 +30,22 @@ def num_normalise(number):
     except:
         return "N/A"
 
-class Alert:
+class Alert(object):
+    """ A DoS alert
+
+        Values are copied out of the XML into plain Python types so that no
+        reference to the XML tree is kept. Slots keep the per-alert
+        footprint small when holding many alerts.
+    """
+
+    __slots__ = ('id', 'direction', 'type', 'protocol', 'protocol_number',
+            'destination', 'target_mo', 'target_mo_id', 'sources',
+            'impact_bps', 'impact_pps', 'threshold', 'threshold_unit',
+            'attack_start', 'attack_stop', 'ongoing', 'duration',
+            'mitigation_name', 'mitigation_start', 'mitigation_stop')
+
     def __init__(self):
+        self.id = None
         self.direction = None
         self.type = None
         self.protocol = None
@@ -138,49 +156,99 @@ class Alert:
 
 
     @classmethod
-    def from_id(cls, co, alert_id):
-        a = Alert()
+    def from_id(cls, co, alert_id, timeout=None):
+        """ Fetch an alert from Peakflow
 
-        pf = PeakflowSOAP(co)
+            timeout is how long to wait for a pooled connection.
+        """
+        with session(co, timeout) as pf:
+            a = find_summary(pf, alert_id)
+            if a is None:
+                raise ValueError("Alert %s not found" % alert_id)
+            details = pf.getDosAlertDetailsXML(alert_id)
 
-        # get XML from peakflow
-        res = pf.getDosAlertSummariesXML(alert_id)
-        # XML to python
-        root = objectify.fromstring(res.encode('utf-8'))
+        for name, sources in iter_samples(details):
+            a.sources.extend(sources)
+        return a
+
+
+    @classmethod
+    def from_ids(cls, co, alert_ids, max_workers=8, timeout=None):
+        """ Fetch many alerts from Peakflow in parallel
+
+            Alerts are fetched by at most max_workers threads over pooled
+            connections and yielded as (alert_id, alert, error) tuples as
+            soon as each one completes. error is None on success, otherwise
+            it is the exception raised while fetching the alert and alert is
+            None.
+
+            timeout is how long to wait for a pooled connection, the timeout
+            of the SOAP requests themselves is set by the timeout of the
+            ConnectionOptions.
+        """
+        get_pool(co, max_workers)
+        fetch = lambda alert_id: cls.from_id(co, alert_id, timeout)
+        for alert_id, a, exc_info in run_parallel(fetch, alert_ids, max_workers):
+            if exc_info is not None:
+                logging.warning("Unable to fetch alert %s: %s" % (alert_id, exc_info[1]))
+                yield alert_id, None, exc_info[1]
+            else:
+                yield alert_id, a, None
+
+
+    @classmethod
+    def from_summary_element(cls, el):
+        """ Create an Alert from one alert element of the XML returned by
+            getDosAlertSummariesXML
+        """
+        a = Alert()
 
         # extract values
-        a.direction = root.alert.direction
-        a.type = root.alert.get('type')
-        a.destination = root.alert.resource.ip
         try:
-            a.attack_start = datetime.fromtimestamp(int(root.alert.duration.get('start')))
+            a.id = int(el.get('id'))
+        except:
+            pass
+        a.direction = el.direction.text
+        a.type = el.get('type')
+        a.destination = el.resource.ip.text
+        try:
+            a.attack_start = datetime.fromtimestamp(int(el.duration.get('start')))
+        except:
+            pass
+        try:
+            a.attack_stop = datetime.fromtimestamp(int(el.duration.get('stop')))
+        except:
+            pass
+        # an alert without the ongoing attribute is ongoing until it stops
+        a.ongoing = _to_bool(el.duration.get('ongoing'))
+        if a.ongoing is None:
+            a.ongoing = a.attack_stop is None
+        a.duration = int(el.duration.get('length'))
+        a.target_mo = el.resource.managed_object.get('name')
+        try:
+            a.target_mo_id = int(el.resource.managed_object.get('gid'))
         except:
             pass
         try:
-            a.attack_stop = datetime.fromtimestamp(int(root.alert.duration.get('stop')))
+            a.protocol = el.protocol.text
         except:
             pass
-        a.ongoing = bool(root.alert.duration.get('ongoing'))
-        a.duration = int(root.alert.duration.get('length'))
-        a.target_mo = root.alert.resource.managed_object.get('name')
-        a.target_mo_id = root.alert.resource.managed_object.get('gid')
         try:
-            a.protocol = root.alert.protocol
+            a.impact_bps = float(el.impact.get('bps'))
         except:
             pass
         try:
-            a.impact_bps = root.alert.impact.get('bps')
+            a.impact_pps = float(el.impact.get('pps'))
         except:
             pass
         try:
-            a.impact_pps = root.alert.impact.get('pps')
+            a.threshold = float(el.severity.get('threshold'))
         except:
             pass
-        a.threshold = root.alert.severity.get('threshold')
-        a.threshold_unit = root.alert.severity.get('unit')
+        a.threshold_unit = el.severity.get('unit')
 
         try:
-            for annotation in root.alert['annotation-list'].iterchildren():
+            for annotation in el['annotation-list'].iterchildren():
                 m = re.match("TMS mitigation '([^']+)' (started|stopped)", str(annotation.content))
                 if m is not None:
                     a.mitigation_name = m.group(1)
@@ -191,20 +259,395 @@ class Alert:
         except:
             pass
 
-        res = client.service.getDosAlertDetailsXML(alert_id)
-        root = objectify.fromstring(res.encode('utf-8'))
-        for item in root['sample-list']:
-            if item.get('name') is None:
-                continue
+        return a
+
+
+    @classmethod
+    def from_xml(cls, summary, details, alert_id=None):
+        """ Create an Alert from the XML returned by getDosAlertSummariesXML
+            and getDosAlertDetailsXML
+
+            The summary of alert_id is used, or the first one if no
+            alert_id is given.
+        """
+        # XML to python
+        root = objectify.fromstring(summary.encode('utf-8'))
+        for el in root.iterchildren(tag='alert'):
+            if alert_id is None or el.get('id') == str(alert_id):
+                break
+        else:
+            raise ValueError("Alert %s not found in summaries" % alert_id)
+        a = cls.from_summary_element(el)
 
-            for prefix in item.prefixes.find('prefix'):
-                if prefix.get('is_dst') == "0":
-                    a.sources.append(prefix.get('cidr'))
+        for name, sources in iter_samples(details):
+            a.sources.extend(sources)
 
         return a
 
 
 
+def _to_bool(value):
+    # xsd:boolean
+    if value is None:
+        return None
+    return value.lower() in ('true', '1')
+
+def parse_summaries(summaries):
+    """ Return the alerts with an ID in the XML returned by
+        getDosAlertSummariesXML as a list of Alert
+    """
+    alerts = []
+    root = objectify.fromstring(summaries.encode('utf-8'))
+    for el in root.iterchildren(tag='alert'):
+        a = Alert.from_summary_element(el)
+        if a.id is not None:
+            alerts.append(a)
+    return alerts
+
+def find_summary(pf, alert_id, max_count=10000):
+    """ Return the summary of alert alert_id as an Alert, or None if
+        Peakflow doesn't know of it
+
+        The filter of getDosAlertSummariesXML is a free text search, so
+        searching for alert 12 also finds alert 112 and any other alert
+        mentioning 12. The search is widened until alert_id is among the
+        alerts returned, there are no more alerts to return or max_count
+        alerts are returned.
+    """
+    alert_id = int(alert_id)
+    count = 1
+    while True:
+        alerts = parse_summaries(pf.getDosAlertSummariesXML(str(alert_id), count))
+        for a in alerts:
+            if a.id == alert_id:
+                return a
+        if len(alerts) < count or count >= max_count:
+            return None
+        count = min(count * 10, max_count)
+
+def fetch_recent(pf, filter, count, last_id=None, max_count=None):
+    """ Return the most recent alerts matching filter
+
+        Returns a tuple of a list of Alert and whether the alerts reach
+        back to last_id. If more than count alerts are newer than last_id,
+        the count is doubled until the alerts returned reach back to
+        last_id, there are no more alerts to return or, if given, max_count
+        alerts are returned.
+    """
+    while True:
+        alerts = parse_summaries(pf.getDosAlertSummariesXML(filter, count))
+        if (last_id is None or len(alerts) < count
+                or min([a.id for a in alerts]) <= last_id):
+            return alerts, True
+        if max_count is not None and count >= max_count:
+            return alerts, False
+        count *= 2
+        if max_count is not None:
+            count = min(count, max_count)
+
+def to_epoch(dt):
+    """ Convert a naive datetime in local time, as used by Alert, to
+        seconds since the epoch, None stays None
+    """
+    if dt is None:
+        return None
+    return time.mktime(dt.timetuple())
+
+def from_epoch(epoch):
+    """ Convert seconds since the epoch to a datetime as used by Alert,
+        None or NaN to None
+    """
+    if epoch is None or epoch != epoch:
+        return None
+    return datetime.fromtimestamp(epoch)
+
+def _to_number(value):
+    if value is None:
+        return NaN
+    return value
+
+def _from_number(value):
+    if value != value:
+        return None
+    return value
+
+NaN = float('nan')
+
+
+class AlertBatch:
+    """ Many alerts stored column by column
+
+        Numeric values are kept in typed arrays, with NaN or -1 for missing
+        values, and strings in lists where equal values share one string
+        object. This takes a fraction of the memory of one Alert per alert
+        and lets aggregations run over a whole column at a time. Sources
+        are not kept.
+    """
+
+    def __init__(self):
+        self.id = array('l')
+        self.target_mo_id = array('l')
+        self.attack_start = array('d')
+        self.attack_stop = array('d')
+        self.duration = array('d')
+        self.impact_bps = array('d')
+        self.impact_pps = array('d')
+        self.threshold = array('d')
+        self.mitigation_start = array('d')
+        self.mitigation_stop = array('d')
+        self.ongoing = array('b')
+        self.type = []
+        self.direction = []
+        self.protocol = []
+        self.destination = []
+        self.target_mo = []
+        self.threshold_unit = []
+        self.mitigation_name = []
+        self._strings = {}
+
+    def _intern(self, value):
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+    def append(self, a):
+        """ Add an Alert to the batch
+        """
+        self.id.append(a.id if a.id is not None else -1)
+        self.target_mo_id.append(a.target_mo_id if a.target_mo_id is not None else -1)
+        self.attack_start.append(_to_number(to_epoch(a.attack_start)))
+        self.attack_stop.append(_to_number(to_epoch(a.attack_stop)))
+        self.duration.append(_to_number(a.duration))
+        self.impact_bps.append(_to_number(a.impact_bps))
+        self.impact_pps.append(_to_number(a.impact_pps))
+        self.threshold.append(_to_number(a.threshold))
+        self.mitigation_start.append(_to_number(to_epoch(a.mitigation_start)))
+        self.mitigation_stop.append(_to_number(to_epoch(a.mitigation_stop)))
+        self.ongoing.append(bool(a.ongoing))
+        self.type.append(self._intern(a.type))
+        self.direction.append(self._intern(a.direction))
+        self.protocol.append(self._intern(a.protocol))
+        self.destination.append(self._intern(a.destination))
+        self.target_mo.append(self._intern(a.target_mo))
+        self.threshold_unit.append(self._intern(a.threshold_unit))
+        self.mitigation_name.append(self._intern(a.mitigation_name))
+
+    def extend(self, alerts):
+        for a in alerts:
+            self.append(a)
+
+    @classmethod
+    def from_alerts(cls, alerts):
+        batch = AlertBatch()
+        batch.extend(alerts)
+        return batch
+
+    @classmethod
+    def from_summaries_xml(cls, summaries):
+        """ Create an AlertBatch from the XML returned by
+            getDosAlertSummariesXML
+        """
+        batch = AlertBatch()
+        root = objectify.fromstring(summaries.encode('utf-8'))
+        for el in root.iterchildren(tag='alert'):
+            batch.append(Alert.from_summary_element(el))
+        return batch
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, i):
+        """ Return alert i of the batch as an Alert
+        """
+        a = Alert()
+        a.id = self.id[i] if self.id[i] != -1 else None
+        a.target_mo_id = self.target_mo_id[i] if self.target_mo_id[i] != -1 else None
+        a.attack_start = from_epoch(self.attack_start[i])
+        a.attack_stop = from_epoch(self.attack_stop[i])
+        a.duration = _from_number(self.duration[i])
+        a.impact_bps = _from_number(self.impact_bps[i])
+        a.impact_pps = _from_number(self.impact_pps[i])
+        a.threshold = _from_number(self.threshold[i])
+        a.mitigation_start = from_epoch(self.mitigation_start[i])
+        a.mitigation_stop = from_epoch(self.mitigation_stop[i])
+        a.ongoing = bool(self.ongoing[i])
+        a.type = self.type[i]
+        a.direction = self.direction[i]
+        a.protocol = self.protocol[i]
+        a.destination = self.destination[i]
+        a.target_mo = self.target_mo[i]
+        a.threshold_unit = self.threshold_unit[i]
+        a.mitigation_name = self.mitigation_name[i]
+        return a
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+
+def iter_samples(details):
+    """ Decode the XML returned by getDosAlertDetailsXML one sample at a time
+
+        Yields a (name, sources) tuple for every named sample-list element,
+        where sources is the list of source prefixes, ie those under
+        prefixes with is_dst 0, of the sample. The XML is parsed
+        incrementally and every sample-list is freed once yielded, so memory
+        use does not grow with the number of samples.
+    """
+    if isinstance(details, unicode):
+        details = details.encode('utf-8')
+
+    for event, elem in etree.iterparse(StringIO(details), events=('end',), tag='sample-list'):
+        name = elem.get('name')
+        if name is not None:
+            sources = []
+            prefixes = elem.find('prefixes')
+            if prefixes is not None:
+                for prefix in prefixes.iterchildren(tag='prefix'):
+                    if prefix.get('is_dst') == "0":
+                        sources.append(prefix.get('cidr'))
+            yield name, sources
+
+        parent = elem.getparent()
+        if parent is None:
+            continue
+
+        # free the sample and the ones before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def iter_sources(details):
+    """ Yield the source prefixes of the XML returned by
+        getDosAlertDetailsXML, see iter_samples
+    """
+    for name, sources in iter_samples(details):
+        for source in sources:
+            yield source
+
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class AlertEvent:
+    """ A change to an alert seen by the AlertPoller
+
+        type is one of 'started', 'impact_increased', 'mitigation_started',
+        'mitigation_ended' and 'ended'. previous is the alert as seen in the
+        previous cycle, None for 'started'.
+    """
+
+    def __init__(self, type, alert, previous=None):
+        self.type = type
+        self.alert = alert
+        self.previous = previous
+
+    def __repr__(self):
+        return "<AlertEvent %s %s>" % (self.type, self.alert.id)
+
+
+class AlertPoller:
+    """ Watch Peakflow for new and changing alerts
+
+        Each cycle fetches the count most recent alerts matching filter in
+        a single getDosAlertSummariesXML call. Alerts newer than the highest
+        alert ID seen so far are new, while alerts we know to be ongoing are
+        compared with how they looked in the previous cycle. Ongoing alerts
+        that have dropped out of the most recent alerts are looked up by ID,
+        see find_summary.
+        Finished alerts are forgotten and never fetched again, so the cost
+        of a cycle only depends on the number of new and ongoing alerts.
+
+        If more than count alerts arrived since the previous cycle, the
+        count is doubled, up to max_count, until the alerts returned reach
+        back to those already seen.
+    """
+
+    def __init__(self, co, filter='', count=100, interval=60, max_count=10000):
+        self.co = co
+        self.filter = filter
+        self.count = count
+        self.max_count = max_count
+        self.interval = interval
+        self.last_id = None
+        self.ongoing = {}
+
+    def poll(self):
+        """ Run one poll cycle and return a list of AlertEvent
+        """
+        with session(self.co) as pf:
+            alerts, complete = fetch_recent(pf, self.filter, self.count,
+                    self.last_id, self.max_count)
+            if not complete:
+                logging.warning("More than %d new alerts since last poll, alerts after %d may be missed" % (self.max_count, self.last_id))
+
+            # ongoing alerts that are no longer among the most recent ones
+            missing = set(self.ongoing) - set([a.id for a in alerts])
+            for alert_id in missing:
+                a = find_summary(pf, alert_id)
+                if a is None:
+                    logging.warning("Ongoing alert %d not found, forgetting it" % alert_id)
+                    del self.ongoing[alert_id]
+                    continue
+                alerts.append(a)
+
+        events = []
+        last_id = self.last_id
+        for a in sorted(alerts, key=lambda a: a.id):
+            previous = self.ongoing.get(a.id)
+            if previous is None:
+                if last_id is not None and a.id <= last_id:
+                    # finished alert we already know of
+                    continue
+                if last_id is None and not a.ongoing:
+                    # alerts that finished before we started polling
+                    self.last_id = max(self.last_id, a.id)
+                    continue
+                events.append(AlertEvent('started', a))
+                if a.mitigation_start:
+                    events.append(AlertEvent('mitigation_started', a))
+            else:
+                if (_to_float(a.impact_bps) > _to_float(previous.impact_bps)
+                        or _to_float(a.impact_pps) > _to_float(previous.impact_pps)):
+                    events.append(AlertEvent('impact_increased', a, previous))
+                if a.mitigation_start and not previous.mitigation_start:
+                    events.append(AlertEvent('mitigation_started', a, previous))
+
+            if a.mitigation_stop and (previous is None or not previous.mitigation_stop):
+                events.append(AlertEvent('mitigation_ended', a, previous))
+
+            if not a.ongoing:
+                events.append(AlertEvent('ended', a, previous))
+                self.ongoing.pop(a.id, None)
+            else:
+                self.ongoing[a.id] = a
+
+            if self.last_id is None or a.id > self.last_id:
+                self.last_id = a.id
+
+        return events
+
+    def run(self):
+        """ Poll forever, yielding AlertEvent as they are seen
+        """
+        while True:
+            start = time.time()
+            try:
+                for event in self.poll():
+                    yield event
+            except Exception, exc:
+                logging.warning("Polling alerts failed: %s" % exc)
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+
+
 if __name__ == '__main__':
     logger = logging.getLogger()
     log_stream = logging.StreamHandler()
@@ -220,13 +663,23 @@ if __name__ == '__main__':
     parser.add_option("-P", "--password", help="password for SOAP API connection")
     parser.add_option("--human", action="store_true", help="Print a human readable summary of current state")
     parser.add_option("--detail", action="store_true", help="Print a details of alert")
+    parser.add_option("--workers", type="int", default=8, help="number of alerts to fetch in parallel")
+    parser.add_option("--watch", action="store_true", help="Watch for new and changing alerts")
+    parser.add_option("--interval", type="int", default=60, help="seconds between polls when watching")
     (options, args) = parser.parse_args()
 
     co = ConnectionOptions(options.host, options.username, options.password)
 #    pf = PeakflowSOAP(options.host, options.username, options.password)
 
-    for arg in args:
-        alert = Alert().from_id(co, arg)
+    if options.watch:
+        poller = AlertPoller(co, interval=options.interval)
+        for event in poller.run():
+            print "%s: %s" % (event.type, event.alert.get_current_status())
+
+    for alert_id, alert, error in Alert.from_ids(co, args, options.workers):
+        if error is not None:
+            print >> sys.stderr, "Unable to fetch alert %s: %s" % (alert_id, error)
+            continue
         if options.human:
             print alert.get_current_status()
         if options.detail:
@@ -0,0 +1,164 @@
+""" Aggregate statistics over batches of alerts using NumPy
+"""
+
+import logging
+import sys
+import time
+from collections import Counter
+
+import numpy
+
+from alert import AlertBatch
+
+def column(batch, name):
+    """ Return a copy of a column of an AlertBatch as a NumPy array
+    """
+    values = getattr(batch, name)
+    if isinstance(values, list):
+        return numpy.array(values, dtype=object)
+    # a view would point at freed memory once the batch grows, as array
+    # does not lock its buffer, so copy right away
+    return numpy.frombuffer(values, dtype=values.typecode).copy()
+
+
+def impact_percentiles(batch, unit='bps', percentiles=(50, 90, 95, 99)):
+    """ Return the percentiles of impact, in bps or pps, per target managed
+        object
+
+        Returns a dict of managed object gid to an array with one value per
+        percentile. Alerts without a target managed object or impact are
+        left out.
+    """
+    impact = column(batch, 'impact_%s' % unit)
+    mo_ids = column(batch, 'target_mo_id')
+    valid = (mo_ids != -1) & ~numpy.isnan(impact)
+    impact = impact[valid]
+    mo_ids = mo_ids[valid]
+
+    res = {}
+    if not len(impact):
+        return res
+    # sort once so the impacts of every managed object are contiguous
+    order = numpy.lexsort((impact, mo_ids))
+    impact = impact[order]
+    mo_ids = mo_ids[order]
+    keys, starts, counts = numpy.unique(mo_ids, return_index=True, return_counts=True)
+    # linear interpolation between the closest ranks, like numpy.percentile,
+    # for all managed objects and percentiles at once
+    pos = starts[:, None] + (counts[:, None] - 1) * (numpy.asarray(percentiles, dtype=float) / 100)
+    low = numpy.floor(pos).astype(int)
+    high = numpy.ceil(pos).astype(int)
+    values = impact[low] + (impact[high] - impact[low]) * (pos - low)
+    for key, value in zip(keys, values):
+        res[int(key)] = value
+    return res
+
+
+def duration_histogram(batch, bins=(0, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 24 * 3600, numpy.inf)):
+    """ Return a histogram of attack durations in seconds as a tuple of
+        (counts, bin edges)
+    """
+    duration = column(batch, 'duration')
+    duration = duration[~numpy.isnan(duration)]
+    return numpy.histogram(duration, bins=numpy.asarray(bins, dtype=float))
+
+
+def top_destinations(batch, n=10):
+    """ Return the n most attacked destinations as a list of
+        (destination, number of alerts)
+    """
+    # destinations are strings, which NumPy can only sort as Python
+    # objects, so counting them in a dict is faster
+    counts = Counter(batch.destination)
+    counts.pop(None, None)
+    return counts.most_common(n)
+
+
+def mitigation_coverage(batch):
+    """ Return the ratio of alerts that were mitigated, overall and per
+        target managed object
+
+        Returns a tuple of the overall ratio and a dict of managed object gid
+        to ratio.
+    """
+    mitigated = ~numpy.isnan(column(batch, 'mitigation_start'))
+    if not len(mitigated):
+        return None, {}
+    mo_ids = column(batch, 'target_mo_id')
+    keys, inverse = numpy.unique(mo_ids, return_inverse=True)
+    totals = numpy.bincount(inverse, minlength=len(keys))
+    covered = numpy.bincount(inverse, weights=mitigated, minlength=len(keys))
+    ratios = covered / totals
+    per_mo = {}
+    for key, ratio in zip(keys, ratios):
+        if key != -1:
+            per_mo[int(key)] = float(ratio)
+    return float(mitigated.mean()), per_mo
+
+
+
+def _synthetic_batch(num_alerts):
+    """ Generate a batch of random alerts for benchmarking
+    """
+    from alert import Alert
+    from datetime import datetime
+    import random
+
+    batch = AlertBatch()
+    now = time.time()
+    for i in xrange(num_alerts):
+        a = Alert()
+        a.id = i
+        a.target_mo_id = random.randint(1, 2000)
+        a.destination = "192.0.2.%d" % random.randint(0, 255)
+        a.duration = random.expovariate(1 / 900.0)
+        a.impact_bps = random.expovariate(1 / 1e9)
+        a.impact_pps = a.impact_bps / 800
+        a.attack_start = datetime.fromtimestamp(now - random.randint(0, 365 * 86400))
+        if random.random() < 0.2:
+            a.mitigation_start = a.attack_start
+        batch.append(a)
+    return batch
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("--summaries", metavar="FILE", help="read alerts from getDosAlertSummariesXML output in FILE")
+    parser.add_option("--benchmark", metavar="ALERTS", type="int", help="benchmark aggregations on ALERTS synthetic alerts")
+    (options, args) = parser.parse_args()
+
+    if options.summaries:
+        f = open(options.summaries)
+        batch = AlertBatch.from_summaries_xml(f.read().decode('utf-8'))
+        f.close()
+    elif options.benchmark:
+        batch = _synthetic_batch(options.benchmark)
+    else:
+        print >> sys.stderr, "Please specify --summaries or --benchmark."
+        sys.exit(1)
+
+    start = time.time()
+    percentiles = impact_percentiles(batch)
+    histogram = duration_histogram(batch)
+    top = top_destinations(batch)
+    coverage, coverage_per_mo = mitigation_coverage(batch)
+    elapsed = time.time() - start
+
+    print "Duration histogram:"
+    counts, edges = histogram
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print "  %8ss - %8ss: %d" % (int(low), high, count)
+    print "Top destinations:"
+    for destination, count in top:
+        print "  %-40s %d" % (destination, count)
+    print "Mitigation coverage: %s" % coverage
+    print "Aggregated %d alerts over %d managed objects in %.3fs" % (len(batch), len(percentiles), elapsed)
@@ -1,11 +1,17 @@
+import bisect
 import logging
 import sys
 import os
 import re
 import textwrap
+import time
 import urllib
 
-from peakflow_soap import ConnectionOptions, PeakflowSOAP
+from peakflow_soap import ConnectionOptions, CliBatch
+from config import PeakflowConfig
+from prefix_index import parse_prefix, prefix_contains
+
+_intf_rule_line_re = re.compile('services sp auto-config interface rules (add|edit) "([^"]+)"')
 
 class InterfaceRule:
     """ Auto-Configuration Rule 
@@ -34,15 +40,26 @@ class InterfaceRule:
 
 
     @classmethod
-    def from_peakflow(cls, co):
+    def from_peakflow(cls, co, config=None):
+        """ Read auto configuration interface rules from a Peakflow system
+
+            An already fetched PeakflowConfig can be passed as config,
+            otherwise the configuration is read through the configuration
+            cache.
         """
+        if config is None:
+            config = PeakflowConfig.from_cache(co)
+        intf_rules = cls.from_config(config)
+        for ir in intf_rules:
+            ir.co = co
+        return intf_rules
+
+
+    @classmethod
+    def from_config(cls, config):
+        """ Read auto configuration interface rules from a PeakflowConfig
         """
-        pf = PeakflowSOAP(co)
-        config = pf.cliRun("config show")
-        mos = cls.from_conf(config['results'])
-        for mo in mos:
-            mo.co = co
-        return mos
+        return cls._from_config_lines(config.get_lines('auto-config'))
 
 
     @classmethod
@@ -51,10 +68,18 @@ class InterfaceRule:
             representing the auto configuration interfaces rules on the Peakflow
             platform.
         """
+        return cls._from_config_lines(config.splitlines())
+
+
+    @classmethod
+    def _from_config_lines(cls, lines):
+        """ Group configuration lines by interface rule and return a list of
+            InterfaceRules
+        """
         intf_rules = []
         raw_intf_rules = {}
-        for line in config.splitlines():
-            m = re.match('services sp auto-config interface rules (add|edit) "([^"]+)"', line)
+        for line in lines:
+            m = _intf_rule_line_re.match(line)
             if m is not None:
                 if m.group(2) not in raw_intf_rules:
                     raw_intf_rules[m.group(2)] = []
@@ -88,7 +113,7 @@ class InterfaceRule:
             # precedence
             m = re.match('services sp auto-config interface rules edit "([^"]+)" precedence set ([0-9]+)', line)
             if m is not None:
-                ir.precedence = m.group(2)
+                ir.precedence = int(m.group(2))
 
             # description
             m = re.match('services sp auto-config interface rules edit "([^"]+)" description set "([^"]+)"', line)
@@ -99,6 +124,17 @@ class InterfaceRule:
             m = re.match('services sp auto-config interface rules edit "([^"]+)" regexp_uri set (.+)$', line)
             if m is not None:
                 ir.regexp_uri = m.group(2)
+                ir.match_intf_desc_regex = urllib.unquote(m.group(2).strip('"'))
+
+            # match / routers
+            m = re.match('services sp auto-config interface rules edit "([^"]+)" routers add "([^"]+)"', line)
+            if m is not None:
+                ir.match_routers.append(m.group(2))
+
+            # match / interface subnet
+            m = re.match('services sp auto-config interface rules edit "([^"]+)" subnet set (.+)$', line)
+            if m is not None:
+                ir.match_intf_subnet = m.group(2).strip('"')
 
             # action / action type enable
             m = re.match('services sp auto-config interface rules edit "([^"]+)" action type (.+)$', line)
@@ -133,25 +169,38 @@ class InterfaceRule:
         return ir
 
 
-    def save(self):
+    def get_commands(self):
+        """ Return the CLI commands that configure this interface rule
+
+            Attributes that are not set, ie None, are left out.
+        """
         cmds = []
         cmds.append("services sp auto-config interface rules add \"%s\"" % self.name)
-        cmds.append("services sp auto-config interface rules edit \"%s\" description set \"%s\"" % (self.name, self.description))
-        cmds.append("services sp auto-config interface rules edit \"%s\" precedence set %s" % (self.name, self.precedence))
+        if self.description is not None:
+            cmds.append("services sp auto-config interface rules edit \"%s\" description set \"%s\"" % (self.name, self.description))
+        if self.precedence is not None:
+            cmds.extend(self.get_precedence_commands())
+
+        for router in self.match_routers:
+            cmds.append("services sp auto-config interface rules edit \"%s\" routers add \"%s\"" % (self.name, router))
+        if self.match_intf_subnet is not None:
+            cmds.append("services sp auto-config interface rules edit \"%s\" subnet set \"%s\"" % (self.name, self.match_intf_subnet))
 
         if self.action_type:
             cmds.append("services sp auto-config interface rules edit \"%s\" action type enable" % self.name)
-            cmds.append("services sp auto-config interface rules edit \"%s\" type set %s" % (self.name, self.action_set_type))
+            if self.action_set_type is not None:
+                cmds.append("services sp auto-config interface rules edit \"%s\" type set %s" % (self.name, self.action_set_type))
         else:
             cmds.append("services sp auto-config interface rules edit \"%s\" action type disable" % self.name)
 
         if self.action_asns:
             cmds.append("services sp auto-config interface rules edit \"%s\" action asns enable" % self.name)
-            cmds.append("services sp auto-config interface rules edit \"%s\" peers set %s" % (self.name, self.action_set_asn))
+            if self.action_set_asn is not None:
+                cmds.append("services sp auto-config interface rules edit \"%s\" peers set %s" % (self.name, self.action_set_asn))
         else:
             cmds.append("services sp auto-config interface rules edit \"%s\" action asns disable" % self.name)
 
-        if self.action_set_mo:
+        if self.action_set_mo_type:
             cmds.append("services sp auto-config interface rules edit \"%s\" action managed_objects enable" % self.name)
             cmds.append("services sp auto-config interface rules edit \"%s\" managed_objects type set %s" % (self.name, self.action_set_mo_type))
             for mo in self.action_set_mos:
@@ -159,18 +208,326 @@ class InterfaceRule:
         else:
             cmds.append("services sp auto-config interface rules edit \"%s\" managed_objects clear" % self.name)
 
-        cmds.append("services sp auto-config interface rules edit \"%s\" regexp set \"%s\"" % (self.name, self.match_intf_desc_regex))
+        if self.match_intf_desc_regex is not None:
+            cmds.append("services sp auto-config interface rules edit \"%s\" regexp set \"%s\"" % (self.name, self.match_intf_desc_regex))
+
+        return cmds
+
+
+    def get_precedence_commands(self):
+        """ Return the CLI commands that set only the precedence of this
+            interface rule
+        """
+        return ["services sp auto-config interface rules edit \"%s\" precedence set %s" % (self.name, self.precedence)]
+
+
+    def save(self, batch=None):
+        """ Save the interface rule to Peakflow
+
+            If a CliBatch is given the commands are only added to it and
+            sent when the batch is run, otherwise they are sent right away.
+        """
+        if batch is not None:
+            batch.extend(self.get_commands())
+            return None
+
+        batch = CliBatch(self.co)
+        batch.extend(self.get_commands())
+        return batch.run(commit=False)[-1][1]
+
+
+    def save_precedence(self, batch=None):
+        """ Save only the precedence of the interface rule to Peakflow, like
+            save()
+        """
+        if batch is not None:
+            batch.extend(self.get_precedence_commands())
+            return None
+
+        batch = CliBatch(self.co)
+        batch.extend(self.get_precedence_commands())
+        return batch.run(commit=False)[-1][1]
+
+class IntfRuleList:
+    """ Interface rules ordered by precedence
+
+        Rules are kept sorted on (precedence, name) and indexed by name and
+        precedence. Positions are found by bisection, so inserting, moving
+        and removing rules costs O(log n) comparisons plus shifting the
+        underlying list. Rules are inserted at a position rather than with
+        a precedence; insert() and move() pick a precedence for the rule
+        and renumber as few other rules as possible to make room for it,
+        returning the rules whose precedence then needs to be saved.
+
+            rules = IntfRuleList(InterfaceRule.from_peakflow(co))
+            batch = CliBatch(co)
+            for rule in rules.insert(rules.index("transit") + 1, new_rule):
+                rule.save_precedence(batch)
+            new_rule.save(batch)
+            for rule in rules.move("backbone", 0):
+                rule.save_precedence(batch)
+            batch.run()
+    """
+
+    min_precedence = 1
+    # precedence distance between rules appended at the end
+    step = 10
+
+    def __init__(self, rules=()):
+        self._keys = []
+        self._rules = []
+        self._by_name = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """ Add rule at the position of its precedence
+        """
+        if rule.name in self._by_name:
+            raise ValueError("Interface rule %s already exists" % rule.name)
+        rule.precedence = int(rule.precedence)
+        key = (rule.precedence, rule.name)
+        i = bisect.bisect(self._keys, key)
+        self._keys.insert(i, key)
+        self._rules.insert(i, rule)
+        self._by_name[rule.name] = rule
+
+    def remove(self, name):
+        """ Remove and return the rule called name
+        """
+        rule = self._by_name.pop(name)
+        i = bisect.bisect_left(self._keys, (rule.precedence, rule.name))
+        del self._keys[i]
+        del self._rules[i]
+        return rule
+
+    def get(self, name):
+        """ Return the rule called name or None
+        """
+        return self._by_name.get(name)
+
+    def index(self, name):
+        """ Return the position of the rule called name
+        """
+        rule = self._by_name[name]
+        return bisect.bisect_left(self._keys, (rule.precedence, rule.name))
+
+    def get_by_precedence(self, precedence):
+        """ Return the rules with precedence
+        """
+        i = bisect.bisect_left(self._keys, (precedence,))
+        j = bisect.bisect_left(self._keys, (precedence + 1,))
+        return self._rules[i:j]
+
+    def get_renumbering(self, index):
+        """ Return how to make room for a rule at position index
+
+            Returns a tuple of the precedence for the new rule and a list of
+            (rule, new precedence) for the rules that must be renumbered.
+            Room is made either by moving the rules before index down or
+            the rules after it up, whichever renumbers fewer rules. Only
+            rules in a consecutive run next to index are renumbered.
+        """
+        n = len(self._keys)
+        if index < 0:
+            index = max(0, n + index)
+        index = min(index, n)
+        low = self.min_precedence - 1
+        if index > 0:
+            low = self._keys[index - 1][0]
+        if index == n:
+            if index == 0:
+                return self.step, []
+            return low + self.step, []
+        high = self._keys[index][0]
+        if high - low > 1:
+            return (low + high) // 2, []
+
+        # move the following rules up
+        up = []
+        precedence = low + 1
+        required = precedence + 1
+        for j in xrange(index, n):
+            if self._keys[j][0] >= required:
+                break
+            up.append((self._rules[j], required))
+            required += 1
+
+        # or the preceding rules down, if there is room below them
+        down = []
+        down_precedence = high - 1
+        required = down_precedence - 1
+        for j in xrange(index - 1, -1, -1):
+            if self._keys[j][0] <= required:
+                break
+            down.append((self._rules[j], required))
+            required -= 1
+        if down_precedence >= self.min_precedence and \
+                (not down or down[-1][1] >= self.min_precedence) and \
+                len(down) < len(up):
+            return down_precedence, down
+        return precedence, up
+
+    def insert(self, index, rule):
+        """ Insert rule at position index, like list.insert()
+
+            Sets the precedence of rule and renumbers other rules as needed.
+            Returns the other rules whose precedence changed, for which only
+            the precedence needs saving.
+        """
+        if rule.name in self._by_name:
+            raise ValueError("Interface rule %s already exists" % rule.name)
+        precedence, renumbered = self.get_renumbering(index)
+        # look up all positions first as the keys are only sorted again
+        # once all renumbering is done
+        positions = [self.index(other.name) for other, other_precedence in renumbered]
+        for i, (other, other_precedence) in zip(positions, renumbered):
+            other.precedence = other_precedence
+            self._keys[i] = (other_precedence, other.name)
+        rule.precedence = precedence
+        self.add(rule)
+        return [other for other, other_precedence in renumbered]
+
+    def move(self, name, index):
+        """ Move the rule called name to position index, counted without
+            the rule itself
+
+            Returns the rules whose precedence changed, including the moved
+            rule unless it kept its precedence.
+        """
+        rule = self.remove(name)
+        precedence = rule.precedence
+        renumbered = self.insert(index, rule)
+        if rule.precedence != precedence:
+            renumbered.insert(0, rule)
+        return renumbered
 
-        pf = PeakflowSOAP(self.co)
-        for cmd in cmds:
-            res = pf.cliRun(cmd)
-        return res
+    def __len__(self):
+        return len(self._rules)
 
-class IntfRuleList(list):
-    """ Class that will emulate a normal list but is ordered by precedence of
-        elements it holds
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __getitem__(self, index):
+        return self._rules[index]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __repr__(self):
+        return "IntfRuleList(%r)" % [(rule.precedence, rule.name) for rule in self._rules]
+
+
+
+class RuleEvaluator:
+    """ Predict which interface rule classifies each router interface
+
+        Rules are tried in order of precedence, lowest first, and the first
+        rule whose routers, interface subnet and description regexp all
+        match an interface, where set, classifies it. Rules are compiled
+        once: rules are indexed by router so only rules for the router of
+        an interface or for any router are tried, subnets are parsed to
+        integers and every distinct regexp is compiled and then evaluated
+        at most once per description.
+
+            evaluator = RuleEvaluator(InterfaceRule.from_peakflow(co))
+            rule = evaluator.classify("router1", "Customer: ACME", "192.0.2.0/30")
     """
 
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=_precedence_key)
+        regexps = {}
+        # one (position, rule, subnet, regexp) per rule
+        compiled = []
+        for pos, rule in enumerate(self.rules):
+            subnet = None
+            if rule.match_intf_subnet:
+                try:
+                    subnet = parse_prefix(rule.match_intf_subnet)
+                except ValueError, exc:
+                    logging.warning("Rule %s never matches: %s" % (rule.name, exc))
+                    continue
+            regexp = rule.match_intf_desc_regex
+            if regexp and regexp not in regexps:
+                try:
+                    regexps[regexp] = re.compile(regexp)
+                except re.error, exc:
+                    logging.warning("Rule %s never matches, invalid regexp %s: %s" % (rule.name, regexp, exc))
+                    continue
+            compiled.append((pos, rule, subnet, regexp or None))
+        self._regexps = regexps
+
+        self._any_router = []
+        self._by_router = {}
+        for entry in compiled:
+            if not entry[1].match_routers:
+                self._any_router.append(entry)
+        for entry in compiled:
+            for router in set(entry[1].match_routers):
+                self._by_router.setdefault(router, []).append(entry)
+        # merge the rules for any router into every router's rules once
+        for router, entries in self._by_router.items():
+            self._by_router[router] = sorted(entries + self._any_router)
+
+    def classify(self, router, description, subnet = None):
+        """ Return the rule classifying an interface or None
+        """
+        if subnet:
+            try:
+                subnet = parse_prefix(subnet)
+            except ValueError:
+                subnet = None
+        regexp_results = {}
+        for pos, rule, rule_subnet, regexp in self._by_router.get(router, self._any_router):
+            if rule_subnet is not None and (subnet is None or not prefix_contains(rule_subnet, subnet)):
+                continue
+            if regexp is not None:
+                matched = regexp_results.get(regexp)
+                if matched is None:
+                    matched = regexp_results[regexp] = self._regexps[regexp].search(description or '') is not None
+                if not matched:
+                    continue
+            return rule
+        return None
+
+    def classify_many(self, interfaces):
+        """ Classify (router, description, subnet) interfaces
+
+            Returns a tuple of a list with the rule, or None, for every
+            interface and a dict of statistics.
+        """
+        start = time.time()
+        res = [self.classify(router, description, subnet)
+                for router, description, subnet in interfaces]
+        elapsed = time.time() - start
+
+        hits = {}
+        for rule in res:
+            if rule is not None:
+                hits[rule.name] = hits.get(rule.name, 0) + 1
+        stats = {
+                'interfaces': len(res),
+                'matched': sum(hits.values()),
+                'hits': hits,
+                'elapsed': elapsed,
+                'per_interface': None
+                }
+        if res:
+            stats['per_interface'] = elapsed / len(res)
+        return res, stats
+
+
+
+def _precedence_key(rule):
+    """ Sort key ordering rules by numeric precedence, rules without one
+        last
+    """
+    try:
+        return (0, int(rule.precedence), rule.name)
+    except (TypeError, ValueError):
+        return (1, 0, rule.name)
+
+
 
 if __name__ == '__main__':
     logger = logging.getLogger()
@@ -184,6 +541,7 @@ if __name__ == '__main__':
     parser = optparse.OptionParser()
     parser.add_option("--test-slurp", help="test to slurp config FILE")
     parser.add_option("--list", action="store_true", help="list rules")
+    parser.add_option("--classify", metavar="FILE", help="classify the tab separated 'router description subnet' interfaces in FILE")
     (options, args) = parser.parse_args()
 
     if options.test_slurp:
@@ -209,3 +567,18 @@ if __name__ == '__main__':
                     print "    %s" % line
 
 
+
+        if options.classify:
+            interfaces = []
+            f = open(options.classify)
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                interfaces.append(tuple((fields + [None, None])[:3]))
+            f.close()
+            evaluator = RuleEvaluator(intf_rules)
+            res, stats = evaluator.classify_many(interfaces)
+            for interface, rule in zip(interfaces, res):
+                print "%-20s %-40s %-20s %s" % (interface[0], interface[1], interface[2], rule.name if rule else '-')
+            print "Classified %d interfaces, %d matched, in %.3fs (%.1fus per interface)" % (
+                    stats['interfaces'], stats['matched'], stats['elapsed'],
+                    (stats['per_interface'] or 0) * 1e6)
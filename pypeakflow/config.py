@@ -0,0 +1,262 @@
+""" Snapshot of the configuration of an Arbor Peakflow SP system
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import re
+import time
+
+import peakflow_soap
+from peakflow_soap import ConnectionOptions, session
+
+# file name of a cached configuration, 'config-<host>-<key>.pickle'
+_filename_re = re.compile('^config-(.+)-[0-9a-f]{40}\.pickle$')
+
+class PeakflowConfig:
+    """ The configuration of a Peakflow SP system as returned by 'config show'
+
+        The configuration is fetched once and split up per subsystem, ie the
+        keyword following 'services sp', in a single pass. The object models,
+        like ManagedObject and InterfaceRule, are then built from the lines
+        of their subsystem without having to fetch or scan the full
+        configuration again.
+    """
+
+    prefix = 'services sp '
+
+    def __init__(self):
+        self.co = None
+        self.subsystems = {}
+        self.num_lines = 0
+
+    @classmethod
+    def from_peakflow(cls, co):
+        """ Fetch the configuration from a Peakflow system
+        """
+        with session(co) as pf:
+            config = pf.cliRun("config show")
+        conf = cls.from_conf(config['results'])
+        conf.co = co
+        return conf
+
+    @classmethod
+    def from_cache(cls, co):
+        """ Return the configuration of a Peakflow system, served from the
+            configuration cache when possible
+        """
+        return config_cache.get(co)
+
+    @classmethod
+    def from_conf(cls, config):
+        """ Read configuration text and group its lines by subsystem
+        """
+        conf = PeakflowConfig()
+        prefix_len = len(cls.prefix)
+        subsystems = conf.subsystems
+        for line in config.splitlines():
+            conf.num_lines += 1
+            if not line.startswith(cls.prefix):
+                continue
+            end = line.find(' ', prefix_len)
+            if end == -1:
+                subsystem = line[prefix_len:]
+            else:
+                subsystem = line[prefix_len:end]
+            if subsystem not in subsystems:
+                subsystems[subsystem] = []
+            subsystems[subsystem].append(line)
+
+        return conf
+
+    def get_lines(self, subsystem):
+        """ Return configuration lines of subsystem, eg 'managed_objects'
+        """
+        return self.subsystems.get(subsystem, [])
+
+    def __repr__(self):
+        return "<PeakflowConfig %d lines, %d subsystems>" % (self.num_lines, len(self.subsystems))
+
+
+
+class ConfigCache:
+    """ Cache of PeakflowConfig snapshots keyed by ConnectionOptions
+
+        Snapshots are kept in memory and pickled to cache_dir so that they
+        survive between processes. A snapshot younger than ttl seconds is
+        returned as is. An older snapshot is revalidated by running
+        revision_command, if one is set, and comparing a hash of its output
+        to that of when the snapshot was taken; only if it differs is the full
+        configuration fetched again. Without a revision_command, expired
+        snapshots are always fetched again.
+
+        Snapshots are keyed on the full ConnectionOptions, so sessions with
+        other credentials never share a snapshot, and every caller gets its
+        own copy of the snapshot to modify. Our own changes, through
+        ManagedObject.save or PeakflowSOAP.commit, invalidate the snapshots
+        of that host.
+    """
+
+    def __init__(self, ttl=300, cache_dir=None, revision_command=None):
+        if cache_dir is None:
+            cache_dir = peakflow_soap.cache_dir
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.revision_command = revision_command
+        self._entries = {}
+
+    def get(self, co):
+        """ Return a PeakflowConfig for the host of co
+        """
+        entry = self._entries.get(co)
+        if entry is None:
+            entry = self._load(co)
+
+        if entry is not None:
+            if time.time() - entry['fetched'] < self.ttl:
+                return self._to_config(entry, co)
+            if self.revision_command is not None:
+                revision = self._get_revision(co)
+                if revision == entry['revision']:
+                    logging.debug("Configuration of %s unchanged, revalidated snapshot" % co.host)
+                    entry['fetched'] = time.time()
+                    self._store(co, entry)
+                    return self._to_config(entry, co)
+
+        # take revision before the configuration so that we never store a
+        # revision newer than the configuration
+        revision = None
+        if self.revision_command is not None:
+            revision = self._get_revision(co)
+        conf = PeakflowConfig.from_peakflow(co)
+        entry = {
+            'fetched': time.time(),
+            'revision': revision,
+            'subsystems': conf.subsystems,
+            'num_lines': conf.num_lines
+            }
+        self._store(co, entry)
+        return self._to_config(entry, co)
+
+    def invalidate(self, host=None):
+        """ Drop the snapshot of host, or of all hosts if host is None
+        """
+        for co in self._entries.keys():
+            if host is None or co.host == host:
+                del self._entries[co]
+
+        paths = []
+        if os.path.isdir(self.cache_dir):
+            for filename in os.listdir(self.cache_dir):
+                m = _filename_re.match(filename)
+                if m is not None and (host is None or m.group(1) == host):
+                    paths.append(os.path.join(self.cache_dir, filename))
+
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _get_revision(self, co):
+        with session(co) as pf:
+            res = pf.cliRun(self.revision_command)
+        return hashlib.sha1(res['results']).hexdigest()
+
+    def _to_config(self, entry, co):
+        # copy the line lists so that callers can't change the snapshot
+        conf = PeakflowConfig()
+        conf.co = co
+        conf.subsystems = dict([(subsystem, list(lines))
+            for subsystem, lines in entry['subsystems'].iteritems()])
+        conf.num_lines = entry['num_lines']
+        return conf
+
+    def _path(self, co):
+        # the file name holds a hash of all options, not the password itself
+        key = hashlib.sha1(repr(co._key())).hexdigest()
+        return os.path.join(self.cache_dir, 'config-%s-%s.pickle' % (co.host, key))
+
+    def _load(self, co):
+        host = co.host
+        if not peakflow_soap.check_cache_dir(self.cache_dir):
+            return None
+        try:
+            fd = os.open(self._path(co), os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        f = os.fdopen(fd, 'rb')
+        try:
+            if os.fstat(fd).st_uid != os.getuid():
+                logging.warning("Not reading cached configuration of %s, not owned by us" % host)
+                return None
+            try:
+                entry = cPickle.load(f)
+            except Exception, exc:
+                logging.warning("Unable to read cached configuration of %s: %s" % (host, exc))
+                return None
+        finally:
+            f.close()
+        self._entries[co] = entry
+        return entry
+
+    def _store(self, co, entry):
+        host = co.host
+        self._entries[co] = entry
+        # the configuration holds secrets, like SNMP communities, so keep it
+        # private to the user
+        if not peakflow_soap.check_cache_dir(self.cache_dir):
+            return
+        try:
+            tmp_path = "%s.%d" % (self._path(co), os.getpid())
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path(co))
+        except (IOError, OSError), exc:
+            logging.warning("Unable to write cached configuration of %s: %s" % (host, exc))
+
+
+config_cache = ConfigCache()
+
+def invalidate(host=None):
+    """ Invalidate the cached configuration of host, or of all hosts
+    """
+    config_cache.invalidate(host)
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="host for SOAP API connection, typically the leader")
+    parser.add_option("-U", "--username", help="username for SOAP API connection")
+    parser.add_option("-P", "--password", help="password for SOAP API connection")
+    parser.add_option("--test-slurp", help="test to slurp config FILE")
+    parser.add_option("--cached", action="store_true", help="use the configuration cache")
+    (options, args) = parser.parse_args()
+
+    if options.test_slurp:
+        f = open(options.test_slurp)
+        conf = PeakflowConfig.from_conf(f.read())
+        f.close()
+    else:
+        co = ConnectionOptions(options.host, options.username, options.password)
+        if options.cached:
+            conf = PeakflowConfig.from_cache(co)
+        else:
+            conf = PeakflowConfig.from_peakflow(co)
+
+    for subsystem in sorted(conf.subsystems):
+        print "%-30s %d lines" % (subsystem, len(conf.subsystems[subsystem]))
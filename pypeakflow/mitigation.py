@@ -0,0 +1,241 @@
+""" TMS and blackhole mitigations
+"""
+
+import calendar
+import logging
+import re
+import sys
+from datetime import datetime, timedelta
+
+from cStringIO import StringIO
+from lxml import etree
+
+from peakflow_soap import ConnectionOptions, session
+
+_datetime_re = re.compile('^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+# tags of a mitigation in the XML, the schema of the non-XML call names it
+# mitigationSummary
+_mitigation_tags = ('mitigationSummary', 'mitigation')
+
+class Mitigation(object):
+    """ A mitigation, with the fields of MitigationSummary in the WSDL
+
+        Like Alert, values are plain Python types and slots keep the
+        footprint small when scanning many mitigations. start and stop are
+        naive datetimes in local time, like those of Alert.
+    """
+
+    __slots__ = ('id', 'type', 'name', 'description', 'user', 'ip_version',
+            'alert_id', 'prefix', 'is_automitigation', 'is_learning',
+            'managed_object_id', 'managed_object_name', 'ongoing', 'start',
+            'stop', 'duration')
+
+    def __init__(self):
+        self.id = None
+        self.type = None
+        self.name = None
+        self.description = None
+        self.user = None
+        self.ip_version = None
+        self.alert_id = None
+        self.prefix = None
+        self.is_automitigation = None
+        self.is_learning = None
+        self.managed_object_id = None
+        self.managed_object_name = None
+        self.ongoing = None
+        self.start = None
+        self.stop = None
+        self.duration = None
+
+    @classmethod
+    def from_element(cls, el):
+        """ Create a Mitigation from one mitigation element of the XML
+            returned by getMitigationSummariesXML
+        """
+        m = Mitigation()
+        m.id = _to_int(_text(el, 'id'))
+        m.type = _text(el, 'type')
+        m.name = _text(el, 'name')
+        m.description = _text(el, 'description')
+        m.user = _text(el, 'user')
+        m.ip_version = _to_int(_text(el, 'ip_version'))
+        m.alert_id = _to_int(_text(el, 'alert_id'))
+        m.prefix = _text(el, 'prefix')
+        m.is_automitigation = _to_bool(_text(el, 'is_automitigation'))
+        m.is_learning = _to_bool(_text(el, 'is_learning'))
+        m.managed_object_id = _to_int(_text(el, 'managed_object_id'))
+        m.managed_object_name = _text(el, 'managed_object_name')
+        m.ongoing = _to_bool(_text(el, 'ongoing'))
+        m.start = _to_datetime(_text(el, 'start'))
+        m.stop = _to_datetime(_text(el, 'stop'))
+        try:
+            m.duration = float(_text(el, 'duration'))
+        except (TypeError, ValueError):
+            pass
+        return m
+
+    def __repr__(self):
+        return "<Mitigation %s %s %s>" % (self.id, self.type, self.name)
+
+
+
+def _text(el, name):
+    child = el.find(name)
+    if child is None or child.text is None or not child.text.strip():
+        return None
+    return child.text.strip()
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_bool(value):
+    if value is None:
+        return None
+    return value.lower() in ('true', '1')
+
+def _to_datetime(value):
+    """ Convert an xsd:dateTime to a naive datetime in local time
+    """
+    if value is None:
+        return None
+    m = _datetime_re.match(value)
+    if m is None:
+        logging.warning("Unable to parse time: %s" % value)
+        return None
+    fields = [int(field) for field in m.groups()[:6]]
+    tz = m.group(7)
+    if tz is None:
+        return datetime(*fields)
+    offset = 0
+    if tz != 'Z':
+        tz = tz.replace(':', '')
+        offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+        if tz[0] == '-':
+            offset = -offset
+    return datetime.fromtimestamp(calendar.timegm(fields + [0, 0, 0]) - offset)
+
+
+
+def iter_summaries_xml(summaries):
+    """ Decode the XML returned by getMitigationSummariesXML one mitigation
+        at a time
+
+        The XML is parsed incrementally and every mitigation element is
+        freed once decoded, so memory use does not grow with the number of
+        mitigations.
+    """
+    for elem in _iter_elements(summaries):
+        yield Mitigation.from_element(elem)
+
+
+def _iter_elements(summaries):
+    if isinstance(summaries, unicode):
+        summaries = summaries.encode('utf-8')
+
+    for event, elem in etree.iterparse(StringIO(summaries), events=('end',)):
+        if elem.tag not in _mitigation_tags:
+            continue
+        yield elem
+
+        # free the mitigation and the ones before it
+        elem.clear()
+        parent = elem.getparent()
+        while parent is not None and elem.getprevious() is not None:
+            del parent[0]
+
+
+def iter_mitigations(co, window_filter, start, end=None, window=86400,
+        page_size=1000, max_mitigations=None):
+    """ Yield the mitigations from start to end, newest window first
+
+        getMitigationSummariesXML has no offset, so the time range is paged
+        by filter instead: window_filter(window_start, window_end) returns
+        the search filter, in the syntax of the search box of the UI, that
+        matches the mitigations of a time window. The range is fetched
+        window seconds at a time with a max_count of page_size. A window
+        that returns a full page may have more mitigations, so it is split
+        in two and each half fetched again. No response thus holds more
+        than page_size mitigations and none are lost, unless a window of a
+        second still fills a page. Mitigations matched by more than one
+        window are yielded once. start and end are naive datetimes in local
+        time, end defaults to now.
+
+        Paging stops after max_mitigations or when the caller stops
+        iterating.
+    """
+    if end is None:
+        end = datetime.now()
+    # windows to fetch, the newest last
+    windows = []
+    window_end = end
+    while window_end > start:
+        window_start = max(start, window_end - timedelta(seconds=window))
+        windows.insert(0, (window_start, window_end))
+        window_end = window_start
+
+    seen = set()
+    while windows:
+        window_start, window_end = windows.pop()
+        with session(co) as pf:
+            res = pf.getMitigationSummariesXML(window_filter(window_start, window_end), page_size)
+        mitigations = list(iter_summaries_xml(res))
+        if len(mitigations) >= page_size:
+            if window_end - window_start > timedelta(seconds=1):
+                middle = window_start + (window_end - window_start) / 2
+                logging.debug("Full page for %s - %s, splitting it at %s" % (window_start, window_end, middle))
+                windows.append((window_start, middle))
+                windows.append((middle, window_end))
+                continue
+            logging.warning("More than %d mitigations from %s to %s, some are missing" % (page_size, window_start, window_end))
+
+        for m in mitigations:
+            if m.id is None:
+                logging.warning("Skipping mitigation without ID: %s" % m.name)
+                continue
+            if m.id in seen:
+                continue
+            seen.add(m.id)
+            yield m
+            if max_mitigations is not None and len(seen) >= max_mitigations:
+                return
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="host for SOAP API connection, typically the leader")
+    parser.add_option("-U", "--username", help="username for SOAP API connection")
+    parser.add_option("-P", "--password", help="password for SOAP API connection")
+    parser.add_option("--window-filter", help="search filter matching the mitigations from %(start)s to %(end)s")
+    parser.add_option("--days", type="int", default=7, help="list mitigations of the last DAYS days")
+    parser.add_option("--page-size", type="int", default=1000, help="most mitigations per request")
+    parser.add_option("--max", type="int", help="stop after MAX mitigations")
+    (options, args) = parser.parse_args()
+
+    if not options.host:
+        print >> sys.stderr, "Please specify a remote host for SOAP API connection."
+        sys.exit(1)
+
+    if not options.window_filter:
+        print >> sys.stderr, "Please specify a search filter for a time window."
+        sys.exit(1)
+
+    window_filter = lambda start, end: options.window_filter % {'start': start, 'end': end}
+    co = ConnectionOptions(options.host, options.username, options.password)
+    start = datetime.now() - timedelta(days=options.days)
+    for m in iter_mitigations(co, window_filter, start, page_size=options.page_size,
+            max_mitigations=options.max):
+        print "%-8s %-10s %-20s %-20s %-20s %s" % (m.id, m.type, m.start, m.stop or 'ongoing', m.prefix, m.name)
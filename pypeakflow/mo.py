@@ -4,7 +4,8 @@ import os
 import re
 import urllib
 
-from peakflow_soap import ConnectionOptions, PeakflowSOAP
+from peakflow_soap import ConnectionOptions, CliBatch
+from config import PeakflowConfig
 
 class MoMatch:
     """ Match
@@ -24,6 +25,9 @@ class MoMatchAsPath(MoMatch):
     def __repr__(self):
         return "AS Path Regexp: %s" % self.aspath
 
+    def get_conf(self):
+        return "asregexp_uri \"%s\"" % urllib.quote(self.aspath, safe='')
+
 
 class MoMatchCidrBlocks(MoMatch):
     def __init__(self):
@@ -42,6 +46,9 @@ class MoMatchCidrBlocks(MoMatch):
             res += "    %s\n" % prefix
         return res
 
+    def get_conf(self):
+        return "cidr_blocks %s" % ",".join(sorted(self.prefix))
+
 
 class MoMatchCidrV6Blocks(MoMatch):
     def __init__(self):
@@ -60,6 +67,9 @@ class MoMatchCidrV6Blocks(MoMatch):
             res += "    %s\n" % prefix
         return res
 
+    def get_conf(self):
+        return "cidr_v6_blocks %s" % ",".join(sorted(self.prefix))
+
 
 
 
@@ -92,38 +102,57 @@ class ManagedObject:
         self.family = None
         self.tags = {}
         self.match = None
+        # state as loaded from Peakflow, None for new objects
+        self._loaded = None
 
     def __repr__(self):
         return "%s" % self.name
 
     @classmethod
-    def from_peakflow(cls, co):
-        """
+    def from_peakflow(cls, co, config=None):
+        """ Read managed objects from a Peakflow system
+
+            An already fetched PeakflowConfig can be passed as config,
+            otherwise the configuration is read through the configuration
+            cache.
         """
-        pf = PeakflowSOAP(co)
-        config = pf.cliRun("config show")
-        mos = cls.from_conf(config['results'])
+        if config is None:
+            config = PeakflowConfig.from_cache(co)
+        mos = cls.from_config(config)
         for mo in mos:
             mo.co = co
         return mos
 
+    @classmethod
+    def from_config(cls, config):
+        """ Read managed objects from a PeakflowConfig
+        """
+        return cls._from_config_lines(config.get_lines('managed_objects'))
+
     @classmethod
     def from_conf(cls, config):
         """ Read managed objects from config and return a list of objects
             representing managed objects on the Peakflow platform.
         """
+        return cls._from_config_lines(config.splitlines())
+
+    @classmethod
+    def _from_config_lines(cls, lines):
+        """ Group configuration lines by managed object and return a list of
+            ManagedObjects
+        """
         mos = []
         raw_mos = {}
-        for line in config.splitlines():
-            m = re.match('services sp managed_objects (add(_with_parent)?|edit) "(?P<name>[^"]+)"', line)
-            if m is not None:
-                name = m.group('name').split('|')[-1]
+        for line in lines:
+            token = _tokenize(line)
+            if token is not None:
+                name = token[2]
                 if name not in raw_mos:
                     raw_mos[name] = []
-                raw_mos[name].append(line)
+                raw_mos[name].append(token)
 
         for name in raw_mos:
-            mos.append(ManagedObject.from_lines(raw_mos[name]))
+            mos.append(ManagedObject._from_tokens(raw_mos[name]))
 
         return mos
 
@@ -136,71 +165,240 @@ class ManagedObject:
             Returns one ManagedObject representing a Managed Object on the
             Peakflow platform.
         """
-        mo = ManagedObject()
+        tokens = []
         for line in lines:
+            token = _tokenize(line)
+            if token is None:
+                token = (line, None, None, None)
+            tokens.append(token)
+        return ManagedObject._from_tokens(tokens)
+
+
+
+    @classmethod
+    def _from_tokens(cls, tokens):
+        """ Create a Managed Object from lines already split by _tokenize
+
+            Each line is only matched against the one attribute regexp that
+            its leading keyword dispatches to.
+        """
+        mo = ManagedObject()
+        for line, verb, name, attr in tokens:
             # store a verbatim copy of the configuration lines that pertain to
             # this MO
             mo.config_lines.append(line)
 
             # name
-            m = re.match('services sp managed_objects add(_with_parent)? "(?P<name>[^"]+)"', line)
-            if m is not None:
-                mo.name = m.group('name').split('|')[-1]
+            if verb == 'add' or verb == 'add_with_parent':
+                mo.name = name
 
-            # description
-            m = re.match('services sp managed_objects edit "([^"]+)" description set "(?P<description>[^"]+)"', line)
-            if m is not None:
-                mo.description = m.group('description')
+            if attr is None:
+                continue
 
-            # family
-            m = re.match('services sp managed_objects edit "([^"]+)" family set ([^ $]+)', line)
+            parser = _attr_parsers.get(attr.split(' ', 1)[0])
+            if parser is None:
+                continue
+            regexp, handler = parser
+            m = regexp.match(attr)
             if m is not None:
-                mo.family = m.group(2)
+                getattr(mo, handler)(m)
 
-            # tag
-            m = re.match('services sp managed_objects edit "([^"]+)" tags add "([^"]+)"', line)
-            if m is not None:
-                mo.tags[m.group(2)] = None
+        mo._loaded = mo._get_state()
+        return mo
 
-            # match
-            m = re.match('services sp managed_objects edit "([^"]+)" match set (?P<match>[^ ]+) (?P<value>.+)', line)
-            if m is not None:
 
-                if m.group('match') == 'asregexp_uri':
-                    mo.match = MoMatchAsPath.from_value(m.group('value').strip('"'))
-                elif m.group('match') == 'cidr_blocks':
-                    mo.match = MoMatchCidrBlocks.from_value(m.group('value'))
-                elif m.group('match') == 'cidr_v6_blocks':
-                    mo.match = MoMatchCidrV6Blocks.from_value(m.group('value'))
-                elif m.group('match') == 'peer_as':
-                    mo.match = MoMatchPeerAs.from_value(m.group('value'))
-                else:
-                    raise NotImplementedError("No match class for: %s" % m.group('match'))
-
-            # misuse detection
-            m = re.match('services sp managed_objects edit "([^"]+)" detection misuse (?P<match>[^ ]+) (trigger|high_severity) set (?P<value>[0-9]+)', line)
-            if m is not None:
-                #if m.group(
-                pass
+    def _parse_description(self, m):
+        self.description = m.group('description')
 
-        return mo
+    def _parse_family(self, m):
+        self.family = m.group('family')
 
-    def save(self):
+    def _parse_tag(self, m):
+        self.tags[m.group('tag')] = None
+
+    def _parse_match(self, m):
+        if m.group('match') == 'asregexp_uri':
+            self.match = MoMatchAsPath.from_value(m.group('value').strip('"'))
+        elif m.group('match') == 'cidr_blocks':
+            self.match = MoMatchCidrBlocks.from_value(m.group('value'))
+        elif m.group('match') == 'cidr_v6_blocks':
+            self.match = MoMatchCidrV6Blocks.from_value(m.group('value'))
+        elif m.group('match') == 'peer_as':
+            self.match = MoMatchPeerAs.from_value(m.group('value'))
+        else:
+            raise NotImplementedError("No match class for: %s" % m.group('match'))
+
+    def _parse_detection(self, m):
+        # misuse detection
+        pass
+
+
+    def _get_state(self):
+        """ Return the configurable state of the managed object in a form
+            that can be compared
+        """
+        match = None
+        if self.match is not None:
+            match = self.match.get_conf()
+        return {
+            'description': self.description,
+            'family': self.family,
+            'tags': set(self.tags),
+            'match': match
+            }
+
+
+    def get_commands(self, full=False):
+        """ Return the CLI commands that configure this managed object
+
+            For a managed object loaded from Peakflow only the commands for
+            attributes changed since it was loaded are returned, unless full
+            is set. New managed objects always get the full set of commands.
+            Raises ValueError if the description, family or match of a
+            loaded managed object was set to None, as there is no command
+            to unset them.
+        """
         # TODO: implement support for parents..
+        if full or self._loaded is None:
+            return self._get_full_commands()
+        return self._get_delta_commands(self._loaded)
+
+
+    def get_delta(self, current):
+        """ Return the CLI commands that turn the managed object current, as
+            loaded from Peakflow, into this one
+
+            Raises ValueError if current has a description, family or match
+            that this one lacks, see get_commands.
+        """
+        return self._get_delta_commands(current._get_state())
+
+
+    def _get_delta_commands(self, loaded):
+        cmds = []
+        state = self._get_state()
+        for attr in ('description', 'family', 'match'):
+            if state[attr] is None and loaded[attr] is not None:
+                raise ValueError("Unable to unset %s of managed object %s" % (attr, self.name))
+        for tag in sorted(state['tags'] - loaded['tags']):
+            cmds.append("services sp managed_objects edit \"%s\" tags add \"%s\"" % (self.name, tag))
+        for tag in sorted(loaded['tags'] - state['tags']):
+            cmds.append("services sp managed_objects edit \"%s\" tags delete \"%s\"" % (self.name, tag))
+        if state['description'] != loaded['description']:
+            cmds.append("services sp managed_objects edit \"%s\" description set \"%s\"" % (self.name, self.description))
+        if state['family'] != loaded['family']:
+            cmds.append("services sp managed_objects edit \"%s\" family set \"%s\"" % (self.name, self.family))
+        if state['match'] != loaded['match']:
+            cmds.append("services sp managed_objects edit \"%s\" match set %s" % (self.name, state['match']))
+        return cmds
+
+
+    def _get_full_commands(self):
         cmds = []
         cmds.append("services sp managed_objects add \"%s\"" % self.name)
         for tag in self.tags:
             cmds.append("services sp managed_objects edit \"%s\" tags add \"%s\"" % (self.name, tag))
-        cmds.append("services sp managed_objects edit \"%s\" description set \"%s\"" % (self.name, self.description))
-        cmds.append("services sp managed_objects edit \"%s\" family set \"%s\"" % (self.name, self.family))
-        cmds.append("services sp managed_objects edit \"%s\" match set %s" % (self.name, self.match.get_conf()))
-
-        pf = PeakflowSOAP(self.co)
-        for cmd in cmds:
-            res = pf.cliRun(cmd)
+        if self.description is not None:
+            cmds.append("services sp managed_objects edit \"%s\" description set \"%s\"" % (self.name, self.description))
+        if self.family is not None:
+            cmds.append("services sp managed_objects edit \"%s\" family set \"%s\"" % (self.name, self.family))
+        if self.match is not None:
+            cmds.append("services sp managed_objects edit \"%s\" match set %s" % (self.name, self.match.get_conf()))
+        return cmds
+
+
+    def save(self, batch=None, dry_run=False):
+        """ Save changes of the managed object to Peakflow
+
+            If a CliBatch is given the commands are only added to it and
+            sent when the batch is run, otherwise they are sent right away.
+            With dry_run the commands that would be sent are returned
+            without sending anything. Changes are not committed, and if a
+            command fails those sent before it are left uncommitted too.
+
+            What is saved is the managed object as it is when save is
+            called, later changes are left for the next save.
+        """
+        cmds = self.get_commands()
+        if dry_run:
+            return cmds
+
+        state = self._get_state()
+        if batch is not None:
+            batch.extend(cmds)
+            batch.add_callback(lambda: self._mark_saved(state))
+            return None
+
+        if not cmds:
+            return None
+        batch = CliBatch(self.co)
+        batch.extend(cmds)
+        res = batch.run(commit=False)[-1][1]
+        self._mark_saved(state)
         return res
-            
-            
+
+
+    def _mark_saved(self, state):
+        self._loaded = state
+
+
+#
+# Config line tokenizer
+#
+# Every line pertaining to a managed object is matched once against
+# _mo_line_re which splits it into verb, name and the remaining attribute
+# part. The attribute is then dispatched on its first keyword to a single
+# precompiled regexp, so that each line is only parsed once.
+#
+_mo_prefix = 'services sp managed_objects '
+_mo_line_re = re.compile('services sp managed_objects (add_with_parent|add|edit) "([^"]+)"(?: (.*))?')
+
+_attr_parsers = {
+    'description': (re.compile('description set "(?P<description>[^"]+)"'), '_parse_description'),
+    'family': (re.compile('family set (?P<family>[^ $]+)'), '_parse_family'),
+    'tags': (re.compile('tags add "(?P<tag>[^"]+)"'), '_parse_tag'),
+    'match': (re.compile('match set (?P<match>[^ ]+) (?P<value>.+)'), '_parse_match'),
+    'detection': (re.compile('detection misuse (?P<match>[^ ]+) (trigger|high_severity) set (?P<value>[0-9]+)'), '_parse_detection')
+}
+
+def _tokenize(line):
+    """ Split a managed object configuration line into its parts
+
+        Returns a tuple of (line, verb, name, attribute) or None if the line
+        does not pertain to a managed object. The name is stripped of any
+        parent prefix.
+    """
+    if not line.startswith(_mo_prefix):
+        return None
+    m = _mo_line_re.match(line)
+    if m is None:
+        return None
+    return (line, m.group(1), m.group(2).split('|')[-1], m.group(3))
+
+
+
+def _synthetic_config(num_lines):
+    """ Generate a synthetic configuration of roughly num_lines lines
+
+        Used for benchmarking the config parser. Every tenth line is
+        unrelated to managed objects, like in a real 'config show'.
+    """
+    lines = []
+    i = 0
+    while len(lines) < num_lines:
+        name = "customer-%d" % i
+        lines.append('services sp managed_objects add "%s"' % name)
+        lines.append('services sp managed_objects edit "%s" description set "Customer %d"' % (name, i))
+        lines.append('services sp managed_objects edit "%s" family set customer' % name)
+        lines.append('services sp managed_objects edit "%s" tags add "customer"' % name)
+        lines.append('services sp managed_objects edit "%s" tags add "tag-%d"' % (name, i % 100))
+        lines.append('services sp managed_objects edit "%s" match set cidr_blocks 10.%d.%d.0/24,192.0.2.0/24' % (name, (i >> 8) & 255, i & 255))
+        lines.append('services sp managed_objects edit "%s" detection misuse total trigger set 1000' % name)
+        lines.append('services sp managed_objects edit "%s" detection misuse total high_severity set 5000' % name)
+        lines.append('services sp managed_objects edit "%s" dos_profiled_network enable' % name)
+        lines.append('services sp routers edit "router-%d" snmp community set "public"' % i)
+        i += 1
+    return "\n".join(lines[:num_lines])
 
 
 
@@ -221,10 +419,21 @@ if __name__ == '__main__':
     parser.add_option("--list", action='store_true', help="list MOs")
     parser.add_option("--show", metavar='MO', help="Show detailed info on MO")
     parser.add_option("--new", action='store_true', help="test creation of new MO")
+    parser.add_option("--benchmark", metavar='LINES', type='int', help="benchmark config parser on a synthetic config of LINES lines")
     (options, args) = parser.parse_args()
 
     co = ConnectionOptions(options.host, options.username, options.password)
 
+    if options.benchmark:
+        import time
+        config = _synthetic_config(options.benchmark)
+        start = time.time()
+        mos = ManagedObject.from_conf(config)
+        elapsed = time.time() - start
+        print "Parsed %d lines (%d MOs) in %.3fs, %.3fs per 100k lines" % (
+                options.benchmark, len(mos), elapsed,
+                elapsed * 100000 / options.benchmark)
+
     if options.list:
         for mo in ManagedObject.from_peakflow(co):
             print mo.name
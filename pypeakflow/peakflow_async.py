@@ -0,0 +1,90 @@
+""" Non-blocking client for Arbor Peakflow SP
+
+    The SOAP libraries we build on are blocking, so calls are run on a pool of
+    worker threads, each using a pooled PeakflowSOAP client, and return a
+    Future right away. This lets one process keep many requests in flight
+    against the leader.
+"""
+
+import logging
+import sys
+
+from peakflow_soap import ConnectionOptions, get_pool, session
+from workers import ThreadPool
+
+class AsyncPeakflowSOAP:
+    """ Client for Arbor Peakflow SP whose calls return a Future
+
+        At most max_in_flight calls run at the same time, further calls are
+        queued.
+
+            pf = AsyncPeakflowSOAP(co)
+            futures = [pf.getDosAlertSummariesXML(i) for i in alert_ids]
+            for future in futures:
+                print future.result()
+    """
+
+    def __init__(self, con_opts, max_in_flight=32):
+        self.co = con_opts
+        get_pool(con_opts, max_in_flight)
+        self._pool = ThreadPool(max_in_flight)
+
+    def _call(self, method, *args, **kwargs):
+        with session(self.co) as pf:
+            return getattr(pf, method)(*args, **kwargs)
+
+    def _submit(self, method, *args, **kwargs):
+        return self._pool.submit(self._call, method, *args, **kwargs)
+
+    def cliRun(self, command):
+        return self._submit('cliRun', command)
+
+    def getTrafficGraph(self, query, graph_configuration):
+        return self._submit('getTrafficGraph', query, graph_configuration)
+
+    def runXmlQuery(self, query, output_format = 'xml'):
+        return self._submit('runXmlQuery', query, output_format)
+
+    def getDosAlertSummariesXML(self, filter, count = 1000):
+        return self._submit('getDosAlertSummariesXML', filter, count)
+
+    def getDosAlertDetailsXML(self, alert_id):
+        return self._submit('getDosAlertDetailsXML', alert_id)
+
+    def getMitigationSummariesXML(self, filter = '', max_count = 1000):
+        return self._submit('getMitigationSummariesXML', filter, max_count)
+
+    def close(self):
+        """ Stop the worker threads once queued calls have completed
+        """
+        self._pool.shutdown()
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="host for SOAP API connection, typically the leader")
+    parser.add_option("-U", "--username", help="username for SOAP API connection")
+    parser.add_option("-P", "--password", help="password for SOAP API connection")
+    parser.add_option("--cli-run", action="append", default=[], help="Run a command on the Peakflow system, may be given multiple times")
+    (options, args) = parser.parse_args()
+
+    if not options.host:
+        print >> sys.stderr, "Please specify a remote host for SOAP API connection."
+        sys.exit(1)
+
+    co = ConnectionOptions(options.host, options.username, options.password)
+    pf = AsyncPeakflowSOAP(co)
+
+    futures = [pf.cliRun(command) for command in options.cli_run]
+    for future in futures:
+        print future.result()
+    pf.close()
@@ -2,20 +2,72 @@
 """
 
 import logging
+import os
+import re
+import stat
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import peakflow_suds
 import peakflow_zsi
 
+# where parsed WSDL and other cached data is kept between processes
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'), 'pypeakflow')
+
+def check_cache_dir(path):
+    """ Return True if path is a directory that only we can write to,
+        creating it if needed
+
+        Cached data is unpickled or imported as code and holds secrets from
+        the configuration, so a directory that others could have planted
+        files in or can read is not used.
+    """
+    try:
+        if not os.path.lexists(path):
+            os.makedirs(path, 0700)
+        st = os.lstat(path)
+    except OSError, exc:
+        logging.warning("Unable to use cache directory %s: %s" % (path, exc))
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+        logging.warning("Not using cache directory %s, it must be a directory owned by us with mode 0700" % path)
+        return False
+    return True
+
+def _backend_cache_dir():
+    # SUDS unpickles and ZSI imports code from its cache, so only use a
+    # cache directory that passed the checks
+    if check_cache_dir(cache_dir):
+        return cache_dir
+    return None
+
+
 class ConnectionOptions:
     """ ConnectionOptions just carries some information like host to connect to,
         user, pass and so forth
     """
-    def __init__(self, host=None, username=None, password=None, port=None):
+    def __init__(self, host=None, username=None, password=None, port=None, timeout=None):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        # timeout of SOAP requests in seconds, None for the library default
+        self.timeout = timeout
+
+    def _key(self):
+        return (self.host, self.port, self.username, self.password, self.timeout)
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionOptions) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._key())
 
 
 class PeakflowSOAP:
@@ -25,11 +77,24 @@ class PeakflowSOAP:
 
     def __init__(self, con_opts):
 
-        self.suds = peakflow_suds.PeakflowSuds(con_opts)
-        self.zsi = peakflow_zsi.PeakflowZsi(con_opts)
+        self.co = con_opts
         self._timeout = 10
 
 
+    def __getattr__(self, name):
+        # The SUDS and ZSI backends each load the WSDL, so they are only
+        # built once first used. cliRun only uses ZSI while most other calls
+        # only use SUDS.
+        if name == 'suds':
+            logging.debug("Building SUDS backend for %s" % self.co.host)
+            self.suds = peakflow_suds.PeakflowSuds(self.co, _backend_cache_dir())
+            return self.suds
+        if name == 'zsi':
+            logging.debug("Building ZSI backend for %s" % self.co.host)
+            self.zsi = peakflow_zsi.PeakflowZsi(self.co, _backend_cache_dir())
+            return self.zsi
+        raise AttributeError(name)
+
 
     def cliRun(self, command):
         """ Run a command
@@ -38,7 +103,21 @@ class PeakflowSOAP:
 
 
     def commit(self, comment=None):
-        return self.zsi.cliRun(command = 'config write')
+        res = self.zsi.cliRun(command = 'config write')
+        # imported here as config itself builds on PeakflowSOAP
+        from config import config_cache
+        config_cache.invalidate(self.co.host)
+        return res
+
+
+    def revert(self):
+        """ Throw away all uncommitted configuration changes, not only our
+            own
+        """
+        res = self.zsi.cliRun(command = 'config revert')
+        from config import config_cache
+        config_cache.invalidate(self.co.host)
+        return res
 
 
     def getTrafficGraph(self, query, graph_configuration):
@@ -48,14 +127,17 @@ class PeakflowSOAP:
     def runXmlQuery(self, query, output_format = 'xml'):
         return self.suds.runXmlQuery(query = query, output_format = output_format)
 
-    def getDosAlertSummariesXML(self, alert_id):
-        return self.suds.getDosAlertSummariesXML(alert_id)
+    def getDosAlertSummariesXML(self, filter, count = 1000):
+        """ Return up to count alerts matching a search filter, same as the
+            search box in the UI, eg an alert ID
+        """
+        return self.suds.getDosAlertSummariesXML(filter = filter, count = count)
 
     def getDosAlertDetailsXML(self, alert_id):
         return self.suds.getDosAlertDetailsXML(alert_id)
 
     def getDosAlertGraph(self, alert_id, width, height):
-        return self.suds.getDosAlertGraph(alertID = alert_id, width = width, height = height)
+        return self.suds.getDosAlertGraph(alert_id = alert_id, width = width, height = height)
 
     def getMitigationSummariesXML(self, filter = '', max_count = 1000):
         return self.suds.getMitigationSummariesXML(filter = filter, max_count = max_count)
@@ -64,6 +146,270 @@ class PeakflowSOAP:
 
 
 
+class ConnectionPool:
+    """ Pool of PeakflowSOAP clients for one set of ConnectionOptions
+
+        Building a PeakflowSOAP client means parsing the WSDL and setting up
+        transports, so clients are kept around and handed out again instead
+        of being built per call. At most size clients are created, callers
+        beyond that wait for a client to be released. Clients that have been
+        idle for longer than check_interval seconds are health checked
+        before being handed out and replaced if the check fails.
+    """
+
+    health_check_command = 'system version'
+
+    def __init__(self, con_opts, size=4, check_interval=300):
+        self.co = con_opts
+        self.size = size
+        self.check_interval = check_interval
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """ Get a client from the pool, creating one if needed
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self._cond.acquire()
+        try:
+            while not self._idle and self._created >= self.size:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("Timed out waiting for a connection to %s" % self.co.host)
+                    self._cond.wait(remaining)
+            if self._idle:
+                pf, last_used = self._idle.pop()
+            else:
+                pf, last_used = None, None
+                self._created += 1
+        finally:
+            self._cond.release()
+
+        try:
+            if pf is not None and time.time() - last_used > self.check_interval:
+                if not self._check(pf):
+                    pf = None
+            if pf is None:
+                pf = PeakflowSOAP(self.co)
+        except:
+            self._discard()
+            raise
+        return pf
+
+    def release(self, pf, broken=False):
+        """ Return a client to the pool
+
+            A broken client, ie one whose last call failed, is thrown away.
+        """
+        if broken:
+            self._discard()
+            return
+        self._cond.acquire()
+        try:
+            self._idle.append((pf, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def grow(self, size):
+        """ Allow the pool to hold at least size clients
+        """
+        self._cond.acquire()
+        try:
+            if size > self.size:
+                self.size = size
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    @contextmanager
+    def session(self, timeout=None):
+        """ Context manager that holds a client from the pool
+        """
+        pf = self.acquire(timeout)
+        try:
+            yield pf
+        except:
+            self.release(pf, broken=True)
+            raise
+        self.release(pf)
+
+    def _check(self, pf):
+        # only check backends already built, building one just for the check
+        # would load its WSDL on clients that may never use it
+        try:
+            if 'zsi' in pf.__dict__:
+                pf.zsi.cliRun(self.health_check_command)
+            elif 'suds' in pf.__dict__:
+                pf.suds.cliRun(self.health_check_command)
+        except Exception, exc:
+            logging.info("Dropping connection to %s failing health check: %s" % (self.co.host, exc))
+            return False
+        return True
+
+    def _discard(self):
+        self._cond.acquire()
+        try:
+            self._created -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+
+
+class CommandError(Exception):
+    """ A CLI command run through a CliBatch failed
+
+        results holds the (command, result) pairs of the commands run up to
+        and including the failing one.
+    """
+    def __init__(self, command, result, results):
+        Exception.__init__(self, "Command '%s' failed: %s" % (command, _cli_output(result)))
+        self.command = command
+        self.result = result
+        self.results = results
+
+
+class CliBatch:
+    """ Collect CLI commands, possibly from many objects, and run them
+        together
+
+        By default a batch still makes one cliRun call per command: what it
+        saves is the 'config write' after every object, as the batch ends
+        with a single one, and setting up a connection per object. Sending
+        several commands per call, commands_per_call of them joined by
+        newlines, has not been verified against the CLI, which may only
+        report the result of the last command of a call. Running stops at
+        the first failing command.
+
+        The CLI has no transactions: commands run before a failing one stay
+        in the candidate configuration, where the next 'config write' of
+        anyone would commit them. See run() for reverting them.
+    """
+
+    # output of the Peakflow CLI when a command fails
+    error_re = re.compile('^\s*(%? *error|invalid|unknown command)', re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, con_opts, commands_per_call=1):
+        self.co = con_opts
+        self.commands_per_call = commands_per_call
+        self.commands = []
+        self.callbacks = []
+
+    def add(self, command):
+        self.commands.append(command)
+
+    def extend(self, commands):
+        self.commands.extend(commands)
+
+    def add_callback(self, callback):
+        """ Add a function to call once the batch has run successfully
+        """
+        self.callbacks.append(callback)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def run(self, commit=True, revert=False):
+        """ Run the collected commands and return a list of (command, result)
+
+            Raises CommandError on the first failing command, in which case
+            nothing is committed and the commands run so far are left in
+            the candidate configuration. With revert set, 'config revert' is
+            run instead, which throws away all uncommitted changes on the
+            system, including pending changes of other users and sessions.
+        """
+        results = []
+        if not self.commands:
+            self._run_callbacks()
+            return results
+
+        try:
+            with session(self.co) as pf:
+                try:
+                    for i in range(0, len(self.commands), self.commands_per_call):
+                        command = "\n".join(self.commands[i:i + self.commands_per_call])
+                        res = pf.cliRun(command)
+                        results.append((command, res))
+                        if self.is_error(res):
+                            raise CommandError(command, res, results)
+                except:
+                    exc_info = sys.exc_info()
+                    if revert and results:
+                        try:
+                            pf.revert()
+                        except Exception, exc:
+                            logging.error("Unable to revert failed batch on %s: %s" % (self.co.host, exc))
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if commit:
+                    pf.commit()
+        finally:
+            # imported here as config itself builds on PeakflowSOAP
+            from config import config_cache
+            config_cache.invalidate(self.co.host)
+
+        self.commands = []
+        self._run_callbacks()
+        return results
+
+    def _run_callbacks(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def is_error(self, result):
+        output = _cli_output(result)
+        return output is not None and self.error_re.search(str(output)) is not None
+
+
+def _cli_output(result):
+    """ Return the output text of a cliRun result
+    """
+    try:
+        return result['results']
+    except (KeyError, TypeError):
+        return result
+
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(con_opts, size=None):
+    """ Return the connection pool for con_opts, creating it if needed
+
+        If size is given the pool is grown to hold at least that many
+        clients.
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(con_opts)
+        if pool is None:
+            pool = ConnectionPool(con_opts)
+            _pools[con_opts] = pool
+    finally:
+        _pools_lock.release()
+    if size is not None:
+        pool.grow(size)
+    return pool
+
+def session(con_opts, timeout=None):
+    """ Context manager that holds a pooled client for con_opts
+
+            with session(co) as pf:
+                pf.cliRun("system version")
+    """
+    return get_pool(con_opts).session(timeout)
+
+
 
 if __name__ == '__main__':
     logger = logging.getLogger()
@@ -9,6 +9,7 @@ import urllib2
 
 from lxml import objectify
 
+from suds.cache import ObjectCache
 from suds.client import Client
 from suds.transport.https import HttpAuthenticated
 
@@ -17,7 +18,7 @@ class PeakflowSuds:
     """ Client library for talking to Arbor Peakflow SP via SOAP
     """
 
-    def __init__(self, con_opts):
+    def __init__(self, con_opts, cache_dir=None):
         wsdl_url = 'file://%s/PeakflowSP.wsdl' % os.path.dirname(__file__)
         soap_url = 'https://%s/soap/sp' % con_opts.host
 
@@ -25,7 +26,16 @@ class PeakflowSuds:
         t = HttpAuthenticated(username=con_opts.username, password=con_opts.password)
         t.handler = urllib2.HTTPDigestAuthHandler(t.pm)
         t.urlopener = urllib2.build_opener(t.handler)
-        self.client = Client(url = wsdl_url, location = soap_url, transport = t)
+        if con_opts.timeout is not None:
+            t.options.timeout = con_opts.timeout
+        if cache_dir is None:
+            self.client = Client(url = wsdl_url, location = soap_url, transport = t)
+        else:
+            # cache the parsed WSDL as a pickled object rather than the
+            # WSDL document so later processes skip parsing it entirely
+            cache = ObjectCache(location = os.path.join(cache_dir, 'suds'), days = 30)
+            self.client = Client(url = wsdl_url, location = soap_url,
+                    transport = t, cache = cache, cachingpolicy = 1)
 
         self._timeout = 10
 
@@ -40,24 +50,23 @@ class PeakflowSuds:
 
 
     def getTrafficGraph(self, query, graph_configuration):
-        return self.soap.getTrafficGraph(query = query, graph_configuration = graph_configuration)
+        return self.client.service.getTrafficGraph(query = query, graph_configuration = graph_configuration)
 
 
     def runXmlQuery(self, query, output_format = 'xml'):
-        return self.soap.runXmlQuery(query = query, output_format = output_format)
+        return self.client.service.runXmlQuery(query = query, output_format = output_format)
 
-    def getDosAlertSummariesXML(self, alert_id):
-        print "AlertID:", alert_id
-        return self.client.service.getDosAlertSummariesXML(alertID = alert_id)
+    def getDosAlertSummariesXML(self, filter, count = 1000):
+        return self.client.service.getDosAlertSummariesXML(filter = filter, count = count)
 
     def getDosAlertDetailsXML(self, alert_id):
-        return self.soap.getDosAlertDetailsXML(alertID = alert_id)
+        return self.client.service.getDosAlertDetailsXML(alertId = alert_id)
 
     def getDosAlertGraph(self, alert_id, width, height):
-        return self.soap.getDosAlertGraph(alertID = alert_id, width = width, height = height)
+        return self.client.service.getDosAlertGraph(alertId = alert_id, width = width, height = height)
 
     def getMitigationSummariesXML(self, filter = '', max_count = 1000):
-        return self.soap.getMitigationSummariesXML(filter = filter, max_count = max_count)
+        return self.client.service.getMitigationSummariesXML(filter = filter, max_count = max_count)
 
 
 
@@ -47,13 +47,19 @@ class PeakflowZsi:
     """ Client library for talking to Arbor Peakflow SP using ZSI
     """
 
-    def __init__(self, con_opts):
+    def __init__(self, con_opts, cache_dir=None):
 
         wsdl_url = 'file://%s/PeakflowSP.wsdl' % os.path.dirname(__file__)
         soap_url = 'https://%s/soap/sp' % con_opts.host
 
         cred = (AUTH.httpdigest, con_opts.username, con_opts.password)
-        self.soap = ServiceProxy(wsdl = wsdl_url, url = soap_url, auth = cred)
+        if cache_dir is None:
+            self.soap = ServiceProxy(wsdl = wsdl_url, url = soap_url, auth = cred)
+        else:
+            # keep the typecode modules ZSI generates from the WSDL with our
+            # other cached data so they are reused by later processes
+            self.soap = ServiceProxy(wsdl = wsdl_url, url = soap_url, auth = cred,
+                    cachedir = os.path.join(cache_dir, 'zsi'))
         self._timeout = 10
 
 
@@ -73,10 +79,10 @@ class PeakflowZsi:
         return self.soap.runXmlQuery(query = query, output_format = output_format)
 
     def getDosAlertDetailsXML(self, alert_id):
-        return self.soap.getDosAlertDetailsXML(alertID = alert_id)
+        return self.soap.getDosAlertDetailsXML(alertId = alert_id)
 
     def getDosAlertGraph(self, alert_id, width, height):
-        return self.soap.getDosAlertGraph(alertID = alert_id, width = width, height = height)
+        return self.soap.getDosAlertGraph(alertId = alert_id, width = width, height = height)
 
     def getMitigationSummariesXML(self, filter = '', max_count = 1000):
         return self.soap.getMitigationSummariesXML(filter = filter, max_count = max_count)
@@ -0,0 +1,344 @@
+""" Longest prefix match of IP addresses to managed objects
+"""
+
+import binascii
+import logging
+import socket
+import sys
+import time
+
+import numpy
+
+from mo import ManagedObject, MoMatchCidrBlocks, MoMatchCidrV6Blocks
+
+_families = {
+    4: (socket.AF_INET, 32),
+    6: (socket.AF_INET6, 128)
+    }
+
+def parse_address(address):
+    """ Return an IPv4 or IPv6 address as a tuple of (version, integer)
+    """
+    version = 6 if ':' in address else 4
+    try:
+        packed = socket.inet_pton(_families[version][0], address.strip())
+    except socket.error:
+        raise ValueError("Invalid IP address: %s" % address)
+    return version, int(binascii.hexlify(packed), 16)
+
+
+def parse_prefix(prefix):
+    """ Return a prefix like "192.0.2.0/24" as a tuple of (version, network,
+        length)
+
+        Host bits are cleared and an address without length is a host
+        prefix.
+    """
+    address, sep, length = prefix.partition('/')
+    version, network = parse_address(address)
+    bits = _families[version][1]
+    if sep:
+        if not length.isdigit() or int(length) > bits:
+            raise ValueError("Invalid prefix length: %s" % prefix)
+        length = int(length)
+    else:
+        length = bits
+    return version, network & _mask(version, length), length
+
+
+def format_prefix(version, network, length):
+    """ Return the string form of a parsed prefix
+    """
+    family, bits = _families[version]
+    packed = binascii.unhexlify("%0*x" % (bits / 4, network))
+    return "%s/%d" % (socket.inet_ntop(family, packed), length)
+
+
+def prefix_contains(outer, inner):
+    """ Return True if parsed prefix inner lies within parsed prefix outer
+    """
+    return (outer[0] == inner[0] and outer[2] <= inner[2] and
+            inner[1] & _mask(inner[0], outer[2]) == outer[1])
+
+
+def _mask(version, length):
+    bits = _families[version][1]
+    return ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+
+
+def mo_prefixes(mo):
+    """ Yield the parsed prefixes, as (version, network, length), that
+        managed object mo matches on
+    """
+    if not isinstance(mo.match, (MoMatchCidrBlocks, MoMatchCidrV6Blocks)):
+        return
+    for prefix in mo.match.prefix:
+        try:
+            yield parse_prefix(prefix)
+        except ValueError, exc:
+            logging.warning("Managed object %s: %s" % (mo.name, exc))
+
+
+
+class PrefixIndex:
+    """ Longest prefix match index over the CIDR blocks of managed objects
+
+        Prefixes are kept in one hash table per version and prefix length,
+        so a lookup is one dict lookup per distinct prefix length in use,
+        longest first. Managed objects can be added, updated and removed
+        one at a time.
+
+            index = PrefixIndex.from_mos(ManagedObject.from_peakflow(co))
+            mo = index.lookup("192.0.2.1")
+    """
+
+    def __init__(self):
+        # version -> length -> network -> list of managed objects
+        self._tables = {4: {}, 6: {}}
+        # version -> prefix lengths in use, longest first
+        self._lengths = {4: [], 6: []}
+        # managed object name -> parsed prefixes
+        self._prefixes = {}
+        # sorted networks and owners per length for lookup_many(), built
+        # on demand
+        self._arrays = None
+
+    @classmethod
+    def from_mos(cls, mos):
+        index = PrefixIndex()
+        for mo in mos:
+            index.add(mo)
+        return index
+
+    def add(self, mo):
+        """ Index the prefixes of managed object mo, replacing any managed
+            object of the same name
+        """
+        if mo.name in self._prefixes:
+            self.remove(mo.name)
+        prefixes = list(mo_prefixes(mo))
+        self._prefixes[mo.name] = prefixes
+        for version, network, length in prefixes:
+            table = self._tables[version].get(length)
+            if table is None:
+                table = self._tables[version][length] = {}
+                self._lengths[version] = sorted(self._tables[version], reverse=True)
+            table.setdefault(network, []).append(mo)
+        self._arrays = None
+
+    update = add
+
+    def remove(self, name):
+        """ Remove the managed object called name from the index
+        """
+        prefixes = self._prefixes.pop(name, None)
+        if prefixes is None:
+            raise KeyError(name)
+        for version, network, length in prefixes:
+            table = self._tables[version][length]
+            owners = [mo for mo in table[network] if mo.name != name]
+            if owners:
+                table[network] = owners
+                continue
+            del table[network]
+            if not table:
+                del self._tables[version][length]
+                self._lengths[version] = sorted(self._tables[version], reverse=True)
+        self._arrays = None
+
+    def match(self, address):
+        """ Return the longest prefix matching address as a tuple of
+            (prefix, managed object) or None
+
+            If several managed objects have the same prefix, the one added
+            first is returned.
+        """
+        version, value = parse_address(address)
+        tables = self._tables[version]
+        for length in self._lengths[version]:
+            network = value & _mask(version, length)
+            owners = tables[length].get(network)
+            if owners is not None:
+                return format_prefix(version, network, length), owners[0]
+        return None
+
+    def lookup(self, address):
+        """ Return the managed object owning address or None
+        """
+        version, value = parse_address(address)
+        tables = self._tables[version]
+        for length in self._lengths[version]:
+            owners = tables[length].get(value & _mask(version, length))
+            if owners is not None:
+                return owners[0]
+        return None
+
+    def lookup_many(self, addresses):
+        """ Return the managed object owning each of addresses, or None,
+            as a list
+
+            IPv4 addresses are matched with NumPy a prefix length at a time,
+            IPv6 addresses one by one.
+        """
+        res = [None] * len(addresses)
+        v4_pos = []
+        v4_values = []
+        for i, address in enumerate(addresses):
+            if ':' in address:
+                res[i] = self.lookup(address)
+            else:
+                v4_pos.append(i)
+                v4_values.append(parse_address(address)[1])
+        if not v4_pos:
+            return res
+
+        if self._arrays is None:
+            self._arrays = self._build_arrays(4)
+        values = numpy.array(v4_values, dtype=numpy.uint64)
+        pos = numpy.array(v4_pos)
+        for length, networks, owners in self._arrays:
+            if not len(values):
+                break
+            masked = values & numpy.uint64(_mask(4, length))
+            idx = numpy.searchsorted(networks, masked)
+            idx[idx == len(networks)] = 0
+            found = networks[idx] == masked
+            for i, j in zip(pos[found], idx[found]):
+                res[i] = owners[j]
+            values = values[~found]
+            pos = pos[~found]
+        return res
+
+    def _build_arrays(self, version):
+        arrays = []
+        for length in self._lengths[version]:
+            table = self._tables[version][length]
+            networks = sorted(table)
+            arrays.append((length, numpy.array(networks, dtype=numpy.uint64),
+                [table[network][0] for network in networks]))
+        return arrays
+
+    def __len__(self):
+        return sum([len(prefixes) for prefixes in self._prefixes.values()])
+
+    def __contains__(self, name):
+        return name in self._prefixes
+
+
+
+def find_overlaps(mos):
+    """ Find overlapping CIDR blocks across managed objects
+
+        Returns a dict of:
+            duplicates: (prefix, [names]) for prefixes of more than one
+                managed object, or given twice by one
+            overlaps: (prefix, name, more specific prefix, name) for every
+                prefix within a prefix of another managed object
+            shadowed: (prefix, [names]) for prefixes completely covered by
+                more specific prefixes, which thus never match
+
+        Prefixes are swept in address order keeping a stack of the
+        prefixes enclosing the current one. CIDR blocks either nest or are
+        disjoint and the stack is at most 129 deep, so this takes
+        O(n log n) time for n prefixes.
+    """
+    owners = {}
+    for mo in mos:
+        for prefix in mo_prefixes(mo):
+            owners.setdefault(prefix, []).append(mo.name)
+
+    res = {
+        'duplicates': [],
+        'overlaps': [],
+        'shadowed': []
+        }
+    for prefix, names in owners.iteritems():
+        if len(names) > 1:
+            res['duplicates'].append((format_prefix(*prefix), sorted(names)))
+    res['duplicates'].sort()
+
+    def close(node):
+        prefix, end, size, covered, names = node
+        if covered[0] == size:
+            res['shadowed'].append((format_prefix(*prefix), sorted(set(names))))
+
+    # stack of (prefix, last address, size, [addresses covered by more
+    # specifics], names)
+    stack = []
+    for prefix in sorted(owners, key=lambda p: (p[0], p[1], p[2])):
+        version, network, length = prefix
+        size = 1 << (_families[version][1] - length)
+        end = network + size - 1
+        while stack and (stack[-1][0][0] != version or stack[-1][1] < network):
+            close(stack.pop())
+        names = owners[prefix]
+        if stack:
+            stack[-1][3][0] += size
+        for outer in stack:
+            for outer_name in set(outer[4]):
+                for name in set(names):
+                    if name != outer_name:
+                        res['overlaps'].append((format_prefix(*outer[0]),
+                            outer_name, format_prefix(*prefix), name))
+        stack.append((prefix, end, size, [0], names))
+    while stack:
+        close(stack.pop())
+    res['shadowed'].sort()
+    return res
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser(usage="%prog [options] ADDRESS...")
+    parser.add_option("--config", metavar="FILE", help="read managed objects from 'config show' output in FILE")
+    parser.add_option("--check", action="store_true", help="report duplicate, overlapping and shadowed prefixes")
+    parser.add_option("--benchmark", metavar="LOOKUPS", type="int", help="time LOOKUPS random IPv4 lookups")
+    (options, args) = parser.parse_args()
+
+    if not options.config:
+        print >> sys.stderr, "Please specify a config file."
+        sys.exit(1)
+
+    f = open(options.config)
+    start = time.time()
+    mos = ManagedObject.from_conf(f.read())
+    index = PrefixIndex.from_mos(mos)
+    f.close()
+    print "Indexed %d prefixes in %.3fs" % (len(index), time.time() - start)
+
+    if options.check:
+        start = time.time()
+        res = find_overlaps(mos)
+        elapsed = time.time() - start
+        for prefix, names in res['duplicates']:
+            print "Duplicate %s in %s" % (prefix, ", ".join(names))
+        for outer, outer_name, inner, inner_name in res['overlaps']:
+            print "Overlap %s (%s) contains %s (%s)" % (outer, outer_name, inner, inner_name)
+        for prefix, names in res['shadowed']:
+            print "Shadowed %s in %s" % (prefix, ", ".join(names))
+        print "Checked %d prefixes in %.3fs" % (len(index), elapsed)
+
+    for address in args:
+        print "%-40s %s" % (address, index.match(address))
+
+    if options.benchmark:
+        import random
+        addresses = [socket.inet_ntoa(binascii.unhexlify("%08x" % random.getrandbits(32)))
+                for i in xrange(options.benchmark)]
+        start = time.time()
+        for address in addresses:
+            index.lookup(address)
+        elapsed = time.time() - start
+        print "lookup: %.2fus per address" % (elapsed * 1e6 / options.benchmark)
+        start = time.time()
+        index.lookup_many(addresses)
+        elapsed = time.time() - start
+        print "lookup_many: %.2fus per address" % (elapsed * 1e6 / options.benchmark)
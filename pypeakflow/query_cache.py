@@ -0,0 +1,198 @@
+""" Cache of traffic query results
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from lxml import etree
+
+from traffic import TrafficResult, parse_time
+
+class QueryCache:
+    """ LRU cache of runXmlQuery and getTrafficGraph results with a TTL
+
+        Results are keyed on the host queried and a normalised form of the
+        query XML: whitespace and attribute order do not matter, and time
+        windows, whether relative like "24 hours ago" to "now" or absolute,
+        are snapped to bucket seconds. Identical queries within the same
+        bucket thus share one result. At most max_entries results are kept,
+        each for at most ttl seconds.
+    """
+
+    def __init__(self, ttl = 60, max_entries = 1000, bucket = 60):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bucket = bucket
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalise(self, query, now = None):
+        """ Return the normalised form of query used as cache key
+        """
+        if now is None:
+            now = time.time()
+        parser = etree.XMLParser(remove_blank_text = True, remove_comments = True)
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        root = etree.fromstring(query.strip(), parser)
+        for el in root.iter():
+            if el.text is not None:
+                el.text = el.text.strip()
+            el.tail = None
+            if el.tag == 'time':
+                self._snap_time(el, now)
+            # attributes in sorted order
+            attrib = sorted(el.attrib.items())
+            el.attrib.clear()
+            for key, value in attrib:
+                el.set(key, value)
+        return etree.tostring(root)
+
+    def _snap_time(self, el, now):
+        for relative, absolute in (('start_ascii', 'start'), ('end_ascii', 'end')):
+            value = el.get(relative)
+            if value is not None:
+                epoch = parse_time(value, now)
+                if epoch is not None:
+                    del el.attrib[relative]
+                    el.set(absolute, str(epoch))
+            value = el.get(absolute)
+            if value is not None and value.isdigit():
+                el.set(absolute, str(int(value) // self.bucket * self.bucket))
+
+    def get(self, key):
+        """ Return the cached result for key or None
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            # move to most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def runXmlQuery(self, pf, query, output_format = 'xml'):
+        """ Run query through PeakflowSOAP pf unless its result is cached
+        """
+        key = "runXmlQuery\0%s\0%s\0%s" % (self._host(pf), output_format, self.normalise(query))
+        res = self.get(key)
+        if res is None:
+            res = pf.runXmlQuery(query, output_format)
+            self.put(key, res)
+        return res
+
+    def _host(self, pf):
+        # results of different leaders must never be mixed up
+        return "%s:%s" % (pf.co.host, pf.co.port)
+
+    def getTrafficGraph(self, pf, query, graph_configuration):
+        """ Get a traffic graph through PeakflowSOAP pf unless it is cached
+        """
+        key = "getTrafficGraph\0%s\0%s\0%s" % (self._host(pf), self.normalise(query),
+                self.normalise(graph_configuration))
+        res = self.get(key)
+        if res is None:
+            res = pf.getTrafficGraph(query, graph_configuration)
+            self.put(key, res)
+        return res
+
+
+
+class SeriesCache:
+    """ Rolling window of traffic series per managed object and filter
+
+        The first get() for a (mo_type, mo_id, filter) fetches the whole
+        window through report, a Report. Later calls only fetch the
+        interval since the last bucket already fetched, which is fetched
+        again as it may have been incomplete, and drop the buckets that
+        fell out of the window. The cost of a refresh thus depends on the
+        time since the last one rather than on the window length.
+    """
+
+    def __init__(self, report, window = 86400):
+        self.report = report
+        self.window = window
+        self.queried_seconds = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, mo_type, mo_id, filter2 = None, filter2_binby = 1, now = None):
+        """ Return the TrafficResult for the last window seconds
+        """
+        if now is None:
+            now = time.time()
+        now = int(now)
+        key = (mo_type, mo_id, filter2, filter2_binby)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+        finally:
+            self._lock.release()
+
+        window_start = now - self.window
+        if entry is None or entry[1] < window_start:
+            cached = TrafficResult.empty()
+            start = window_start
+        else:
+            cached, start = entry
+
+        query = self.report.get_query(mo_type, mo_id, filter2, filter2_binby)
+        query.start = start
+        query.end = now
+        self.queried_seconds += now - start
+        fetched = TrafficResult.from_xml(self.report.run_query(query))
+
+        # fresh samples replace the possibly incomplete ones already cached
+        res = TrafficResult.merge([fetched, cached]).since(window_start)
+        if len(res):
+            fetched_until = int(res.timestamps[-1])
+        else:
+            fetched_until = start
+        self._lock.acquire()
+        try:
+            self._entries[key] = (res, fetched_until)
+        finally:
+            self._lock.release()
+        return res
+
+    def invalidate(self, mo_type = None, mo_id = None):
+        """ Drop the cached series of a managed object, or all of them
+        """
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                if mo_type is None or key[:2] == (mo_type, mo_id):
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
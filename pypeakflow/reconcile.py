@@ -0,0 +1,306 @@
+""" Reconcile managed objects on Peakflow with a desired inventory
+"""
+
+import logging
+import sys
+import time
+
+from peakflow_soap import ConnectionOptions, CliBatch, CommandError, session
+from config import PeakflowConfig
+from mo import ManagedObject
+from workers import run_parallel
+
+class Plan:
+    """ The changes needed to turn the current managed objects into the
+        desired ones
+
+        creates and updates are lists of (name, commands) while deletes is a
+        list of names. errors holds (name, exception) for managed objects
+        that can't be changed to match, like one whose description would
+        have to be unset. undo maps the name of every managed object to
+        change to the commands that undo the change, if there are any.
+    """
+
+    def __init__(self):
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+        self.errors = []
+        self.undo = {}
+        self.unchanged = 0
+        # managed objects missing from desired that are left alone
+        self.kept = 0
+        self.elapsed = None
+
+    def get_changes(self):
+        """ Return a (name, commands) tuple for every managed object to
+            change
+        """
+        changes = self.creates + self.updates
+        for name in self.deletes:
+            changes.append((name, ["services sp managed_objects delete \"%s\"" % name]))
+        return changes
+
+    def get_commands(self):
+        """ Return the commands of the plan grouped per managed object
+        """
+        return [cmds for name, cmds in self.get_changes()]
+
+    def __len__(self):
+        return len(self.creates) + len(self.updates) + len(self.deletes)
+
+    def __str__(self):
+        r = ""
+        for name, cmds in self.creates:
+            r += "+ %s\n" % name
+        for name, cmds in self.updates:
+            r += "~ %s\n" % name
+            for cmd in cmds:
+                r += "    %s\n" % cmd
+        for name in self.deletes:
+            r += "- %s\n" % name
+        for name, exc in self.errors:
+            r += "! %s: %s\n" % (name, exc)
+        r += "%d to create, %d to update, %d to delete, %d unchanged, %d not in desired kept\n" % (
+                len(self.creates), len(self.updates), len(self.deletes),
+                self.unchanged, self.kept)
+        return r
+
+
+
+class Reconciler:
+    """ Compute and apply the changes needed to make the managed objects on
+        Peakflow mirror a desired set of managed objects
+
+        Managed objects are matched on name through a dict so planning is
+        linear in the number of objects. Managed objects missing from the
+        desired set are only deleted if scope is given and scope(mo)
+        returns true for them, or if delete_unlisted is set, so that a
+        partial inventory doesn't wipe the rest of the configuration.
+
+        The changes are applied in batches of batch_size managed objects,
+        with at most max_workers batches in flight, and committed once all
+        batches have run successfully.
+    """
+
+    def __init__(self, co, batch_size=50, max_workers=4, scope=None, delete_unlisted=False):
+        self.co = co
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.scope = scope
+        self.delete_unlisted = delete_unlisted
+
+    def plan(self, desired, current):
+        """ Return a Plan for turning current into desired
+
+            desired is a list of new ManagedObject while current is a list of
+            ManagedObject as read from Peakflow, eg by
+            ManagedObject.from_conf.
+        """
+        start = time.time()
+        plan = Plan()
+        current_by_name = {}
+        for mo in current:
+            current_by_name[mo.name] = mo
+
+        desired_names = set()
+        for mo in desired:
+            desired_names.add(mo.name)
+            cur = current_by_name.get(mo.name)
+            if cur is None:
+                plan.creates.append((mo.name, mo.get_commands(full=True)))
+                plan.undo[mo.name] = ["services sp managed_objects delete \"%s\"" % mo.name]
+                continue
+            try:
+                cmds = mo.get_delta(cur)
+            except ValueError, exc:
+                plan.errors.append((mo.name, exc))
+                continue
+            if cmds:
+                plan.updates.append((mo.name, cmds))
+                try:
+                    plan.undo[mo.name] = cur.get_delta(mo)
+                except ValueError:
+                    # the update sets something that can't be unset again
+                    pass
+            else:
+                plan.unchanged += 1
+
+        for name in current_by_name:
+            if name in desired_names:
+                continue
+            cur = current_by_name[name]
+            if self.scope is not None:
+                delete = self.scope(cur)
+            else:
+                delete = self.delete_unlisted
+            if not delete:
+                plan.kept += 1
+                continue
+            plan.deletes.append(name)
+            # the configuration lines as read from Peakflow recreate all of
+            # the managed object, not only what ManagedObject models
+            plan.undo[name] = cur.config_lines or cur.get_commands(full=True)
+
+        plan.elapsed = time.time() - start
+        return plan
+
+    def apply(self, plan, commit=True):
+        """ Apply a Plan and return statistics about the run
+
+            Batches run in parallel without committing. If any batch fails
+            nothing is committed and the failures are returned in the
+            'errors' of the statistics. When committing, the managed objects
+            changed by the batches that did run are then restored one by one
+            with the undo commands of the plan, so that a later 'config
+            write' doesn't commit them. Uncommitted changes of others are
+            left alone.
+        """
+        start = time.time()
+        jobs = []
+        changes = plan.get_changes()
+        for i in range(0, len(changes), self.batch_size):
+            jobs.append(changes[i:i + self.batch_size])
+
+        stats = {
+            'batches': len(jobs),
+            'commands': 0,
+            'errors': [],
+            'committed': False,
+            'undone': 0,
+            'undo_errors': [],
+            'plan_time': plan.elapsed
+            }
+        changed = []
+        for job, results, exc_info in run_parallel(self._run_batch, jobs, self.max_workers):
+            if exc_info is not None:
+                logging.error("Batch failed: %s" % exc_info[1])
+                stats['errors'].append(exc_info[1])
+                changed.extend(_changed(job, exc_info[1]))
+                continue
+            stats['commands'] += len(results)
+            changed.extend([name for name, cmds in job])
+
+        if commit and stats['errors']:
+            self._undo(plan, changed, stats)
+        elif commit and jobs:
+            with session(self.co) as pf:
+                pf.commit()
+            stats['committed'] = True
+
+        stats['apply_time'] = time.time() - start
+        stats['commands_per_second'] = None
+        if stats['apply_time'] > 0:
+            stats['commands_per_second'] = stats['commands'] / stats['apply_time']
+        return stats
+
+    def reconcile(self, desired, current=None, dry_run=False):
+        """ Plan and apply the changes to make Peakflow mirror desired
+
+            The current managed objects are read from Peakflow unless given,
+            bypassing the configuration cache as deltas against a stale
+            snapshot would miss changes.
+            Returns a tuple of the plan and the statistics of applying it,
+            which are None for a dry run.
+        """
+        if current is None:
+            current = ManagedObject.from_peakflow(self.co, PeakflowConfig.from_peakflow(self.co))
+        plan = self.plan(desired, current)
+        if dry_run:
+            return plan, None
+        return plan, self.apply(plan)
+
+    def _run_batch(self, changes):
+        batch = CliBatch(self.co)
+        for name, cmds in changes:
+            batch.extend(cmds)
+        return batch.run(commit=False)
+
+    def _undo(self, plan, names, stats):
+        # a failing undo of one managed object doesn't stop the others
+        jobs = []
+        for name in names:
+            if name not in plan.undo:
+                logging.error("Unable to undo changes of managed object %s" % name)
+                stats['undo_errors'].append((name, None))
+                continue
+            jobs.append([(name, plan.undo[name])])
+        for job, results, exc_info in run_parallel(self._run_batch, jobs, self.max_workers):
+            name = job[0][0]
+            if exc_info is not None:
+                logging.error("Unable to undo changes of managed object %s: %s" % (name, exc_info[1]))
+                stats['undo_errors'].append((name, exc_info[1]))
+                continue
+            stats['undone'] += 1
+
+
+def _changed(changes, exc):
+    """ Return the names of the managed objects in changes, a list of (name,
+        commands) run as one batch, that were changed before the batch
+        failed with exc
+    """
+    if isinstance(exc, CommandError):
+        # the failing command itself changed nothing
+        ran = len(exc.results) - 1
+    else:
+        # no telling how far the batch got
+        ran = sum([len(cmds) for name, cmds in changes])
+    names = []
+    for name, cmds in changes:
+        if ran <= 0:
+            break
+        names.append(name)
+        ran -= len(cmds)
+    return names
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="host for SOAP API connection, typically the leader")
+    parser.add_option("-U", "--username", help="username for SOAP API connection")
+    parser.add_option("-P", "--password", help="password for SOAP API connection")
+    parser.add_option("--desired", metavar="FILE", help="read desired managed objects from config FILE")
+    parser.add_option("--current", metavar="FILE", help="read current managed objects from config FILE instead of Peakflow")
+    parser.add_option("--family", help="delete managed objects of this family missing from the desired ones")
+    parser.add_option("--delete-unlisted", action="store_true", help="delete all managed objects missing from the desired ones")
+    parser.add_option("--apply", action="store_true", help="apply the plan, default is to only print it")
+    (options, args) = parser.parse_args()
+
+    if not options.desired:
+        print >> sys.stderr, "Please specify a file with the desired managed objects."
+        sys.exit(1)
+
+    co = ConnectionOptions(options.host, options.username, options.password)
+
+    f = open(options.desired)
+    desired = ManagedObject.from_conf(f.read())
+    f.close()
+
+    current = None
+    if options.current:
+        f = open(options.current)
+        current = ManagedObject.from_conf(f.read())
+        f.close()
+
+    scope = None
+    if options.family:
+        scope = lambda mo: mo.family == options.family
+
+    r = Reconciler(co, scope=scope, delete_unlisted=options.delete_unlisted)
+    plan, stats = r.reconcile(desired, current, dry_run=not options.apply)
+    print plan
+    print "Planned in %.3fs" % plan.elapsed
+    if stats is not None:
+        print "Applied %(commands)d commands in %(batches)d batches in %(apply_time).3fs" % stats
+        if stats['errors']:
+            print "%d batches failed, nothing committed, %d managed objects restored" % (
+                    len(stats['errors']), stats['undone'])
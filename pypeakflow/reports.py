@@ -2,37 +2,36 @@ import logging
 import sys
 import os
 import re
-from peakflow_soap import PeakflowSOAP 
+import socket
+import time
+from peakflow_soap import ConnectionOptions, get_pool, session
+from traffic import TrafficQuery, TrafficResult
+from workers import run_parallel
 
 
 class Report:
-    def __init__(self):
-        self.pf = PeakflowSOAP()
+    def __init__(self, co, cache = None):
+        """ If a QueryCache is given as cache, results are served from it
+            when possible
+        """
+        self.co = co
+        self.cache = cache
 
-    def get_graph(self, output_filename, mo_type, mo_id, title = None, filter2 = None, filter2_binby = 1):
-        query_filter = ""
+    def _get_query(self, mo_type, mo_id, filter2 = None, filter2_binby = 1):
+        return self.get_query(mo_type, mo_id, filter2, filter2_binby).to_xml()
+
+    def get_query(self, mo_type, mo_id, filter2 = None, filter2_binby = 1, start = "24 hours ago"):
+        """ Return the TrafficQuery for the traffic of a managed object since
+            start
+        """
+        query = TrafficQuery(start)
+        query.add_filter(mo_type, [mo_id])
         if filter2:
-            query_filter = """<filter type="%s" binby="%s"/>""" % (filter2, filter2_binby)
-
-        query = """
-            <peakflow version="1.0">
-                <query id="query1" type="traffic">
-                    <time start_ascii="24 hours ago" end_ascii="now"/>
-                    <unit type="bps"/>
-                    <search limit="100" timeout="30"/>
-                    <class>in</class>
-                    <class>out</class>
-                    <filter type="%(mo_type)s">
-                        <instance value="%(mo_type_id)s"/>
-                    </filter>
-                    %(filter2)s
-                </query>
-            </peakflow>
-        """ % {
-                'mo_type': mo_type,
-                'mo_type_id': mo_id,
-                'filter2': query_filter
-                }
+            query.add_filter(filter2, binby = filter2_binby)
+        return query
+
+    def get_graph(self, output_filename, mo_type, mo_id, title = None, filter2 = None, filter2_binby = 1):
+        query = self._get_query(mo_type, mo_id, filter2, filter2_binby)
 
         gc = """<?xml version="1.0" encoding="utf-8"?>
             <peakflow version="2.0">
@@ -48,7 +47,11 @@ class Report:
                     'title': title
                     }
 
-        res = self.pf.getTrafficGraph(query, gc)
+        with session(self.co) as pf:
+            if self.cache is not None:
+                res = self.cache.getTrafficGraph(pf, query, gc)
+            else:
+                res = pf.getTrafficGraph(query, gc)
 
         f = open(output_filename, "w")
         f.write(res['graph'])
@@ -58,31 +61,171 @@ class Report:
     def get_table(self, output_filename, mo_type, mo_id, title = None, filter2 = None, filter2_binby = 1):
         """
         """
-        query_filter = ""
+        query = self._get_query(mo_type, mo_id, filter2, filter2_binby)
+
+        return self.run_query(query)
+
+
+    def get_series(self, mo_type, mo_id, filter2 = None, filter2_binby = 1,
+            start = "24 hours ago", shard_seconds = None, max_workers = 4):
+        """ Return the traffic of a managed object since start as a
+            TrafficResult
+
+            With shard_seconds the query is run in shards, see run_sharded().
+        """
+        query = self.get_query(mo_type, mo_id, filter2, filter2_binby, start)
+        if shard_seconds:
+            return self.run_sharded(query, shard_seconds, max_workers = max_workers)
+        return TrafficResult.from_xml(self.run_query(query))
+
+
+    def run_sharded(self, query, shard_seconds = 86400, max_instances = 50,
+            max_workers = 4, min_shard_seconds = 300):
+        """ Run a TrafficQuery in shards and return the merged TrafficResult
+
+            The time range is split into shards of shard_seconds and filters
+            into shards of at most max_instances instances, which are run
+            max_workers at a time. A shard that times out is halved and its
+            halves run again, until shards span min_shard_seconds and a
+            single instance.
+        """
+        now = time.time()
+        shards = []
+        for q in query.split_time(shard_seconds, now):
+            shards.extend(q.split_instances(max_instances))
+        get_pool(self.co, max_workers)
+
+        results = []
+        while shards:
+            retry = []
+            for shard, res, exc_info in run_parallel(self._run_shard, shards, max_workers):
+                if exc_info is None:
+                    results.append(res)
+                    continue
+                halves = None
+                if _is_timeout(exc_info[1]):
+                    halves = shard.halve(min_shard_seconds, now)
+                if halves is None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                logging.info("Query shard %s - %s timed out, splitting it" % (shard.start, shard.end))
+                retry.extend(halves)
+            shards = retry
+        return TrafficResult.merge(results)
+
+
+    def _run_shard(self, query):
+        return TrafficResult.from_xml(self.run_query(query))
+
+
+    def run_query(self, query):
+        """ Run a traffic query, a TrafficQuery or its XML, and return the
+            XML result
+        """
+        if isinstance(query, TrafficQuery):
+            query = query.to_xml()
+        with session(self.co) as pf:
+            if self.cache is not None:
+                return self.cache.runXmlQuery(pf, query)
+            return pf.runXmlQuery(query)
+
+
+
+def _is_timeout(exc):
+    """ Return True if exc is a timed out request or query
+    """
+    if isinstance(exc, socket.timeout):
+        return True
+    reason = getattr(exc, 'reason', None)
+    if isinstance(reason, socket.timeout):
+        return True
+    message = str(exc).lower()
+    return 'timed out' in message or 'timeout' in message
+
+
+
+class ReportRunner:
+    """ Run many reports with bounded parallelism
+
+        Jobs are (mo_type, mo_id, filter) tuples, filter may be None. Each
+        job is tried up to 1 + retries times. Output is written to
+        output_dir as soon as a job finishes, graphs as
+        <mo_type>-<mo_id>[-<filter>].png and tables as the same name ending
+        in .xml.
+    """
+
+    def __init__(self, co, output_dir, kind = 'graph', max_workers = 4, retries = 2, retry_delay = 5):
+        if kind not in ('graph', 'table'):
+            raise ValueError("Unknown report kind: %s" % kind)
+        self.co = co
+        self.output_dir = output_dir
+        self.kind = kind
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.report = Report(co)
+
+    def get_filename(self, job):
+        mo_type, mo_id, filter2 = job
+        name = "%s-%s" % (mo_type, mo_id)
         if filter2:
-            query_filter = """<filter type="%s" binby="%s"/>""" % (filter2, filter2_binby)
-
-        query = """
-            <peakflow version="1.0">
-                <query id="query1" type="traffic">
-                    <time start_ascii="24 hours ago" end_ascii="now"/>
-                    <unit type="bps"/>
-                    <search limit="100" timeout="30"/>
-                    <class>in</class>
-                    <class>out</class>
-                    <filter type="%(mo_type)s">
-                        <instance value="%(mo_type_id)s"/>
-                    </filter>
-                    %(filter2)s
-                </query>
-            </peakflow>
-        """ % {
-                'mo_type': mo_type,
-                'mo_type_id': mo_id,
-                'filter2': query_filter
-                }
+            name += "-%s" % filter2
+        name = re.sub('[^A-Za-z0-9_.-]', '_', name)
+        if self.kind == 'graph':
+            return os.path.join(self.output_dir, name + '.png')
+        return os.path.join(self.output_dir, name + '.xml')
+
+    def _run_job(self, job):
+        mo_type, mo_id, filter2 = job
+        filename = self.get_filename(job)
+        attempt = 0
+        start = time.time()
+        while True:
+            try:
+                if self.kind == 'graph':
+                    self.report.get_graph(filename, mo_type, mo_id, None, filter2, 1)
+                else:
+                    res = self.report.get_table(filename, mo_type, mo_id, None, filter2, 1)
+                    f = open(filename, "w")
+                    f.write(res.encode('utf-8'))
+                    f.close()
+                return time.time() - start
+            except Exception, exc:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                logging.info("Report %s failed, retrying (%d/%d): %s" % (filename, attempt, self.retries, exc))
+                time.sleep(self.retry_delay * attempt)
 
-        return self.pf.runXmlQuery(query)
+    def run(self, jobs):
+        """ Run jobs and return statistics about the run
+        """
+        get_pool(self.co, self.max_workers)
+        start = time.time()
+        latencies = []
+        failed = []
+        for job, latency, exc_info in run_parallel(self._run_job, jobs, self.max_workers):
+            if exc_info is not None:
+                logging.error("Report %s failed: %s" % (self.get_filename(job), exc_info[1]))
+                failed.append((job, exc_info[1]))
+                continue
+            logging.debug("Wrote %s in %.1fs" % (self.get_filename(job), latency))
+            latencies.append(latency)
+
+        elapsed = time.time() - start
+        stats = {
+                'completed': len(latencies),
+                'failed': failed,
+                'elapsed': elapsed,
+                'jobs_per_second': None,
+                'latency': {}
+                }
+        if elapsed > 0:
+            stats['jobs_per_second'] = len(latencies) / elapsed
+        latencies.sort()
+        for p in (50, 90, 99, 100):
+            if latencies:
+                stats['latency'][p] = latencies[min(len(latencies) - 1, len(latencies) * p / 100)]
+        return stats
 
 
 
@@ -108,15 +251,39 @@ if __name__ == '__main__':
     parser.add_option("--graph-title", help="title of the graph")
     parser.add_option("--graph", help="fetch data and write a graph")
     parser.add_option("--table", help="fetch data and print in tabular form")
+    parser.add_option("--batch", metavar="FILE", help="run reports for the 'mo_type mo_id [filter]' lines in FILE")
+    parser.add_option("--output-dir", metavar="DIR", default=".", help="write batch reports to DIR")
+    parser.add_option("--workers", type="int", default=4, help="number of batch reports to run in parallel")
     (options, args) = parser.parse_args()
 
-    pf = PeakflowSOAP(options.host, options.username, options.password)
+    co = ConnectionOptions(options.host, options.username, options.password)
+
+    if options.batch:
+        jobs = []
+        f = open(options.batch)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            jobs.append((fields[0], fields[1], (fields[2:] or [None])[0]))
+        f.close()
+        kind = 'graph'
+        if options.table:
+            kind = 'table'
+        runner = ReportRunner(co, options.output_dir, kind, options.workers)
+        stats = runner.run(jobs)
+        print "Completed %d reports, %d failed, in %.1fs (%.2f reports/s)" % (
+                stats['completed'], len(stats['failed']), stats['elapsed'],
+                stats['jobs_per_second'] or 0)
+        for p in sorted(stats['latency']):
+            print "  p%-3d latency: %.2fs" % (p, stats['latency'][p])
+        sys.exit(0)
 
     if options.graph and not options.output_file:
         print >> sys.stderr, "Please provide an output file to write the graph to with --output-file"
         sys.exit(1)
 
-    f = Report()
+    f = Report(co)
     if options.graph:
         f.get_graph(options.output_file, options.mo_type, options.mo_id,
                 options.graph_title, options.filter, 1)
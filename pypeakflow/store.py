@@ -0,0 +1,224 @@
+""" Local store of alert history
+"""
+
+import logging
+import sqlite3
+import sys
+
+from peakflow_soap import ConnectionOptions, session
+from alert import Alert, AlertBatch, fetch_recent, find_summary, from_epoch, to_epoch
+
+_columns = ('id', 'type', 'direction', 'protocol', 'destination', 'target_mo',
+        'target_mo_id', 'impact_bps', 'impact_pps', 'threshold',
+        'threshold_unit', 'attack_start', 'attack_stop', 'ongoing',
+        'duration', 'mitigation_name', 'mitigation_start', 'mitigation_stop',
+        'sources')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    type TEXT,
+    direction TEXT,
+    protocol TEXT,
+    destination TEXT,
+    target_mo TEXT,
+    target_mo_id INTEGER,
+    impact_bps REAL,
+    impact_pps REAL,
+    threshold REAL,
+    threshold_unit TEXT,
+    attack_start REAL,
+    attack_stop REAL,
+    ongoing INTEGER,
+    duration REAL,
+    mitigation_name TEXT,
+    mitigation_start REAL,
+    mitigation_stop REAL,
+    sources TEXT
+);
+CREATE INDEX IF NOT EXISTS alerts_target_mo_id ON alerts (target_mo_id);
+CREATE INDEX IF NOT EXISTS alerts_destination ON alerts (destination);
+CREATE INDEX IF NOT EXISTS alerts_attack_start ON alerts (attack_start);
+CREATE INDEX IF NOT EXISTS alerts_ongoing ON alerts (ongoing);
+"""
+
+class AlertStore:
+    """ SQLite backed history of alerts
+
+        Alerts are indexed on alert ID, target managed object gid,
+        destination IP and start time. The store is filled incrementally by
+        sync(), which only stores alerts newer than the newest one already
+        stored plus updates of alerts that were still ongoing. Stored
+        alerts are otherwise never rewritten.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, alerts):
+        """ Store alerts, updating any stored alert with the same ID
+
+            The stored sources of an alert are kept if the alert has none,
+            as alerts read from summaries only lack them.
+        """
+        rows = []
+        for a in alerts:
+            rows.append((a.id, a.type, a.direction, a.protocol,
+                a.destination, a.target_mo, a.target_mo_id, a.impact_bps,
+                a.impact_pps, a.threshold, a.threshold_unit,
+                to_epoch(a.attack_start), to_epoch(a.attack_stop),
+                bool(a.ongoing), a.duration, a.mitigation_name,
+                to_epoch(a.mitigation_start), to_epoch(a.mitigation_stop),
+                ",".join(a.sources) or None))
+        self.db.executemany("INSERT OR IGNORE INTO alerts (%s) VALUES (%s)" % (
+            ", ".join(_columns), ", ".join(["?"] * len(_columns))), rows)
+        # id first in the row, last in the statement
+        self.db.executemany("UPDATE alerts SET %s, sources = COALESCE(?, sources) WHERE id = ?" % (
+            ", ".join(["%s = ?" % name for name in _columns[1:-1]])),
+            [row[1:] + row[:1] for row in rows])
+        self.db.commit()
+        return len(rows)
+
+    def last_id(self):
+        """ Return the highest stored alert ID or None for an empty store
+        """
+        return self.db.execute("SELECT MAX(id) FROM alerts").fetchone()[0]
+
+    def ongoing_ids(self):
+        """ Return the IDs of stored alerts that were ongoing when stored
+        """
+        return set([row[0] for row in self.db.execute("SELECT id FROM alerts WHERE ongoing")])
+
+    def get(self, alert_id):
+        """ Return the stored alert with ID alert_id or None
+        """
+        for a in self.query(alert_id=alert_id):
+            return a
+        return None
+
+    def query(self, start=None, end=None, target_mo_id=None, destination=None, alert_id=None):
+        """ Yield stored alerts, ordered by start time, that started within
+            [start, end) and match the other given criteria
+
+            start and end are datetimes.
+        """
+        where = []
+        args = []
+        if alert_id is not None:
+            where.append("id = ?")
+            args.append(alert_id)
+        if start is not None:
+            where.append("attack_start >= ?")
+            args.append(to_epoch(start))
+        if end is not None:
+            where.append("attack_start < ?")
+            args.append(to_epoch(end))
+        if target_mo_id is not None:
+            where.append("target_mo_id = ?")
+            args.append(target_mo_id)
+        if destination is not None:
+            where.append("destination = ?")
+            args.append(destination)
+
+        sql = "SELECT %s FROM alerts" % ", ".join(_columns)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY attack_start"
+
+        for row in self.db.execute(sql, args):
+            yield self._to_alert(row)
+
+    def query_batch(self, **kwargs):
+        """ Return the alerts matching a query, see query(), as an
+            AlertBatch
+        """
+        return AlertBatch.from_alerts(self.query(**kwargs))
+
+    def sync(self, co, filter='', count=1000, max_count=None):
+        """ Store new alerts from Peakflow and update ongoing ones
+
+            Fetches the count most recent alerts matching filter and stores
+            those newer than the newest stored alert or that were stored
+            while ongoing. If all alerts fetched are newer than the newest
+            stored alert, the count is doubled until they reach back to it,
+            see fetch_recent. Passing max_count limits this at the risk of
+            leaving a gap in the store. Ongoing alerts that are not among
+            the alerts fetched are looked up by ID. Returns the number of
+            alerts stored.
+        """
+        last_id = self.last_id()
+        ongoing = self.ongoing_ids()
+        with session(co) as pf:
+            recent, complete = fetch_recent(pf, filter, count, last_id, max_count)
+            if not complete:
+                logging.warning("More than %d new alerts, alerts after %d are missing" % (max_count, last_id))
+
+            alerts = []
+            for a in recent:
+                if last_id is None or a.id > last_id or a.id in ongoing:
+                    alerts.append(a)
+
+            missing = ongoing - set([a.id for a in alerts])
+            for alert_id in missing:
+                a = find_summary(pf, alert_id)
+                if a is None:
+                    logging.warning("Ongoing alert %d not found" % alert_id)
+                    continue
+                alerts.append(a)
+
+        return self.add(alerts)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM alerts").fetchone()[0]
+
+    def _to_alert(self, row):
+        a = Alert()
+        for name, value in zip(_columns, row):
+            if name in ('attack_start', 'attack_stop', 'mitigation_start', 'mitigation_stop'):
+                value = from_epoch(value)
+            elif name == 'ongoing':
+                value = bool(value)
+            elif name == 'sources':
+                value = value.split(',') if value else []
+            setattr(a, name, value)
+        return a
+
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: %(levelname)-8s %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_stream)
+
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="host for SOAP API connection, typically the leader")
+    parser.add_option("-U", "--username", help="username for SOAP API connection")
+    parser.add_option("-P", "--password", help="password for SOAP API connection")
+    parser.add_option("--store", metavar="FILE", help="SQLite FILE to keep alerts in")
+    parser.add_option("--sync", action="store_true", help="fetch new alerts from Peakflow")
+    parser.add_option("--mo-id", type="int", help="list alerts of managed object with gid MO_ID")
+    parser.add_option("--destination", help="list alerts towards DESTINATION")
+    (options, args) = parser.parse_args()
+
+    if not options.store:
+        print >> sys.stderr, "Please specify a store file."
+        sys.exit(1)
+
+    store = AlertStore(options.store)
+    if options.sync:
+        co = ConnectionOptions(options.host, options.username, options.password)
+        print "Stored %d alerts" % store.sync(co)
+
+    if options.mo_id or options.destination:
+        for a in store.query(target_mo_id=options.mo_id, destination=options.destination):
+            print a.get_current_status()
+    store.close()
@@ -0,0 +1,310 @@
+""" Build traffic queries and decode their results
+"""
+
+import re
+import time
+
+import numpy
+from lxml import etree
+
+_relative_time_re = re.compile('^\s*(\d+)\s+(second|minute|hour|day|week)s?\s+ago\s*$')
+_units = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400
+    }
+
+def parse_time(value, now = None):
+    """ Return a query time, epoch seconds or a time string like "now" or
+        "24 hours ago", as epoch seconds
+
+        Returns None for time strings that are not understood.
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if now is None:
+        now = time.time()
+    if value.strip() == 'now':
+        return int(now)
+    if value.strip().isdigit():
+        return int(value)
+    m = _relative_time_re.match(value)
+    if m is None:
+        return None
+    return int(now) - int(m.group(1)) * _units[m.group(2)]
+
+
+class TrafficQuery:
+    """ A traffic query for runXmlQuery and getTrafficGraph
+
+        start and end are either epoch seconds or Peakflow time strings like
+        "24 hours ago" and "now".
+
+            q = TrafficQuery(start = "7 days ago", unit = "pps")
+            q.add_filter("customer", ["123"])
+            q.add_filter("nexthop", binby = 1)
+            pf.runXmlQuery(q.to_xml())
+    """
+
+    def __init__(self, start = "24 hours ago", end = "now", unit = "bps",
+            classes = ("in", "out"), search_limit = 100, search_timeout = 30,
+            query_id = "query1"):
+        self.start = start
+        self.end = end
+        self.unit = unit
+        self.classes = list(classes)
+        self.search_limit = search_limit
+        self.search_timeout = search_timeout
+        self.query_id = query_id
+        self.filters = []
+
+    def add_filter(self, type, instances = None, binby = None):
+        """ Filter on type, eg "customer", optionally limited to instances
+            and binned by binby
+        """
+        self.filters.append((type, list(instances or []), binby))
+        return self
+
+    def copy(self):
+        q = TrafficQuery(self.start, self.end, self.unit, self.classes,
+                self.search_limit, self.search_timeout, self.query_id)
+        q.filters = [(type, list(instances), binby) for type, instances, binby in self.filters]
+        return q
+
+    def get_range(self, now = None):
+        """ Return the (start, end) of the query in epoch seconds
+        """
+        start = parse_time(self.start, now)
+        end = parse_time(self.end, now)
+        if start is None or end is None:
+            raise ValueError("Cannot convert time range %s - %s to epoch seconds" % (self.start, self.end))
+        return start, end
+
+    def split_time(self, shard_seconds, now = None):
+        """ Split the query into queries of at most shard_seconds each
+
+            Shard boundaries are multiples of shard_seconds, so sample
+            buckets never straddle two shards when shard_seconds is a
+            multiple of the sample interval.
+        """
+        start, end = self.get_range(now)
+        shards = []
+        while start < end:
+            shard_end = min(end, (start // shard_seconds + 1) * shard_seconds)
+            q = self.copy()
+            q.start = start
+            q.end = shard_end
+            shards.append(q)
+            start = shard_end
+        return shards
+
+    def split_instances(self, max_instances):
+        """ Split the query into queries with at most max_instances
+            instances in each filter
+        """
+        shards = [self.copy()]
+        for i, (type, instances, binby) in enumerate(self.filters):
+            if len(instances) <= max_instances:
+                continue
+            split = []
+            for q in shards:
+                for j in range(0, len(instances), max_instances):
+                    shard = q.copy()
+                    shard.filters[i] = (type, instances[j:j + max_instances], binby)
+                    split.append(shard)
+            shards = split
+        return shards
+
+    def halve(self, min_seconds = 300, now = None):
+        """ Split the query in two, by time range or else by the instances of
+            its largest filter
+
+            Returns None when the time range is at most min_seconds and no
+            filter has more than one instance.
+        """
+        start, end = self.get_range(now)
+        if end - start > min_seconds:
+            middle = start + (end - start) // 2
+            # keep sample buckets whole for the usual 1 and 5 minute intervals
+            if middle - middle % 300 > start:
+                middle -= middle % 300
+            first = self.copy()
+            first.start, first.end = start, middle
+            second = self.copy()
+            second.start, second.end = middle, end
+            return [first, second]
+
+        largest = None
+        for i, (type, instances, binby) in enumerate(self.filters):
+            if len(instances) > 1 and (largest is None or len(instances) > len(self.filters[largest][1])):
+                largest = i
+        if largest is None:
+            return None
+        type, instances, binby = self.filters[largest]
+        middle = len(instances) // 2
+        first = self.copy()
+        first.filters[largest] = (type, instances[:middle], binby)
+        second = self.copy()
+        second.filters[largest] = (type, instances[middle:], binby)
+        return [first, second]
+
+    def to_xml(self):
+        root = etree.Element("peakflow", version = "1.0")
+        query = etree.SubElement(root, "query", id = self.query_id, type = "traffic")
+        time_el = etree.SubElement(query, "time")
+        for name, value in (("start", self.start), ("end", self.end)):
+            if isinstance(value, (int, long)):
+                time_el.set(name, str(value))
+            else:
+                time_el.set(name + "_ascii", value)
+        etree.SubElement(query, "unit", type = self.unit)
+        etree.SubElement(query, "search", limit = str(self.search_limit),
+                timeout = str(self.search_timeout))
+        for cls in self.classes:
+            etree.SubElement(query, "class").text = cls
+        for type, instances, binby in self.filters:
+            filter_el = etree.SubElement(query, "filter", type = type)
+            if binby is not None:
+                filter_el.set("binby", str(binby))
+            for instance in instances:
+                etree.SubElement(filter_el, "instance", value = str(instance))
+        return etree.tostring(root, pretty_print = True)
+
+    def __str__(self):
+        return self.to_xml()
+
+
+
+class TrafficResult:
+    """ The time series of a traffic query as NumPy arrays
+
+        timestamps holds the start of every sample in epoch seconds and
+        values is a timestamps x series array with NaN for missing samples.
+        labels names every series, eg "123/in".
+    """
+
+    def __init__(self, timestamps, labels, values):
+        self.timestamps = timestamps
+        self.labels = labels
+        self.values = values
+
+    @classmethod
+    def empty(cls):
+        return TrafficResult(numpy.zeros(0, dtype = numpy.int64), [],
+                numpy.zeros((0, 0)))
+
+    @classmethod
+    def from_xml(cls, xml):
+        """ Decode the XML returned by runXmlQuery
+
+            The series are read from the items of the query-reply element,
+            one item per filter instance or bin with the items of further
+            binned filters nested within, and one class element per class
+            queried:
+
+                <query-reply id="query1">
+                  <item id="123" name="ACME">
+                    <item id="10" name="192.0.2.1">
+                      <class name="in">
+                        <time-series start="1300000000" step="300">1 2</time-series>
+
+            The samples of a time-series are separated by whitespace. A
+            series is labelled by the names, or else IDs, of its items and
+            its class, eg "ACME/192.0.2.1/in".
+        """
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        root = etree.fromstring(xml)
+        reply = root.find('query-reply')
+        if reply is None:
+            raise ValueError("No query-reply in runXmlQuery result")
+
+        series = []
+        _read_items(reply, [], series)
+
+        if not series:
+            return cls.empty()
+
+        steps = set([s_step for s_label, s_start, s_step, s_samples in series])
+        if len(steps) > 1:
+            raise ValueError("Series with different steps: %s" % sorted(steps))
+        step = steps.pop()
+
+        first = min([s_start for s_label, s_start, s_step, s_samples in series])
+        last = max([s_start + step * len(s_samples) for s_label, s_start, s_step, s_samples in series])
+        timestamps = numpy.arange(first, last, step, dtype = numpy.int64)
+        values = numpy.empty((len(timestamps), len(series)))
+        values.fill(numpy.nan)
+        labels = []
+        for i, (s_label, s_start, s_step, s_samples) in enumerate(series):
+            offset = (s_start - first) // step
+            values[offset:offset + len(s_samples), i] = s_samples
+            labels.append(s_label)
+        return TrafficResult(timestamps, labels, values)
+
+    @classmethod
+    def merge(cls, results):
+        """ Merge the results of shards of a query into one result
+
+            Series with the same label are joined on their timestamps. Where
+            shards overlap, the first sample that is not NaN wins.
+        """
+        results = [r for r in results if len(r.labels)]
+        if not results:
+            return cls.empty()
+        if len(results) == 1:
+            return results[0]
+
+        timestamps = results[0].timestamps
+        labels = []
+        label_index = {}
+        for r in results:
+            timestamps = numpy.union1d(timestamps, r.timestamps)
+            for label in r.labels:
+                if label not in label_index:
+                    label_index[label] = len(labels)
+                    labels.append(label)
+
+        values = numpy.empty((len(timestamps), len(labels)))
+        values.fill(numpy.nan)
+        for r in results:
+            rows = numpy.searchsorted(timestamps, r.timestamps)
+            for i, label in enumerate(r.labels):
+                column = values[:, label_index[label]]
+                missing = numpy.isnan(column[rows])
+                column[rows[missing]] = r.values[missing, i]
+        return TrafficResult(timestamps, labels, values)
+
+    def since(self, start):
+        """ Return the samples at or after start
+        """
+        keep = self.timestamps >= start
+        return TrafficResult(self.timestamps[keep], self.labels, self.values[keep])
+
+    def series(self, label):
+        """ Return the values of the series labelled label
+        """
+        return self.values[:, self.labels.index(label)]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return "<TrafficResult %d samples x %d series>" % self.values.shape
+
+
+
+def _read_items(el, path, series):
+    """ Append the series of the items below el, labelled by path and
+        their own names, to series as (label, start, step, samples)
+    """
+    for item in el.iterchildren(tag='item'):
+        item_path = path + [item.get('name') or item.get('id')]
+        for cls_el in item.iterchildren(tag='class'):
+            for ts in cls_el.iterchildren(tag='time-series'):
+                samples = numpy.array((ts.text or '').split(), dtype = float)
+                series.append(("/".join(item_path + [cls_el.get('name')]),
+                    int(ts.get('start')), int(ts.get('step')), samples))
+        _read_items(item, item_path, series)
@@ -0,0 +1,165 @@
+""" Run jobs concurrently on a bounded number of worker threads
+"""
+
+import Queue
+import logging
+import sys
+import threading
+
+def run_parallel(func, jobs, max_workers=4):
+    """ Call func(job) for every job using at most max_workers threads
+
+        Yields a (job, result, exc_info) tuple for every job as it completes,
+        in order of completion rather than the order of jobs. exc_info is
+        None on success, otherwise it is the sys.exc_info() of the exception
+        raised by func and result is None.
+
+        If the caller stops iterating, jobs not yet started are skipped.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return
+
+    job_queue = Queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    done_queue = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.isSet():
+            try:
+                job = job_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done_queue.put((job, func(job), None))
+            except:
+                done_queue.put((job, None, sys.exc_info()))
+
+    threads = []
+    for i in range(min(max_workers, len(jobs))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    try:
+        for i in range(len(jobs)):
+            # wait in short intervals as a blocking get can't be interrupted
+            # by KeyboardInterrupt
+            while True:
+                try:
+                    res = done_queue.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            yield res
+    finally:
+        stop.set()
+
+
+
+class Future:
+    """ The result of a call running on a ThreadPool
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """ Wait for the call to complete and return its result, or raise the
+            exception it raised
+        """
+        if not self._done.wait(timeout) and not self._done.isSet():
+            raise RuntimeError("Timed out waiting for result")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the call to complete and return the exception it raised
+            or None
+        """
+        if not self._done.wait(timeout) and not self._done.isSet():
+            raise RuntimeError("Timed out waiting for result")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) once the call has completed
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def _set(self, result, exc_info):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logging.exception("Exception in future callback")
+
+
+
+class ThreadPool:
+    """ A fixed number of worker threads running submitted calls
+    """
+
+    def __init__(self, num_workers=4):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedule func(*args, **kwargs) and return a Future for its result
+        """
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop the workers once already submitted calls have completed
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            try:
+                future._set(func(*args, **kwargs), None)
+            except:
+                future._set(None, sys.exc_info())
@@ -0,0 +1,204 @@
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from lxml import objectify
+
+import alert
+
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def summary_xml(alert_id, ongoing=True, impact=1000):
+    if ongoing:
+        duration = '<duration start="1300000000" length="60" ongoing="True"/>'
+    else:
+        duration = '<duration start="1300000000" stop="1300000060" length="60" ongoing="False"/>'
+    return """<alert id="%d" type="dos_host_detection">
+  <direction>Incoming</direction>
+  <resource><ip>192.0.2.1</ip><managed_object name="customer-%d" gid="%d"/></resource>
+  %s
+  <impact bps="%d" pps="1"/>
+  <severity threshold="100" unit="bps"/>
+</alert>""" % (alert_id, alert_id, alert_id, duration, impact)
+
+
+class FakePeakflow:
+    """ Stands in for PeakflowSOAP, searching alerts like Peakflow does
+
+        The filter is a free text search, here on the alert ID and the
+        name of the managed object, and alerts are returned newest first.
+    """
+    def __init__(self):
+        self.alerts = {}
+        self.calls = []
+
+    def add(self, alert_id, ongoing=True, impact=1000):
+        self.alerts[alert_id] = summary_xml(alert_id, ongoing, impact)
+
+    def getDosAlertSummariesXML(self, filter, count=1000):
+        self.calls.append((filter, count))
+        ids = [alert_id for alert_id in sorted(self.alerts, reverse=True)
+                if filter in self.alerts[alert_id]]
+        return u'<peakflow version="1.0">%s</peakflow>' % "".join(
+                [self.alerts[alert_id] for alert_id in ids[:count]])
+
+    def getDosAlertDetailsXML(self, alert_id):
+        return '<peakflow version="1.0"/>'
+
+    @contextmanager
+    def session(self, co, timeout=None):
+        yield self
+
+def objectify_sources(details):
+    """ Source prefixes as read by the original objectify based parser
+    """
+    sources = []
+    root = objectify.fromstring(details)
+    for item in root['sample-list']:
+        if item.get('name') is None:
+            continue
+        for prefix in item.prefixes.find('prefix'):
+            if prefix.get('is_dst') == "0":
+                sources.append(prefix.get('cidr'))
+    return sources
+
+
+class IterSamplesTest(unittest.TestCase):
+    def setUp(self):
+        f = open(os.path.join(fixtures, 'alert_details.xml'))
+        self.details = f.read()
+        f.close()
+
+    def test_sources_match_objectify(self):
+        expected = objectify_sources(self.details)
+        self.assertEqual(expected, ['1.1.1.0/24', '3.3.3.0/24', '4.4.4.0/24'])
+        self.assertEqual(list(alert.iter_sources(self.details)), expected)
+
+    def test_samples(self):
+        self.assertEqual(list(alert.iter_samples(self.details.decode('utf-8'))), [
+            ('s1', ['1.1.1.0/24', '3.3.3.0/24']),
+            ('s2', ['4.4.4.0/24'])
+            ])
+
+
+class SummariesTest(unittest.TestCase):
+    def setUp(self):
+        f = open(os.path.join(fixtures, 'alert_summaries.xml'))
+        self.summaries = f.read().decode('utf-8')
+        f.close()
+
+    def test_parse_summaries(self):
+        alerts = alert.parse_summaries(self.summaries)
+        self.assertEqual([a.id for a in alerts], [112, 12])
+        a = alerts[1]
+        self.assertEqual(a.direction, 'Outgoing')
+        self.assertEqual(a.destination, '192.0.2.12')
+        self.assertEqual(a.target_mo, 'customer-12')
+        self.assertEqual(a.target_mo_id, 12)
+        self.assertEqual(a.impact_bps, 1000000.0)
+        self.assertEqual(a.mitigation_name, 'm-12')
+        self.assertEqual(alert.to_epoch(a.attack_start), 1300000000)
+        self.assertEqual(alert.to_epoch(a.mitigation_stop), 1300000290)
+        self.assertEqual(alerts[0].attack_stop, None)
+
+    def test_ongoing(self):
+        alerts = alert.parse_summaries(self.summaries)
+        self.assertEqual([a.ongoing for a in alerts], [True, False])
+        for value, ongoing in (('False', False), ('0', False), ('false', False),
+                ('True', True), ('1', True)):
+            xml = self.summaries.replace('ongoing="True"', 'ongoing="%s"' % value)
+            self.assertEqual(alert.parse_summaries(xml)[0].ongoing, ongoing)
+        # without the attribute, alerts are ongoing until they stop
+        xml = self.summaries.replace(' ongoing="True"', '').replace(' ongoing="False"', '')
+        self.assertEqual([a.ongoing for a in alert.parse_summaries(xml)], [True, False])
+
+    def test_epoch(self):
+        self.assertEqual(alert.to_epoch(None), None)
+        self.assertEqual(alert.from_epoch(None), None)
+        self.assertEqual(alert.from_epoch(float('nan')), None)
+        self.assertEqual(alert.to_epoch(alert.from_epoch(1300000000)), 1300000000)
+
+    def test_batch_round_trip(self):
+        alerts = alert.parse_summaries(self.summaries)
+        batch = alert.AlertBatch.from_alerts(alerts)
+        for a, b in zip(alerts, batch):
+            for name in ('id', 'attack_start', 'attack_stop', 'mitigation_start',
+                    'mitigation_stop', 'impact_bps', 'target_mo'):
+                self.assertEqual(getattr(a, name), getattr(b, name))
+
+
+class FindSummaryTest(unittest.TestCase):
+    def test_widens_search(self):
+        pf = FakePeakflow()
+        for alert_id in (12, 112, 120, 212):
+            pf.add(alert_id)
+        a = alert.find_summary(pf, 12)
+        self.assertEqual(a.id, 12)
+        self.assertEqual(pf.calls, [('12', 1), ('12', 10)])
+        self.assertEqual(alert.find_summary(pf, "212").id, 212)
+        self.assertEqual(alert.find_summary(pf, 13), None)
+
+    def test_from_id(self):
+        pf = FakePeakflow()
+        pf.add(12)
+        pf.add(112)
+        session = alert.session
+        alert.session = pf.session
+        try:
+            self.assertEqual(alert.Alert.from_id(None, '12').id, 12)
+            self.assertRaises(ValueError, alert.Alert.from_id, None, 13)
+        finally:
+            alert.session = session
+
+
+class AlertPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.pf = FakePeakflow()
+        self.session = alert.session
+        alert.session = self.pf.session
+
+    def tearDown(self):
+        alert.session = self.session
+
+    def events(self, poller):
+        return [(e.type, e.alert.id) for e in poller.poll()]
+
+    def test_dropped_ongoing_alert_ends(self):
+        self.pf.add(12)
+        poller = alert.AlertPoller(None, count=2, max_count=4)
+        self.assertEqual(self.events(poller), [('started', 12)])
+        # alert 12 drops off the page, while 112 mentions 12 too
+        for alert_id in range(100, 115):
+            self.pf.add(alert_id, ongoing=False)
+        events = self.events(poller)
+        self.assertTrue(('ended', 12) not in events)
+        self.assertEqual(poller.ongoing.keys(), [12])
+        self.pf.add(12, ongoing=False)
+        self.assertEqual(self.events(poller), [('ended', 12)])
+        self.assertEqual(poller.ongoing, {})
+
+    def test_burst(self):
+        self.pf.add(1)
+        poller = alert.AlertPoller(None, count=2)
+        self.events(poller)
+        for alert_id in range(2, 12):
+            self.pf.add(alert_id)
+        events = self.events(poller)
+        self.assertEqual([alert_id for t, alert_id in events if t == 'started'], range(2, 12))
+        self.assertEqual(poller.last_id, 11)
+
+    def test_not_ongoing_alerts_are_not_tracked(self):
+        self.pf.add(1, ongoing=False)
+        self.pf.add(2)
+        poller = alert.AlertPoller(None)
+        self.assertEqual(self.events(poller), [('started', 2)])
+        self.assertEqual(poller.ongoing.keys(), [2])
+        self.pf.add(2, impact=2000)
+        self.assertEqual(self.events(poller), [('impact_increased', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+import numpy
+
+import analytics
+from alert import Alert, AlertBatch
+
+def make_alert(alert_id, mo_id=None, impact=None, duration=None, destination=None, mitigated=False):
+    a = Alert()
+    a.id = alert_id
+    a.target_mo_id = mo_id
+    a.impact_bps = impact
+    a.duration = duration
+    a.destination = destination
+    a.attack_start = datetime(2011, 3, 13, 12)
+    if mitigated:
+        a.mitigation_start = a.attack_start
+    return a
+
+
+class AnalyticsTest(unittest.TestCase):
+    def setUp(self):
+        self.batch = AlertBatch.from_alerts([
+            make_alert(1, 10, 100.0, 30, '192.0.2.1', True),
+            make_alert(2, 10, 300.0, 120, '192.0.2.1'),
+            make_alert(3, 10, 200.0, 400, '192.0.2.2'),
+            make_alert(4, 20, 50.0, 7200, '192.0.2.1', True),
+            make_alert(5, None, 1000.0, None, None),
+            make_alert(6, 20, None, 100000, '192.0.2.2'),
+            make_alert(7, 30, None, None, '192.0.2.3')
+            ])
+
+    def test_column_is_a_copy(self):
+        ids = analytics.column(self.batch, 'id')
+        # growing the batch reallocates the array the column was read from
+        for i in range(1000):
+            self.batch.append(make_alert(100 + i))
+        self.assertEqual(list(ids), [1, 2, 3, 4, 5, 6, 7])
+        ids[0] = 42
+        self.assertEqual(self.batch.id[0], 1)
+
+    def test_impact_percentiles(self):
+        res = analytics.impact_percentiles(self.batch, percentiles=(0, 50, 90, 100))
+        self.assertEqual(sorted(res), [10, 20])
+        self.assertTrue(numpy.allclose(res[10], numpy.percentile([100, 300, 200], [0, 50, 90, 100])))
+        self.assertTrue(numpy.allclose(res[20], [50, 50, 50, 50]))
+        self.assertEqual(analytics.impact_percentiles(AlertBatch()), {})
+
+    def test_duration_histogram(self):
+        counts, edges = analytics.duration_histogram(self.batch)
+        self.assertEqual(counts.sum(), 5)
+        self.assertEqual(list(counts[:3]), [1, 1, 1])
+        self.assertEqual(counts[-1], 1)
+
+    def test_top_destinations(self):
+        self.assertEqual(analytics.top_destinations(self.batch, 2),
+                [('192.0.2.1', 3), ('192.0.2.2', 2)])
+
+    def test_mitigation_coverage(self):
+        overall, per_mo = analytics.mitigation_coverage(self.batch)
+        self.assertAlmostEqual(overall, 2 / 7.0)
+        self.assertEqual(per_mo, {10: 1 / 3.0, 20: 0.5, 30: 0.0})
+        self.assertEqual(analytics.mitigation_coverage(AlertBatch()), (None, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
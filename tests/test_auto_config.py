@@ -0,0 +1,140 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from auto_config import InterfaceRule, IntfRuleList, RuleEvaluator
+
+def rule(name, precedence=None):
+    r = InterfaceRule()
+    r.name = name
+    r.precedence = precedence
+    return r
+
+
+class InterfaceRuleTest(unittest.TestCase):
+    def test_unset_attributes_are_left_out(self):
+        self.assertEqual(rule("r").get_commands(), [
+            'services sp auto-config interface rules add "r"',
+            'services sp auto-config interface rules edit "r" action type disable',
+            'services sp auto-config interface rules edit "r" action asns disable',
+            'services sp auto-config interface rules edit "r" managed_objects clear'
+            ])
+
+    def test_match_is_saved(self):
+        r = rule("r", 10)
+        r.match_routers = ["router1"]
+        r.match_intf_subnet = "192.0.2.0/24"
+        r.match_intf_desc_regex = "^Customer"
+        cmds = r.get_commands()
+        for cmd in ('precedence set 10', 'routers add "router1"',
+                'subnet set "192.0.2.0/24"', 'regexp set "^Customer"'):
+            self.assertEqual(len([c for c in cmds if c.endswith(cmd)]), 1, cmd)
+
+    def test_from_conf_round_trip(self):
+        conf = """services sp auto-config interface rules add "r"
+services sp auto-config interface rules edit "r" precedence set 10
+services sp auto-config interface rules edit "r" routers add "router1"
+services sp auto-config interface rules edit "r" subnet set "192.0.2.0/24"
+"""
+        r = InterfaceRule.from_conf(conf)[0]
+        self.assertEqual(r.get_commands()[1:4], conf.splitlines()[1:])
+
+
+class IntfRuleListTest(unittest.TestCase):
+    def setUp(self):
+        self.rules = IntfRuleList([rule("a", 10), rule("b", 11), rule("c", 12), rule("d", 20)])
+
+    def order(self):
+        return [(r.name, r.precedence) for r in self.rules]
+
+    def test_insert_in_gap(self):
+        self.assertEqual(self.rules.insert(3, rule("x")), [])
+        self.assertEqual(self.order(), [("a", 10), ("b", 11), ("c", 12), ("x", 16), ("d", 20)])
+
+    def test_insert_renumbers_fewest(self):
+        renumbered = self.rules.insert(1, rule("x"))
+        # moving a down is one renumbering, moving b and c up two
+        self.assertEqual([r.name for r in renumbered], ["a"])
+        self.assertEqual(self.order(), [("a", 9), ("x", 10), ("b", 11), ("c", 12), ("d", 20)])
+
+    def test_insert_renumbers_up(self):
+        rules = IntfRuleList([rule("a", 1), rule("b", 2), rule("c", 3), rule("d", 10)])
+        renumbered = rules.insert(1, rule("x"))
+        self.assertEqual([r.name for r in renumbered], ["b", "c"])
+        self.assertEqual([(r.name, r.precedence) for r in rules],
+                [("a", 1), ("x", 2), ("b", 3), ("c", 4), ("d", 10)])
+
+    def test_move_only_saves_precedence(self):
+        renumbered = self.rules.move("d", 1)
+        self.assertEqual([r.name for r in renumbered], ["d", "a"])
+        self.assertEqual(self.order(), [("a", 9), ("d", 10), ("b", 11), ("c", 12)])
+        self.assertEqual(renumbered[0].get_precedence_commands(), [
+            'services sp auto-config interface rules edit "d" precedence set 10'
+            ])
+
+    def test_indexes(self):
+        self.assertEqual(self.rules.index("c"), 2)
+        self.assertEqual([r.name for r in self.rules.get_by_precedence(11)], ["b"])
+        self.rules.remove("b")
+        self.assertEqual(self.rules.get("b"), None)
+        self.assertEqual(self.rules.index("c"), 1)
+        self.assertRaises(ValueError, self.rules.add, rule("a", 30))
+
+
+class RuleEvaluatorTest(unittest.TestCase):
+    def setUp(self):
+        customer = rule("customer", 30)
+        customer.match_intf_desc_regex = "^Customer"
+        router1 = rule("router1-customer", 20)
+        router1.match_routers = ["router1"]
+        router1.match_intf_desc_regex = "^Customer"
+        subnet = rule("subnet", 10)
+        subnet.match_intf_subnet = "192.0.2.0/24"
+        bad_regexp = rule("bad-regexp", 1)
+        bad_regexp.match_intf_desc_regex = "(Customer"
+        bad_subnet = rule("bad-subnet", 2)
+        bad_subnet.match_intf_subnet = "192.0.2.0/33"
+        fallback = rule("fallback")
+        fallback.match_routers = ["router2"]
+        self.evaluator = RuleEvaluator([fallback, customer, router1, subnet,
+            bad_regexp, bad_subnet])
+
+    def classify(self, router, description, subnet = None):
+        res = self.evaluator.classify(router, description, subnet)
+        return res and res.name
+
+    def test_precedence(self):
+        self.assertEqual(self.classify("router1", "Customer: ACME"), "router1-customer")
+        self.assertEqual(self.classify("router1", "Customer: ACME", "192.0.2.4/30"), "subnet")
+        self.assertEqual(self.classify("router3", "Customer: ACME"), "customer")
+        self.assertEqual([r.name for r in self.evaluator.rules], ["bad-regexp",
+            "bad-subnet", "subnet", "router1-customer", "customer", "fallback"])
+
+    def test_routers(self):
+        self.assertEqual(self.classify("router2", "Core"), "fallback")
+        self.assertEqual(self.classify("router2", "Customer: ACME"), "customer")
+        self.assertEqual(self.classify("router3", "Core"), None)
+
+    def test_subnet(self):
+        self.assertEqual(self.classify("router3", "Core", "192.0.2.4/30"), "subnet")
+        self.assertEqual(self.classify("router3", "Core", "192.0.0.0/16"), None)
+        self.assertEqual(self.classify("router3", "Core", "198.51.100.4/30"), None)
+        self.assertEqual(self.classify("router3", "Core", "not a subnet"), None)
+
+    def test_classify_many(self):
+        res, stats = self.evaluator.classify_many([
+            ("router1", "Customer: ACME", None),
+            ("router2", "Core", None),
+            ("router2", "Customer: ACME", None),
+            ("router3", "Core", None)
+            ])
+        self.assertEqual([r and r.name for r in res],
+                ["router1-customer", "fallback", "customer", None])
+        self.assertEqual((stats['interfaces'], stats['matched']), (4, 3))
+        self.assertEqual(stats['hits'], {"router1-customer": 1, "fallback": 1, "customer": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
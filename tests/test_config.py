@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from config import ConfigCache, PeakflowConfig
+from peakflow_soap import ConnectionOptions
+
+conf_text = """services sp managed_objects add "a"
+services sp managed_objects edit "a" family customer
+services sp interface_rules add "r"
+"""
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetched = []
+        def from_peakflow(co):
+            self.fetched.append(co)
+            conf = PeakflowConfig.from_conf(conf_text)
+            conf.co = co
+            return conf
+        self.from_peakflow = PeakflowConfig.from_peakflow
+        PeakflowConfig.from_peakflow = staticmethod(from_peakflow)
+
+    def tearDown(self):
+        PeakflowConfig.from_peakflow = self.from_peakflow
+        shutil.rmtree(self.cache_dir)
+
+    def test_copy_on_read(self):
+        cache = ConfigCache(cache_dir=self.cache_dir)
+        co = ConnectionOptions('leader', 'user', 'secret')
+        conf = cache.get(co)
+        conf.get_lines('managed_objects').append('services sp managed_objects add "b"')
+        conf.subsystems['interface_rules'] = []
+        again = cache.get(co)
+        self.assertEqual(len(again.get_lines('managed_objects')), 2)
+        self.assertEqual(len(again.get_lines('interface_rules')), 1)
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_keyed_on_connection_options(self):
+        cache = ConfigCache(cache_dir=self.cache_dir)
+        cache.get(ConnectionOptions('leader', 'user', 'secret'))
+        cache.get(ConnectionOptions('leader', 'other', 'password'))
+        cache.get(ConnectionOptions('leader', 'user', 'secret'))
+        self.assertEqual(len(self.fetched), 2)
+
+        # a new process only finds the snapshot of the same options on disk
+        cache = ConfigCache(cache_dir=self.cache_dir)
+        cache.get(ConnectionOptions('leader', 'user', 'wrong'))
+        self.assertEqual(len(self.fetched), 3)
+        cache.get(ConnectionOptions('leader', 'other', 'password'))
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_invalidate_host(self):
+        cache = ConfigCache(cache_dir=self.cache_dir)
+        cache.get(ConnectionOptions('leader', 'user', 'secret'))
+        cache.get(ConnectionOptions('leader', 'other', 'password'))
+        cache.get(ConnectionOptions('leader2', 'user', 'secret'))
+        cache.invalidate('leader')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cache.get(ConnectionOptions('leader', 'user', 'secret'))
+        cache.get(ConnectionOptions('leader2', 'user', 'secret'))
+        self.assertEqual(len(self.fetched), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
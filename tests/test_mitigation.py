@@ -0,0 +1,126 @@
+import os
+import re
+import sys
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+import mitigation
+from mitigation import iter_mitigations, iter_summaries_xml
+
+mitigation_xml = """<mitigationSummary>
+  <id>%(id)d</id>
+  <type>tms</type>
+  <name>m-%(id)d</name>
+  <ip_version>4</ip_version>
+  <alert_id>%(alert_id)s</alert_id>
+  <prefix>192.0.2.0/24</prefix>
+  <is_automitigation>false</is_automitigation>
+  <is_learning>0</is_learning>
+  <managed_object_id>12</managed_object_id>
+  <ongoing>%(ongoing)s</ongoing>
+  <start>%(start)s</start>
+  <stop>%(stop)s</stop>
+  <duration>60</duration>
+</mitigationSummary>"""
+
+def summary(mitigation_id, start, ongoing=False):
+    stop = ''
+    if not ongoing:
+        stop = (start + timedelta(seconds=60)).strftime('%Y-%m-%dT%H:%M:%S')
+    return mitigation_xml % {
+            'id': mitigation_id,
+            'alert_id': '',
+            'ongoing': str(ongoing).lower(),
+            'start': start.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stop': stop
+            }
+
+_filter_re = re.compile('^start:(.+)\.\.(.+)$')
+
+class FakePeakflow:
+    """ Returns the mitigations started within the window of a filter like
+        'start:<epoch>..<epoch>', newest first
+    """
+    def __init__(self, starts):
+        self.starts = starts
+        self.calls = []
+
+    def getMitigationSummariesXML(self, filter='', max_count=1000):
+        m = _filter_re.match(filter)
+        window_start, window_end = float(m.group(1)), float(m.group(2))
+        found = [(start, i) for i, start in enumerate(self.starts)
+                if window_start <= epoch(start) < window_end]
+        found.sort(reverse=True)
+        self.calls.append((filter, len(found[:max_count])))
+        return "<mitigations>%s</mitigations>" % "".join(
+                [summary(i, start) for start, i in found[:max_count]])
+
+    @contextmanager
+    def session(self, co, timeout=None):
+        yield self
+
+def epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+def window_filter(start, end):
+    return "start:%f..%f" % (epoch(start), epoch(end))
+
+
+class MitigationTest(unittest.TestCase):
+    def test_from_element(self):
+        start = datetime(2011, 3, 13, 12, 0, 0)
+        xml = "<mitigations>%s</mitigations>" % summary(7, start)
+        m = list(iter_summaries_xml(xml))[0]
+        self.assertEqual(m.id, 7)
+        self.assertEqual(m.type, 'tms')
+        self.assertEqual(m.alert_id, None)
+        self.assertEqual(m.is_automitigation, False)
+        self.assertEqual(m.is_learning, False)
+        self.assertEqual(m.ongoing, False)
+        self.assertEqual(m.start, start)
+        self.assertEqual(m.stop, start + timedelta(seconds=60))
+        self.assertEqual(m.duration, 60.0)
+
+    def test_to_datetime(self):
+        self.assertEqual(mitigation._to_datetime('2011-03-13T12:00:00'), datetime(2011, 3, 13, 12))
+        self.assertEqual(mitigation._to_datetime('2011-03-13T12:00:00Z'),
+                datetime.fromtimestamp(epoch(datetime(2011, 3, 13, 12))))
+        self.assertEqual(mitigation._to_datetime('2011-03-13T14:00:00+02:00'),
+                datetime.fromtimestamp(epoch(datetime(2011, 3, 13, 12))))
+        self.assertEqual(mitigation._to_datetime('yesterday'), None)
+
+
+class IterMitigationsTest(unittest.TestCase):
+    def setUp(self):
+        self.end = datetime(2011, 3, 20)
+        self.start = self.end - timedelta(days=7)
+        # a burst of 25 mitigations within an hour, and one a day
+        starts = [self.start + timedelta(days=i, hours=1) for i in range(7)]
+        starts += [self.start + timedelta(days=3, minutes=i) for i in range(25)]
+        self.pf = FakePeakflow(starts)
+        self.session = mitigation.session
+        mitigation.session = self.pf.session
+
+    def tearDown(self):
+        mitigation.session = self.session
+
+    def test_pages_are_bounded(self):
+        mitigations = list(iter_mitigations(None, window_filter, self.start, self.end, page_size=10))
+        self.assertEqual(sorted([m.id for m in mitigations]), range(32))
+        self.assertTrue(max([count for filter, count in self.pf.calls]) <= 10)
+        # newest first
+        starts = [m.start for m in mitigations]
+        self.assertEqual(starts, sorted(starts, reverse=True))
+
+    def test_stop_early(self):
+        mitigations = list(iter_mitigations(None, window_filter, self.start, self.end,
+            page_size=10, max_mitigations=3))
+        self.assertEqual(len(mitigations), 3)
+        self.assertEqual(len(self.pf.calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from mo import ManagedObject, MoMatchCidrBlocks
+from peakflow_soap import CliBatch, ConnectionOptions
+
+conf = """services sp managed_objects add "a"
+services sp managed_objects edit "a" description set "Customer A"
+services sp managed_objects edit "a" family set customer
+services sp managed_objects edit "a" tags add "t1"
+services sp managed_objects edit "a" match set cidr_blocks 192.0.2.0/24
+"""
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self.mo = ManagedObject.from_conf(conf)[0]
+        self.mo.co = ConnectionOptions('leader')
+
+    def test_unchanged(self):
+        self.assertEqual(self.mo.get_commands(), [])
+
+    def test_delta(self):
+        self.mo.tags = {'t2': None}
+        self.mo.description = "Customer B"
+        self.assertEqual(self.mo.save(dry_run=True), [
+            'services sp managed_objects edit "a" tags add "t2"',
+            'services sp managed_objects edit "a" tags delete "t1"',
+            'services sp managed_objects edit "a" description set "Customer B"'
+            ])
+
+    def test_unset_is_refused(self):
+        for attr in ('description', 'family', 'match'):
+            mo = ManagedObject.from_conf(conf)[0]
+            loaded = mo._loaded
+            setattr(mo, attr, None)
+            self.assertRaises(ValueError, mo.save, CliBatch(self.mo.co))
+            self.assertEqual(mo._loaded, loaded)
+
+    def test_batch_saves_state_at_save_time(self):
+        batch = CliBatch(self.mo.co)
+        self.mo.description = "Customer B"
+        self.mo.save(batch)
+        self.mo.match = MoMatchCidrBlocks.from_value('198.51.100.0/24')
+        # what running the batch does once the commands have been sent
+        batch._run_callbacks()
+        self.assertEqual(self.mo.get_commands(), [
+            'services sp managed_objects edit "a" match set cidr_blocks 198.51.100.0/24'
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
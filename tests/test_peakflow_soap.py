@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+import peakflow_soap
+from peakflow_soap import CliBatch, CommandError, ConnectionOptions
+
+class FakePeakflow:
+    """ Stands in for PeakflowSOAP, recording the commands run
+    """
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.commands = []
+
+    def cliRun(self, command):
+        self.commands.append(command)
+        if command in self.fail:
+            return {'results': 'ERROR: %s' % command}
+        return {'results': ''}
+
+    def commit(self):
+        self.commands.append('config write')
+
+    def revert(self):
+        self.commands.append('config revert')
+
+
+class CliBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.pf = FakePeakflow(fail=('bad',))
+        @contextmanager
+        def session(co, timeout=None):
+            yield self.pf
+        self.session = peakflow_soap.session
+        peakflow_soap.session = session
+
+    def tearDown(self):
+        peakflow_soap.session = self.session
+
+    def batch(self, commands):
+        batch = CliBatch(ConnectionOptions('leader'))
+        batch.extend(commands)
+        return batch
+
+    def test_commit_once(self):
+        results = self.batch(['one', 'two']).run()
+        self.assertEqual([command for command, res in results], ['one', 'two'])
+        self.assertEqual(self.pf.commands, ['one', 'two', 'config write'])
+
+    def test_failure_is_not_reverted_by_default(self):
+        self.assertRaises(CommandError, self.batch(['one', 'bad', 'two']).run)
+        self.assertEqual(self.pf.commands, ['one', 'bad'])
+
+    def test_revert_on_request(self):
+        try:
+            self.batch(['one', 'bad', 'two']).run(revert=True)
+        except CommandError, exc:
+            self.assertEqual(exc.command, 'bad')
+            self.assertEqual(len(exc.results), 2)
+        else:
+            self.fail("CommandError not raised")
+        self.assertEqual(self.pf.commands, ['one', 'bad', 'config revert'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from mo import ManagedObject, MoMatchCidrBlocks, MoMatchCidrV6Blocks, MoMatchPeerAs
+from prefix_index import PrefixIndex, find_overlaps, format_prefix, parse_prefix, prefix_contains
+
+def make_mo(name, prefixes, match_class=MoMatchCidrBlocks):
+    mo = ManagedObject()
+    mo.name = name
+    mo.match = match_class.from_value(prefixes)
+    return mo
+
+
+class PrefixTest(unittest.TestCase):
+    def test_parse_prefix(self):
+        self.assertEqual(parse_prefix("192.0.2.1/24"), (4, 0xc0000200, 24))
+        self.assertEqual(parse_prefix("192.0.2.1"), (4, 0xc0000201, 32))
+        self.assertEqual(format_prefix(*parse_prefix("2001:db8::1/32")), "2001:db8::/32")
+        for prefix in ("192.0.2.0/33", "192.0.2.0/x", "192.0.2/24", "2001:db8::/129"):
+            self.assertRaises(ValueError, parse_prefix, prefix)
+
+    def test_prefix_contains(self):
+        outer = parse_prefix("192.0.2.0/24")
+        self.assertTrue(prefix_contains(outer, parse_prefix("192.0.2.128/25")))
+        self.assertTrue(prefix_contains(outer, outer))
+        self.assertFalse(prefix_contains(parse_prefix("192.0.2.128/25"), outer))
+        self.assertFalse(prefix_contains(outer, parse_prefix("198.51.100.0/25")))
+        self.assertFalse(prefix_contains(parse_prefix("::/0"), outer))
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.mos = [
+            make_mo("wide", "192.0.2.0/23"),
+            make_mo("narrow", "192.0.2.128/25,198.51.100.7/32"),
+            make_mo("same", "192.0.2.128/25"),
+            make_mo("v6", "2001:db8::/32", MoMatchCidrV6Blocks),
+            make_mo("v6-narrow", "2001:db8:1::/48", MoMatchCidrV6Blocks),
+            make_mo("asn", "65000", MoMatchPeerAs),
+            make_mo("bad", "192.0.2.0/40")
+            ]
+        self.index = PrefixIndex.from_mos(self.mos)
+
+    def names(self, mos):
+        return [mo and mo.name for mo in mos]
+
+    def test_lookup(self):
+        addresses = ["192.0.2.1", "192.0.2.200", "192.0.3.255", "198.51.100.7",
+                "198.51.100.8", "2001:db8::1", "2001:db8:1::1", "2001:db9::1", "0.0.0.0"]
+        expected = ["wide", "narrow", "wide", "narrow", None, "v6", "v6-narrow", None, None]
+        self.assertEqual(self.names([self.index.lookup(a) for a in addresses]), expected)
+        self.assertEqual(self.names(self.index.lookup_many(addresses)), expected)
+        self.assertEqual(self.index.lookup_many([]), [])
+        self.assertRaises(ValueError, self.index.lookup, "192.0.2")
+
+    def test_match(self):
+        prefix, mo = self.index.match("192.0.2.200")
+        self.assertEqual((prefix, mo.name), ("192.0.2.128/25", "narrow"))
+        prefix, mo = self.index.match("2001:db8:1::1")
+        self.assertEqual((prefix, mo.name), ("2001:db8:1::/48", "v6-narrow"))
+        self.assertEqual(self.index.match("203.0.113.1"), None)
+
+    def test_contents(self):
+        self.assertEqual(len(self.index), 6)
+        self.assertTrue("asn" in self.index)
+        self.assertFalse("missing" in self.index)
+
+    def test_remove(self):
+        self.index.lookup_many(["192.0.2.200"])
+        self.index.remove("narrow")
+        self.assertEqual(self.names(self.index.lookup_many(["192.0.2.200", "198.51.100.7"])),
+                ["same", None])
+        self.index.remove("same")
+        self.assertEqual(self.index.lookup("192.0.2.200").name, "wide")
+        self.assertRaises(KeyError, self.index.remove, "narrow")
+
+    def test_update(self):
+        self.index.lookup_many(["192.0.2.200"])
+        self.index.update(make_mo("wide", "203.0.113.0/24"))
+        self.assertEqual(self.names(self.index.lookup_many(["192.0.2.1", "203.0.113.1", "192.0.2.200"])),
+                [None, "wide", "narrow"])
+        self.assertEqual(self.names([self.index.lookup("192.0.2.1")]), [None])
+
+
+class FindOverlapsTest(unittest.TestCase):
+    def setUp(self):
+        twice = make_mo("twice", "203.0.113.0/24")
+        twice.match.prefix.append("203.0.113.0/24")
+        self.res = find_overlaps([
+            make_mo("a", "192.0.2.0/24"),
+            make_mo("b", "192.0.2.0/24"),
+            make_mo("c", "198.51.100.0/24"),
+            make_mo("d", "198.51.100.0/25"),
+            make_mo("e", "198.51.100.128/25,100.64.0.0/10"),
+            make_mo("f", "10.0.0.0/8"),
+            make_mo("g", "10.1.0.0/16,172.16.0.0/12,172.16.0.0/16"),
+            make_mo("h", "10.1.1.0/24"),
+            twice,
+            make_mo("v6", "::/0", MoMatchCidrV6Blocks)
+            ])
+
+    def test_duplicates(self):
+        self.assertEqual(self.res['duplicates'], [
+            ("192.0.2.0/24", ["a", "b"]),
+            ("203.0.113.0/24", ["twice", "twice"])
+            ])
+
+    def test_overlaps(self):
+        self.assertEqual(sorted(self.res['overlaps']), [
+            ("10.0.0.0/8", "f", "10.1.0.0/16", "g"),
+            ("10.0.0.0/8", "f", "10.1.1.0/24", "h"),
+            ("10.1.0.0/16", "g", "10.1.1.0/24", "h"),
+            ("198.51.100.0/24", "c", "198.51.100.0/25", "d"),
+            ("198.51.100.0/24", "c", "198.51.100.128/25", "e")
+            ])
+
+    def test_shadowed(self):
+        self.assertEqual(self.res['shadowed'], [("198.51.100.0/24", ["c"])])
+
+
+if __name__ == '__main__':
+    unittest.main()
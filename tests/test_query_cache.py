@@ -0,0 +1,124 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import reports
+from peakflow_soap import ConnectionOptions
+from query_cache import QueryCache, SeriesCache
+from reports import Report
+from traffic import TrafficQuery
+import test_reports
+
+class FakePeakflow:
+    def __init__(self, host, port=443):
+        self.co = ConnectionOptions(host, port=port)
+        self.calls = 0
+
+    def runXmlQuery(self, query, output_format='xml'):
+        self.calls += 1
+        return "%s reply %d" % (self.co.host, self.calls)
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = QueryCache(ttl = 60, max_entries = 2, bucket = 60)
+
+    def query(self, start, end = "now"):
+        q = TrafficQuery(start, end)
+        q.add_filter("customer", ["123"])
+        return q.to_xml()
+
+    def test_normalise(self):
+        now = 1300000050
+        a = '<peakflow version="1.0"><query type="traffic" id="q"><time start_ascii="24 hours ago" end_ascii="now"/></query></peakflow>'
+        b = '''<peakflow version="1.0">
+                 <!-- same query -->
+                 <query id="q" type="traffic">
+                   <time end="1300000040" start="1299913620"/>
+                 </query>
+               </peakflow>'''
+        self.assertEqual(self.cache.normalise(a, now), self.cache.normalise(b, now))
+        self.assertNotEqual(self.cache.normalise(a, now), self.cache.normalise(a, now + 60))
+
+    def test_hit(self):
+        pf = FakePeakflow('leader')
+        self.assertEqual(self.cache.runXmlQuery(pf, self.query("24 hours ago")), "leader reply 1")
+        self.assertEqual(self.cache.runXmlQuery(pf, self.query("24 hours ago")), "leader reply 1")
+        self.assertEqual(self.cache.runXmlQuery(pf, self.query("7 days ago")), "leader reply 2")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_keyed_on_host(self):
+        query = self.query(1300000000, 1300086400)
+        leader = FakePeakflow('leader')
+        other = FakePeakflow('other')
+        other_port = FakePeakflow('leader', 8443)
+        self.assertEqual(self.cache.runXmlQuery(leader, query), "leader reply 1")
+        self.assertEqual(self.cache.runXmlQuery(other, query), "other reply 1")
+        self.assertEqual(self.cache.runXmlQuery(leader, query), "leader reply 1")
+        self.assertEqual(self.cache.runXmlQuery(other_port, query), "leader reply 1")
+        self.assertEqual((leader.calls, other.calls, other_port.calls), (1, 1, 1))
+
+    def test_lru(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.put('c', 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = QueryCache(ttl = -1)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+
+class SeriesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.pf = test_reports.FakePeakflow()
+        self.session = reports.session
+        reports.session = self.pf.session
+        self.cache = SeriesCache(Report(ConnectionOptions('leader')), window = 3600)
+
+    def tearDown(self):
+        reports.session = self.session
+
+    def check(self, res, start, end):
+        self.assertEqual(list(res.timestamps), range(start, end, 300))
+        self.assertEqual(list(res.series('123/in')), list(res.timestamps))
+
+    def test_refresh(self):
+        now = 1300003200
+        self.check(self.cache.get('customer', '123', now = now), now - 3600, now)
+        self.assertEqual(self.cache.queried_seconds, 3600)
+
+        # only the last bucket fetched and the time since are queried again,
+        # the buckets that left the window are dropped
+        self.check(self.cache.get('customer', '123', now = now + 600), now - 3000, now + 600)
+        self.assertEqual(self.cache.queried_seconds, 3600 + 900)
+        self.assertEqual(len(self.pf.queries), 2)
+
+    def test_stale_entry_is_refetched(self):
+        now = 1300003200
+        self.cache.get('customer', '123', now = now)
+        self.check(self.cache.get('customer', '123', now = now + 7200), now + 3600, now + 7200)
+        self.assertEqual(self.cache.queried_seconds, 7200)
+
+    def test_invalidate(self):
+        now = 1300003200
+        self.cache.get('customer', '123', now = now)
+        self.cache.get('customer', '124', now = now)
+        self.cache.invalidate('customer', '123')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.get('customer', '123', now = now)
+        self.assertEqual(self.cache.queried_seconds, 3 * 3600)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
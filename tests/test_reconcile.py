@@ -0,0 +1,116 @@
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+import peakflow_soap
+import reconcile
+from mo import ManagedObject
+from peakflow_soap import ConnectionOptions
+from reconcile import Reconciler
+
+current_conf = """services sp managed_objects add "a"
+services sp managed_objects edit "a" family set customer
+services sp managed_objects edit "a" tags add "t1"
+services sp managed_objects add "b"
+services sp managed_objects edit "b" family set customer
+services sp managed_objects add "c"
+services sp managed_objects edit "c" family set peer
+"""
+
+desired_conf = """services sp managed_objects add "a"
+services sp managed_objects edit "a" family set customer
+services sp managed_objects edit "a" tags add "t2"
+services sp managed_objects add "d"
+services sp managed_objects edit "d" family set customer
+"""
+
+class FakePeakflow:
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.commands = []
+
+    def cliRun(self, command):
+        self.commands.append(command)
+        if command in self.fail:
+            return {'results': 'ERROR: %s' % command}
+        return {'results': ''}
+
+    def commit(self):
+        self.commands.append('config write')
+
+    def revert(self):
+        self.commands.append('config revert')
+
+
+class ReconcilerTest(unittest.TestCase):
+    def setUp(self):
+        self.pf = FakePeakflow()
+        @contextmanager
+        def session(co, timeout=None):
+            yield self.pf
+        self.session = peakflow_soap.session
+        peakflow_soap.session = session
+        reconcile.session = session
+        self.co = ConnectionOptions('leader')
+        self.current = ManagedObject.from_conf(current_conf)
+        self.desired = ManagedObject.from_conf(desired_conf)
+
+    def tearDown(self):
+        peakflow_soap.session = self.session
+        reconcile.session = self.session
+
+    def test_no_deletes_without_scope(self):
+        plan = Reconciler(self.co).plan(self.desired, self.current)
+        self.assertEqual([name for name, cmds in plan.creates], ['d'])
+        self.assertEqual([name for name, cmds in plan.updates], ['a'])
+        self.assertEqual(plan.deletes, [])
+        self.assertEqual(plan.kept, 2)
+
+    def test_deletes_in_scope(self):
+        r = Reconciler(self.co, scope=lambda mo: mo.family == 'customer')
+        plan = r.plan(self.desired, self.current)
+        self.assertEqual(plan.deletes, ['b'])
+        self.assertEqual(plan.kept, 1)
+
+    def test_delete_unlisted(self):
+        plan = Reconciler(self.co, delete_unlisted=True).plan(self.desired, self.current)
+        self.assertEqual(sorted(plan.deletes), ['b', 'c'])
+
+    def test_unset_is_a_plan_error(self):
+        desired = ManagedObject.from_conf('services sp managed_objects add "a"\n')
+        plan = Reconciler(self.co).plan(desired, self.current)
+        self.assertEqual([name for name, exc in plan.errors], ['a'])
+        self.assertEqual(plan.updates, [])
+
+    def test_failure_undoes_own_changes_only(self):
+        self.pf.fail = ('services sp managed_objects edit "d" family set "customer"',)
+        r = Reconciler(self.co, batch_size=1, max_workers=1, delete_unlisted=True)
+        plan, stats = r.reconcile(self.desired, self.current)
+        self.assertEqual(len(stats['errors']), 1)
+        self.assertFalse(stats['committed'])
+        self.assertEqual(stats['undo_errors'], [])
+        self.assertEqual(stats['undone'], 4)
+        self.assertTrue('config write' not in self.pf.commands)
+        self.assertTrue('config revert' not in self.pf.commands)
+        undo = self.pf.commands[-7:]
+        # d was added before its family failed, a had its tags changed and
+        # b and c were deleted
+        self.assertTrue('services sp managed_objects delete "d"' in undo)
+        self.assertTrue('services sp managed_objects edit "a" tags add "t1"' in undo)
+        self.assertTrue('services sp managed_objects edit "a" tags delete "t2"' in undo)
+        self.assertTrue('services sp managed_objects add "b"' in undo)
+        self.assertTrue('services sp managed_objects edit "c" family set peer' in undo)
+
+    def test_commit_once(self):
+        r = Reconciler(self.co, batch_size=1)
+        plan, stats = r.reconcile(self.desired, self.current)
+        self.assertTrue(stats['committed'])
+        self.assertEqual(self.pf.commands.count('config write'), 1)
+        self.assertEqual(self.pf.commands[-1], 'config write')
+
+
+if __name__ == '__main__':
+    unittest.main()
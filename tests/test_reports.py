@@ -0,0 +1,158 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+from lxml import etree
+
+import reports
+from peakflow_soap import ConnectionOptions
+from reports import Report, ReportRunner
+from traffic import TrafficQuery
+
+def traffic_reply(query):
+    """ Return a runXmlQuery reply to query with one series per instance of
+        its first filter, whose samples are their timestamps
+    """
+    q = etree.fromstring(query).find('query')
+    time_el = q.find('time')
+    start = int(time_el.get('start', 1300000000))
+    end = int(time_el.get('end', start + 1500))
+    root = etree.Element('peakflow', version = '1.0')
+    reply = etree.SubElement(root, 'query-reply', id = q.get('id'))
+    reply.append(q)
+    for instance in q.find('filter').findall('instance'):
+        item = etree.SubElement(reply, 'item', id = instance.get('value'))
+        cls = etree.SubElement(item, 'class', name = 'in')
+        ts = etree.SubElement(cls, 'time-series', start = str(start), step = '300')
+        ts.text = " ".join([str(t) for t in range(start, end, 300)])
+    return etree.tostring(root)
+
+
+class FakePeakflow:
+    """ Answers runXmlQuery with traffic_reply(), failing the first
+        failures[instance] queries of an instance and timing out queries
+        of more than max_seconds or max_instances
+    """
+    def __init__(self, failures=None, max_seconds=None, max_instances=None):
+        self.failures = dict(failures or {})
+        self.max_seconds = max_seconds
+        self.max_instances = max_instances
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def runXmlQuery(self, query):
+        q = etree.fromstring(query).find('query')
+        instances = q.findall('filter/instance')
+        time_el = q.find('time')
+        self.lock.acquire()
+        try:
+            self.queries.append(query)
+            if self.failures.get(instances[0].get('value')):
+                self.failures[instances[0].get('value')] -= 1
+                raise RuntimeError("Server raised fault: query failed")
+        finally:
+            self.lock.release()
+        if self.max_seconds is not None and int(time_el.get('end')) - int(time_el.get('start')) > self.max_seconds:
+            raise socket.timeout("timed out")
+        if self.max_instances is not None and len(instances) > self.max_instances:
+            raise RuntimeError("Server raised fault: query timeout")
+        return traffic_reply(query)
+
+    @contextmanager
+    def session(self, co, timeout=None):
+        yield self
+
+
+class ReportRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.pf = FakePeakflow({'2': 1, '3': 5})
+        self.session = reports.session
+        reports.session = self.pf.session
+
+    def tearDown(self):
+        reports.session = self.session
+        shutil.rmtree(self.output_dir)
+
+    def runner(self, **kwargs):
+        return ReportRunner(ConnectionOptions('leader'), self.output_dir,
+                'table', retry_delay = 0, **kwargs)
+
+    def test_filenames(self):
+        runner = self.runner()
+        self.assertEqual(runner.get_filename(('customer', '1', None)),
+                os.path.join(self.output_dir, 'customer-1.xml'))
+        self.assertEqual(runner.get_filename(('customer', '1', 'next hop/x')),
+                os.path.join(self.output_dir, 'customer-1-next_hop_x.xml'))
+        self.assertRaises(ValueError, ReportRunner, ConnectionOptions('leader'),
+                self.output_dir, 'pdf')
+
+    def test_run(self):
+        jobs = [('customer', str(i), None) for i in range(1, 5)]
+        stats = self.runner(retries = 2).run(jobs)
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual([job for job, exc in stats['failed']], [('customer', '3', None)])
+        self.assertEqual(sorted(stats['latency']), [50, 90, 99, 100])
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                ['customer-1.xml', 'customer-2.xml', 'customer-4.xml'])
+        # 1 and 4 once, 2 failed once, 3 tried 1 + retries times
+        self.assertEqual(len(self.pf.queries), 1 + 2 + 3 + 1)
+
+        f = open(os.path.join(self.output_dir, 'customer-2.xml'))
+        reply = etree.fromstring(f.read())
+        f.close()
+        self.assertEqual(reply.find('query-reply/item').get('id'), '2')
+
+
+class RunShardedTest(unittest.TestCase):
+    def setUp(self):
+        self.session = reports.session
+
+    def tearDown(self):
+        reports.session = self.session
+
+    def run_sharded(self, pf, instances, **kwargs):
+        reports.session = pf.session
+        query = TrafficQuery(1299996000, 1300003200)
+        query.add_filter("customer", instances)
+        return Report(ConnectionOptions('leader')).run_sharded(query, **kwargs)
+
+    def check(self, res, instances):
+        # shards finish in any order, and so are their series merged
+        self.assertEqual(sorted(res.labels), ["%s/in" % i for i in instances])
+        self.assertEqual(list(res.timestamps), range(1299996000, 1300003200, 300))
+        for label in res.labels:
+            self.assertEqual(list(res.series(label)), list(res.timestamps))
+
+    def test_shards(self):
+        pf = FakePeakflow()
+        instances = [str(i) for i in range(5)]
+        res = self.run_sharded(pf, instances, shard_seconds = 3600, max_instances = 2)
+        # 2 one hour shards times 3 shards of instances
+        self.assertEqual(len(pf.queries), 6)
+        self.check(res, instances)
+
+    def test_timeouts_are_halved(self):
+        pf = FakePeakflow(max_seconds = 1800, max_instances = 1)
+        res = self.run_sharded(pf, ["1", "2"], shard_seconds = 86400)
+        self.check(res, ["1", "2"])
+
+    def test_unsplittable_timeout(self):
+        pf = FakePeakflow(max_seconds = 200)
+        self.assertRaises(socket.timeout, self.run_sharded, pf, ["1"],
+                min_shard_seconds = 300)
+
+    def test_other_errors(self):
+        pf = FakePeakflow(failures = {'1': 1})
+        self.assertRaises(RuntimeError, self.run_sharded, pf, ["1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
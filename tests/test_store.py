@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import store
+from alert import parse_summaries
+from store import AlertStore
+from test_alert import FakePeakflow
+
+class AlertStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.pf = FakePeakflow()
+        self.session = store.session
+        store.session = self.pf.session
+        self.store = AlertStore(':memory:')
+
+    def tearDown(self):
+        store.session = self.session
+        self.store.close()
+
+    def test_ongoing_ids(self):
+        self.pf.add(1, ongoing=False)
+        self.pf.add(2)
+        self.assertEqual(self.store.sync(None), 2)
+        self.assertEqual(self.store.ongoing_ids(), set([2]))
+        self.assertEqual(self.store.get(1).ongoing, False)
+
+    def test_sync_fills_gap(self):
+        self.pf.add(1, ongoing=False)
+        self.store.sync(None, count=2)
+        for alert_id in range(2, 12):
+            self.pf.add(alert_id, ongoing=False)
+        self.assertEqual(self.store.sync(None, count=2), 10)
+        self.assertEqual(len(self.store), 11)
+        self.assertEqual(self.pf.calls[-1], ('', 16))
+
+    def test_sync_closes_dropped_ongoing_alert(self):
+        self.pf.add(12)
+        self.store.sync(None, count=2)
+        for alert_id in range(100, 115):
+            self.pf.add(alert_id, ongoing=False)
+        self.pf.add(12, ongoing=False)
+        self.store.sync(None, count=2, max_count=4)
+        self.assertEqual(self.store.get(12).ongoing, False)
+        self.assertEqual(self.store.get(12).target_mo, 'customer-12')
+        self.assertEqual(self.store.ongoing_ids(), set())
+        self.assertEqual(self.pf.calls[-2:], [('12', 1), ('12', 10)])
+
+    def test_update_keeps_sources(self):
+        self.pf.add(1)
+        a = parse_summaries(self.pf.getDosAlertSummariesXML('', 1))[0]
+        a.sources = ['198.51.100.0/24']
+        self.store.add([a])
+        self.pf.add(1, ongoing=False)
+        self.store.sync(None)
+        stored = self.store.get(1)
+        self.assertEqual(stored.ongoing, False)
+        self.assertEqual(stored.sources, ['198.51.100.0/24'])
+
+    def test_query(self):
+        for alert_id in (1, 2, 3):
+            self.pf.add(alert_id, ongoing=False)
+        self.store.sync(None)
+        self.assertEqual([a.id for a in self.store.query(target_mo_id=2)], [2])
+        self.assertEqual(len(self.store.query_batch(destination='192.0.2.1')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pypeakflow'))
+
+import numpy
+from lxml import etree
+
+from traffic import TrafficQuery, TrafficResult
+
+fixtures = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def read_fixture(name):
+    f = open(os.path.join(fixtures, name))
+    data = f.read()
+    f.close()
+    return data
+
+
+class TrafficResultTest(unittest.TestCase):
+    def setUp(self):
+        self.result = TrafficResult.from_xml(read_fixture('traffic_reply.xml'))
+
+    def test_labels(self):
+        self.assertEqual(self.result.labels, ['ACME/in', 'ACME/out', 'ACME/10/in', 'ACME/192.0.2.2/in'])
+
+    def test_timestamps(self):
+        self.assertEqual(list(self.result.timestamps), range(1300000000, 1300001500, 300))
+        self.assertEqual(self.result.values.shape, (5, 4))
+
+    def test_values(self):
+        self.assertEqual(list(self.result.series('ACME/in')), [100, 200, 300, 400, 500])
+        out = self.result.series('ACME/out')
+        self.assertTrue(numpy.isnan(out[0]))
+        self.assertTrue(numpy.isnan(out[3]))
+        self.assertEqual(list(out[[1, 2, 4]]), [10, 20, 40])
+        self.assertEqual(numpy.isnan(self.result.series('ACME/192.0.2.2/in')).sum(), 3)
+
+    def test_query_is_not_a_series(self):
+        # the echoed query has time and class elements too
+        self.assertFalse([label for label in self.result.labels if 'query' in label])
+
+    def test_no_reply(self):
+        self.assertRaises(ValueError, TrafficResult.from_xml, '<peakflow version="1.0"/>')
+        empty = TrafficResult.from_xml(u'<peakflow><query-reply/></peakflow>')
+        self.assertEqual(len(empty), 0)
+
+
+class TrafficQueryTest(unittest.TestCase):
+    def test_to_xml(self):
+        q = TrafficQuery(start = 1300000000, end = "now", unit = "pps")
+        q.add_filter("customer", ["123"])
+        q.add_filter("nexthop", binby = 1)
+        query = etree.fromstring(q.to_xml()).find('query')
+        self.assertEqual(query.find('time').attrib, {'start': '1300000000', 'end_ascii': 'now'})
+        self.assertEqual(query.find('unit').get('type'), 'pps')
+        self.assertEqual([el.text for el in query.findall('class')], ['in', 'out'])
+        filters = query.findall('filter')
+        self.assertEqual(filters[0].find('instance').get('value'), '123')
+        self.assertEqual(filters[1].get('binby'), '1')
+
+    def test_split_time(self):
+        q = TrafficQuery(start = "2 days ago")
+        shards = q.split_time(86400, now = 1300000000)
+        self.assertEqual([(s.start, s.end) for s in shards], [
+            (1299827200, 1299888000),
+            (1299888000, 1299974400),
+            (1299974400, 1300000000)
+            ])
+        self.assertEqual(q.start, "2 days ago")
+
+    def test_split_instances(self):
+        q = TrafficQuery(1300000000, 1300086400)
+        q.add_filter("customer", ["1", "2", "3"])
+        q.add_filter("nexthop", binby = 1)
+        shards = q.split_instances(2)
+        self.assertEqual([s.filters for s in shards], [
+            [("customer", ["1", "2"], None), ("nexthop", [], 1)],
+            [("customer", ["3"], None), ("nexthop", [], 1)]
+            ])
+
+    def test_halve(self):
+        q = TrafficQuery(1300000200, 1300003900)
+        q.add_filter("customer", ["1", "2", "3"])
+        first, second = q.halve(300)
+        # the middle is snapped to a 5 minute bucket
+        self.assertEqual((first.start, first.end, second.start, second.end),
+                (1300000200, 1300002000, 1300002000, 1300003900))
+
+        q = TrafficQuery(1300000200, 1300000500)
+        q.add_filter("customer", ["1", "2", "3"])
+        first, second = q.halve(300)
+        self.assertEqual((first.filters[0][1], second.filters[0][1]), (["1"], ["2", "3"]))
+        self.assertEqual(first.halve(300), None)
+
+
+class TrafficMergeTest(unittest.TestCase):
+    def test_merge(self):
+        nan = numpy.nan
+        a = TrafficResult(numpy.array([0, 300, 600]), ['1/in'],
+                numpy.array([[1.0], [2.0], [nan]]))
+        b = TrafficResult(numpy.array([600, 900]), ['1/in', '2/in'],
+                numpy.array([[3.0, 30.0], [4.0, 40.0]]))
+        res = TrafficResult.merge([a, TrafficResult.empty(), b])
+        self.assertEqual(list(res.timestamps), [0, 300, 600, 900])
+        self.assertEqual(res.labels, ['1/in', '2/in'])
+        self.assertEqual(list(res.series('1/in')), [1, 2, 3, 4])
+        self.assertEqual(list(res.series('2/in')[2:]), [30, 40])
+        self.assertTrue(numpy.isnan(res.series('2/in')[:2]).all())
+
+    def test_merge_first_wins(self):
+        a = TrafficResult(numpy.array([0, 300]), ['1/in'], numpy.array([[1.0], [2.0]]))
+        b = TrafficResult(numpy.array([300]), ['1/in'], numpy.array([[5.0]]))
+        self.assertEqual(list(TrafficResult.merge([a, b]).series('1/in')), [1, 2])
+        self.assertEqual(len(TrafficResult.merge([])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()